@@ -1,21 +1,120 @@
 # coding=utf-8
-from time import mktime
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import defaultdict, OrderedDict, Counter
+from copy import copy
+from functools import reduce
+from heapq import merge
+from itertools import islice
+from math import ceil, floor
+from operator import or_
+from threading import Lock
 from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, Q, Count, Max
 from django.db.models.signals import post_save, post_delete
 from django.db.transaction import atomic
 from django.dispatch import receiver
+from . import outbox
+from .edge_list import (
+    EdgeList, EdgeListItem, encode_member, decode_member, time_to_score, score_to_time, load_nodes, prefetch_nodes
+)
+from .fields import check_node_pk_columns
+from .local_cache import LocalCache, MISSING
+
 
 # KEY FORMATS
-COUNT_KEY_FORMAT = getattr(settings, 'COUNT_KEY_FORMAT', "count:%(ctype)s:%(pk)s:%(etype)s:%(site)s")
-EDGE_LIST_KEY_FORMAT = getattr(settings, 'EDGE_LIST_KEY_FORMAT', "elist:%(ctype)s:%(pk)s:%(etype)s:%(site)s")
-EDGE_KEY_FORMAT = getattr(settings, 'EDGE_KEY_FORMAT', "edge:%(ctype1)s:%(pk1)s:%(etype)s:%(ctype2)s:%(pk2)s:%(site)s")
+def key_formats(tagged):
+    """
+    Returns the default key formats, by setting name. Tagged keys carry the {ctype:pk} hash tag of their node, which a
+    sharded graph cache routes them by, so that all the keys of a node live in the same shard.
+    """
+    node, node1 = '%(ctype)s:%(pk)s', '%(ctype1)s:%(pk1)s'
+    if tagged:
+        node, node1 = '{%s}' % node, '{%s}' % node1
+    return {
+        'COUNT_KEY_FORMAT': "count:" + node + ":%(etype)s:%(site)s",
+        'EDGE_LIST_KEY_FORMAT': "elist:" + node + ":%(etype)s:%(site)s",
+        'EDGE_KEY_FORMAT': "edge:" + node1 + ":%(etype)s:%(ctype2)s:%(pk2)s:%(site)s",
+        'EDGE_LIST_STATE_KEY_FORMAT': "estate:" + node + ":%(etype)s:%(site)s",
+        'IN_COUNT_KEY_FORMAT': "icount:" + node + ":%(etype)s:%(site)s",
+        'IN_EDGE_LIST_KEY_FORMAT': "ielist:" + node + ":%(etype)s:%(site)s",
+        'IN_EDGE_LIST_STATE_KEY_FORMAT': "iestate:" + node + ":%(etype)s:%(site)s",
+    }
+
+
+def _graph_cache_sharded():
+    from django.utils.module_loading import import_by_path
+    from .cache_backend import ShardedRedisCache
+
+    caches = getattr(settings, 'CACHES', {})
+    config = caches.get(getattr(settings, 'GRAPH_CACHE_ALIAS', 'graph')) or caches.get('default', {})
+    try:
+        return issubclass(import_by_path(config.get('BACKEND', '')), ShardedRedisCache)
+    except ImproperlyConfigured:
+        return False
+
+
+# (keys are only tagged with a sharded graph cache, not to rename the keys of the others)
+_KEY_FORMATS = key_formats(_graph_cache_sharded())
+COUNT_KEY_FORMAT = getattr(settings, 'COUNT_KEY_FORMAT', _KEY_FORMATS['COUNT_KEY_FORMAT'])
+EDGE_LIST_KEY_FORMAT = getattr(settings, 'EDGE_LIST_KEY_FORMAT', _KEY_FORMATS['EDGE_LIST_KEY_FORMAT'])
+EDGE_KEY_FORMAT = getattr(settings, 'EDGE_KEY_FORMAT', _KEY_FORMATS['EDGE_KEY_FORMAT'])
+EDGE_LIST_STATE_KEY_FORMAT = getattr(settings, 'EDGE_LIST_STATE_KEY_FORMAT', _KEY_FORMATS['EDGE_LIST_STATE_KEY_FORMAT'])
+REBUILD_LOCK_KEY_FORMAT = getattr(settings, 'REBUILD_LOCK_KEY_FORMAT', "rebuild:%(key)s")
+IN_COUNT_KEY_FORMAT = getattr(settings, 'IN_COUNT_KEY_FORMAT', _KEY_FORMATS['IN_COUNT_KEY_FORMAT'])
+IN_EDGE_LIST_KEY_FORMAT = getattr(settings, 'IN_EDGE_LIST_KEY_FORMAT', _KEY_FORMATS['IN_EDGE_LIST_KEY_FORMAT'])
+IN_EDGE_LIST_STATE_KEY_FORMAT = getattr(
+    settings, 'IN_EDGE_LIST_STATE_KEY_FORMAT', _KEY_FORMATS['IN_EDGE_LIST_STATE_KEY_FORMAT']
+)
+
 
+# EDGE LIST CACHE MISSES
+REBUILD = 'rebuild'
+
+# CACHE TIMEOUTS of each key family ('count', 'list', 'edge' and 'no_edge'), in seconds (None for no expiration, the
+# cache default timeout for the families not set). Expirations are refreshed each time a key is read (sliding
+# expiration). A 'no_edge' timeout of 0 turns negative caching off.
+CACHE_TIMEOUTS = getattr(settings, 'GRAPH_CACHE_TIMEOUTS', {})
+
+# NEGATIVE CACHING: value cached under the edge key of edges known not to exist
+NO_EDGE = 'social_graph:no_edge'
 
 # EDGE LIST ITEM REPRESENTATION INDEX
 TO_NODE, ATTRIBUTES, TIME = 0, 1, 2
 
+# EDGE LIST MEMBERS FORMAT: "ctype_id:pk" node references instead of pickled (node, attributes, time) tuples
+COMPACT_EDGE_LISTS = getattr(settings, 'GRAPH_COMPACT_EDGE_LISTS', False)
+
+# EDGE LIST REBUILDS: only one process rebuilds a missing edge list, the others wait up to REBUILD_WAIT seconds for
+# it, and get their page from the database when it takes longer (a rebuild lock expires after REBUILD_LOCK_TIMEOUT)
+REBUILD_LOCK_TIMEOUT = getattr(settings, 'GRAPH_REBUILD_LOCK_TIMEOUT', 10)
+REBUILD_WAIT = getattr(settings, 'GRAPH_REBUILD_WAIT', 0.1)
+# times a rebuild reads the edge list again when a write patches the cached list meanwhile, before dropping it
+REBUILD_ATTEMPTS = getattr(settings, 'GRAPH_REBUILD_ATTEMPTS', 3)
+
+# EDGE LIST WINDOWS: when set, only the EDGE_LIST_WINDOW most recent edges of a list are cached on a miss, and the
+# edge list state key tells whether the cached list is COMPLETE or TRUNCATED. Deeper pages extend the cached window
+# (in steps of EDGE_LIST_WINDOW edges), time ranges past the window are read from the database.
+EDGE_LIST_WINDOW = getattr(settings, 'GRAPH_EDGE_LIST_WINDOW', None)
+COMPLETE, TRUNCATED = 'complete', 'truncated'
+
+# IN-PROCESS CACHE of edge counts, edges and first edge list pages, in front of the graph cache: None (off), or the
+# LocalCache arguments, e.g. {'size': 10000, 'timeout': 5}
+LOCAL_CACHE = getattr(settings, 'GRAPH_LOCAL_CACHE', None)
+
+# BULK OPERATIONS
+BULK_CHUNK_SIZE = getattr(settings, 'GRAPH_BULK_CHUNK_SIZE', 500)
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    items = list(items)
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
 
 class Graph(object):
     client_requires = [
@@ -23,22 +122,51 @@ class Graph(object):
         'add_to_sorted_set',
         'rem_from_sorted_set',
         'sorted_set_rev_range',
-        'sorted_set_rev_range_by_score'
+        'sorted_set_rev_range_by_score',
+        'update_graph',
+        'add_member_to_sorted_set',
+        'sorted_set_rev_range_with_scores',
+        'sorted_set_rev_range_by_score_with_scores',
+        'acquire_lock',
+        'release_lock',
+        'wait_for_lock',
+        'get_and_touch',
+        'sorted_sets_rev_range_by_score_with_scores',
+        'intersect_sorted_sets',
+        'has_keys',
+        'touch_many',
+        'replace_sorted_set',
+        'push_to_list',
+        'pop_from_list',
+        'publish',
+        'subscribe'
     ]
     __instance = None
     _nodeTypes = set()
     _instance_count = 0
+    # edge list rebuilds done by this process ('rebuilds'), avoided because another process was rebuilding the same
+    # list ('coalesced'), and pages served from the database while waiting for another process ('db_fallbacks')
+    rebuild_stats = Counter()
+    # in-process caches of this process, one per graph cache alias (each with its invalidations listener)
+    _local_caches = {}
+    _local_caches_lock = Lock()
+    # whether the node pk columns were found to match GRAPH_NODE_PK_FIELD (checked once per process)
+    _node_pk_columns_checked = False
 
     def __init__(self):
         from django.core.cache import get_cache, InvalidCacheBackendError, DEFAULT_CACHE_ALIAS
-        from django.core.exceptions import ImproperlyConfigured
+        self.cache_alias = getattr(settings, 'GRAPH_CACHE_ALIAS', 'graph')
         try:
-            self.cache = get_cache(getattr(settings, 'GRAPH_CACHE_ALIAS', 'graph'))
+            self.cache = get_cache(self.cache_alias)
         except InvalidCacheBackendError:
+            self.cache_alias = DEFAULT_CACHE_ALIAS
             self.cache = get_cache(DEFAULT_CACHE_ALIAS)
         for func_name in self.client_requires:
             if not getattr(self.cache, func_name, None):
                 raise ImproperlyConfigured("Selected Cache backend must have a %s function" % func_name)
+        if not Graph._node_pk_columns_checked:
+            check_node_pk_columns()
+            Graph._node_pk_columns_checked = True
 
     def __new__(cls, *more):
         return cls.get_instance(*more)
@@ -102,19 +230,764 @@ class Graph(object):
 
     # Edges Writing #
 
-    @atomic
-    def edge(self, from_node, to_node, etype, site, attributes="{}"):
+    def edge(self, from_node, to_node, etype, site, attributes="{}", keep_time=False):
+        """
+        Creates the edge (from_node, etype, to_node) in site, or updates its attributes if it already exists.
+        :param keep_time: when updating, keep the original edge time instead of refreshing it
+        """
         from .models import Edge
-        try:
-            return self._update(from_node, to_node, etype, site, attributes)
-        except Edge.DoesNotExist:
-            return self._add(from_node, to_node, etype, site, attributes)
+        with outbox.atomic():
+            try:
+                return self._update(from_node, to_node, etype, site, attributes, keep_time)
+            except Edge.DoesNotExist:
+                return self._add(from_node, to_node, etype, site, attributes)
 
     def no_edge(self, from_node, to_node, etype, site):
-        return self._delete(from_node, to_node, etype, site)
+        with outbox.atomic():
+            return self._delete(from_node, to_node, etype, site)
+
+    @atomic
+    def edges_bulk(self, edges, keep_time=False):
+        """
+        Creates (or updates) many edges at once, the same way edge() does for a single one.
+        Returns the list of created or updated edges (created symmetric edges included).
+        :param edges: iterable of (from_node, to_node, etype[, site[, attributes]]) tuples
+        :param keep_time: when updating, keep the original edges time instead of refreshing it
+        """
+        from social_graph import signals
+
+        rows = self._bulk_rows(edges)
+        created, updated = self._bulk_upsert(rows, keep_time=keep_time)
+
+        # symmetric edges of the created ones, with the same attributes as their original edges
+        inverse_types = {}
+        symmetric_rows = OrderedDict()
+        for edge in created:
+            if edge.type_id not in inverse_types:
+                inverse_types[edge.type_id] = self._inverse_type(edge.type)
+            symmetric_type = inverse_types[edge.type_id]
+            if symmetric_type is not None:
+                row = (edge.toNode, edge.fromNode, symmetric_type, edge.site, edge.attributes, True)
+                symmetric_rows[self._bulk_identity(row)] = row
+        created += self._bulk_upsert(symmetric_rows, keep_existing=True)[0]
+
+        deltas = defaultdict(int)
+        for edge in created:
+            deltas[(edge.fromNode_type_id, u'%s' % edge.fromNode_pk, edge.type_id, edge.site_id)] += 1
+        self._bulk_adjust_counts(deltas)
+        self._bulk_cache_write(created, updated)
+
+        for edge in created:
+            signals.edge_created.send(sender=edge.type, instance=edge)
+        for edge in updated:
+            signals.edge_updated.send(sender=edge.type, instance=edge)
+        return created + updated
+
+    @atomic
+    def no_edges_bulk(self, edges):
+        """
+        Deletes many edges at once, the same way no_edge() does for a single one.
+        Returns the number of deleted edges (symmetric edges included).
+        :param edges: iterable of (from_node, to_node, etype[, site]) tuples
+        """
+        from django.db.models.sql.subqueries import DeleteQuery
+        from .models import Edge
+        from social_graph import signals
+
+        rows = self._bulk_rows(edge[:4] for edge in edges)
+        existing = self._bulk_lookup(rows)
+        deleted = list(existing.values())
+
+        inverse_types = {}
+        symmetric_rows = OrderedDict()
+        for edge in deleted:
+            if edge.type_id not in inverse_types:
+                inverse_types[edge.type_id] = self._inverse_type(edge.type)
+            symmetric_type = inverse_types[edge.type_id]
+            if symmetric_type is not None:
+                row = (edge.toNode, edge.fromNode, symmetric_type, edge.site, None, True)
+                symmetric_rows[self._bulk_identity(row)] = row
+        for identity, edge in self._bulk_lookup(symmetric_rows).items():
+            if identity not in existing:
+                deleted.append(edge)
+
+        # raw batched deletion: consistency enforcers are replaced by the grouped fix-ups below
+        DeleteQuery(Edge).delete_batch([edge.pk for edge in deleted], Edge.objects.db)
+
+        deltas = defaultdict(int)
+        for edge in deleted:
+            deltas[(edge.fromNode_type_id, u'%s' % edge.fromNode_pk, edge.type_id, edge.site_id)] -= 1
+        self._bulk_adjust_counts(deltas)
+        self._bulk_cache_delete(deleted)
+
+        for edge in deleted:
+            signals.edge_deleted.send(sender=edge.type, instance=edge)
+        return len(deleted)
 
     # Private Methods #
 
+    @staticmethod
+    def _inverse_type(etype):
+        from .models import EdgeTypeAssociation
+        try:
+            return EdgeTypeAssociation.objects.get_for_direct_edge_type(etype).inverse
+        except EdgeTypeAssociation.DoesNotExist:
+            return None
+
+    @staticmethod
+    def _bulk_identity(row):
+        from_node, to_node, etype, site = row[:4]
+        return (
+            ContentType.objects.get_for_model(from_node).pk, u'%s' % from_node.pk,
+            ContentType.objects.get_for_model(to_node).pk, u'%s' % to_node.pk,
+            etype.pk, site.pk
+        )
+
+    def _bulk_rows(self, edges):
+        """
+        Normalizes bulk input into (from_node, to_node, etype, site, attributes, auto) rows, keyed by edge identity.
+        Repeated edges are collapsed, the last occurrence wins.
+        """
+        current_site = None
+        rows = OrderedDict()
+        for edge in edges:
+            from_node, to_node, etype = edge[:3]
+            site = edge[3] if len(edge) > 3 else None
+            attributes = edge[4] if len(edge) > 4 else "{}"
+            if site is None:
+                if current_site is None:
+                    current_site = Site.objects.get_current()
+                site = current_site
+            row = (from_node, to_node, etype, site, attributes, False)
+            rows[self._bulk_identity(row)] = row
+        return rows
+
+    @staticmethod
+    def _bulk_lookup(rows):
+        """
+        Returns the already existing edges among rows, keyed by edge identity.
+        """
+        from .models import Edge
+
+        existing = {}
+        for chunk in chunks(rows.keys(), BULK_CHUNK_SIZE // 2):
+            groups = defaultdict(list)
+            for identity in chunk:
+                ctype1, pk1, ctype2, pk2, etype, site = identity
+                groups[(ctype1, ctype2, etype, site)].append(identity)
+            for (ctype1, ctype2, etype, site), identities in groups.items():
+                edges = Edge.objects.filter(
+                    fromNode_type_id=ctype1,
+                    fromNode_pk__in=set(identity[1] for identity in identities),
+                    toNode_type_id=ctype2,
+                    toNode_pk__in=set(identity[3] for identity in identities),
+                    type_id=etype,
+                    site_id=site
+                ).order_by()
+                for edge in edges:
+                    identity = (ctype1, edge.fromNode_pk, ctype2, edge.toNode_pk, etype, site)
+                    if identity in rows:
+                        from_node, to_node, etype_obj, site_obj = rows[identity][:4]
+                        edge.fromNode, edge.toNode, edge.type, edge.site = from_node, to_node, etype_obj, site_obj
+                        existing[identity] = edge
+        return existing
+
+    def _bulk_upsert(self, rows, keep_existing=False, keep_time=False):
+        """
+        Creates the edges in rows that don't exist yet, with bulk inserts, and updates the attributes (and time, unless
+        keep_time is set) of the existing ones (unless keep_existing is set), with one update per distinct attributes
+        value.
+        Returns the (created, updated) edge lists.
+        """
+        from django.utils import timezone
+        from .models import Edge
+
+        existing = self._bulk_lookup(rows)
+        created = []
+        updated = []
+        for identity, (from_node, to_node, etype, site, attributes, auto) in rows.items():
+            edge = existing.get(identity)
+            if edge is None:
+                edge = Edge(type=etype, site=site, attributes=attributes, auto=auto)
+                edge.fromNode = from_node
+                edge.toNode = to_node
+                created.append(edge)
+            elif not keep_existing:
+                edge.attributes = attributes
+                updated.append(edge)
+
+        Edge.objects.bulk_create(created, batch_size=BULK_CHUNK_SIZE)
+
+        now = timezone.now()
+        by_attributes = defaultdict(list)
+        for edge in updated:
+            if not keep_time:
+                edge.time = now
+            by_attributes[json.dumps(edge.attributes, sort_keys=True)].append(edge.pk)
+        for attributes, pks in by_attributes.items():
+            for chunk in chunks(pks):
+                values = {'attributes': json.loads(attributes)}
+                if not keep_time:
+                    values['time'] = now
+                Edge.objects.filter(pk__in=chunk).update(**values)
+        return created, updated
+
+    @staticmethod
+    def _bulk_adjust_counts(deltas):
+        """
+        Applies the EdgeCount adjustments with one query finding the counters of each chunk of (node, etype, site),
+        and one grouped UPDATE (a CASE over the counter ids) adjusting them all. Missing counters are created.
+        :param deltas: dict {(ctype_id, pk, etype_id, site_id): delta}
+        """
+        from django.db import connections, router
+        from .models import EdgeCount
+
+        db = router.db_for_write(EdgeCount)
+        qn = connections[db].ops.quote_name
+        count_column, pk_column = qn(EdgeCount._meta.get_field('count').column), qn(EdgeCount._meta.pk.column)
+        missing = []
+        for chunk in chunks((identity, delta) for identity, delta in deltas.items() if delta):
+            chunk = dict(
+                ((int(ctype_id), u'%s' % pk, int(etype_id), int(site_id)), delta)
+                for (ctype_id, pk, etype_id, site_id), delta in chunk
+            )
+            counters = EdgeCount.objects.using(db).filter(reduce(or_, [
+                Q(fromNode_type_id=ctype_id, fromNode_pk=pk, type_id=etype_id, site_id=site_id)
+                for ctype_id, pk, etype_id, site_id in chunk
+            ])).values_list('pk', 'fromNode_type_id', 'fromNode_pk', 'type_id', 'site_id')
+            adjustments, found = [], set()
+            for counter_pk, ctype_id, pk, etype_id, site_id in counters:
+                identity = (ctype_id, u'%s' % pk, etype_id, site_id)
+                adjustments.append((counter_pk, chunk[identity]))
+                found.add(identity)
+            if adjustments:
+                cases = ' '.join(['WHEN %s THEN %s'] * len(adjustments))
+                ids = ', '.join(['%s'] * len(adjustments))
+                connections[db].cursor().execute(
+                    'UPDATE %s SET %s = %s + CASE %s %s END WHERE %s IN (%s)' % (
+                        qn(EdgeCount._meta.db_table), count_column, count_column, pk_column, cases, pk_column, ids
+                    ),
+                    [param for adjustment in adjustments for param in adjustment] +
+                    [counter_pk for counter_pk, delta in adjustments]
+                )
+            for (ctype_id, pk, etype_id, site_id), delta in chunk.items():
+                if (ctype_id, pk, etype_id, site_id) not in found and delta > 0:
+                    missing.append(
+                        EdgeCount(fromNode_type_id=ctype_id, fromNode_pk=pk, type_id=etype_id, site_id=site_id,
+                                  count=delta)
+                    )
+        EdgeCount.objects.using(db).bulk_create(missing, batch_size=BULK_CHUNK_SIZE)
+
+    def _execute_chunked(self, commands):
+        """
+        Runs (method_name, args, kwargs) cache commands through pipelines of at most BULK_CHUNK_SIZE commands.
+        """
+        for chunk in chunks(commands):
+            transaction = self.cache.pipeline()
+            for method_name, args, kwargs in chunk:
+                getattr(transaction, method_name)(*args, **kwargs)
+            transaction.execute()
+
+    def _bulk_cache_write(self, created, updated):
+        """
+        Applies the same cache maintenance as edge() to every created or updated edge, through chunked pipelines.
+        """
+        commands = []
+        for edge in created:
+            count_key = self._count_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            list_key = self._list_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            kwargs = self._in_list_change(edge, 1, dict(counters={count_key: 1}, **self._list_add(list_key, edge)))
+            kwargs.update(self._update_graph_timeouts())
+            commands.append(('update_graph', (self._edge_key_for(edge), edge), kwargs))
+        for edge in updated:
+            list_key = self._list_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            kwargs = self._in_list_change(edge, 0, self._list_update(list_key, edge))
+            kwargs.update(self._update_graph_timeouts())
+            commands.append(('update_graph', (self._edge_key_for(edge), edge), kwargs))
+        self._execute_chunked(commands)
+        self._invalidate_local(self._local_keys(created + updated))
+
+    def _bulk_cache_delete(self, deleted):
+        """
+        Applies the same cache maintenance as no_edge() to every deleted edge, through chunked pipelines.
+        """
+        commands = []
+        for edge in deleted:
+            count_key = self._count_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            list_key = self._list_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            kwargs = self._list_removal(list_key, edge)
+            kwargs['counters'] = {count_key: -1}
+            kwargs = self._in_list_change(edge, -1, kwargs)
+            kwargs.update(self._update_graph_timeouts())
+            kwargs.update(self._no_edge())
+            commands.append(('update_graph', (self._edge_key_for(edge),), kwargs))
+        self._execute_chunked(commands)
+        self._invalidate_local(self._local_keys(deleted))
+
+    def _local_keys(self, edges):
+        """
+        Returns the keys cached in process that the creation, update or deletion of edges changes.
+        """
+        keys = set()
+        for edge in edges:
+            keys.update([
+                self._edge_key_for(edge),
+                self._count_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id),
+                self._list_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            ])
+        return keys
+
+    # Edge Lists #
+
+    @staticmethod
+    def _edges_from_db(from_node, ctype, etype, site, nodes=None, limit=None):
+        """
+        Returns the (from_node, etype, site) edges stored in the database, most recent first (only the limit most
+        recent ones if limit is given). Their nodes are loaded with one query per content type when required (non
+        compact edge lists hold them), instead of one query per edge and node.
+        """
+        from .models import Edge
+
+        edges = Edge.objects.filter(fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site)
+        if limit is not None:
+            edges = edges[:limit]
+        if nodes is None:
+            nodes = not COMPACT_EDGE_LISTS
+        if not nodes:
+            return edges
+        return prefetch_nodes(edges, known=(from_node,))
+
+    def _rebuild_list(self, from_node, ctype, etype, site, list_key, size=None):
+        """
+        Caches the (from_node, etype, site) edge list, and its edges, from the database: the whole list, or its size
+        most recent edges (recording whether they are all of them in the edge list state key).
+        Returns whether the list got cached (see _replace_list()).
+        """
+        return self._replace_list(
+            list_key, self._list_state_key(ctype.pk, from_node.pk, etype.pk, site.pk),
+            lambda: self._edges_from_db(from_node, ctype, etype, site, limit=size), self._list_member, size
+        )
+
+    @staticmethod
+    def _in_edges_from_db(to_node, ctype, etype, site, limit=None):
+        """
+        Returns the incoming (to_node, etype, site) edges stored in the database, most recent first (only the limit
+        most recent ones if limit is given), read from the (toNode, type, site, time) index.
+        """
+        from .models import Edge
+
+        edges = Edge.objects.filter(
+            toNode_pk=to_node.pk, toNode_type=ctype, type=etype, site=site
+        ).order_by('-time')
+        if limit is not None:
+            edges = edges[:limit]
+        return edges
+
+    def _rebuild_in_list(self, to_node, ctype, etype, site, list_key, size=None):
+        """
+        Caches the incoming (to_node, etype, site) edge list and its edges from the database, the way _rebuild_list()
+        does, and the in-degree of to_node when the whole list is read.
+        """
+        return self._replace_list(
+            list_key, self._in_list_state_key(ctype.pk, to_node.pk, etype.pk, site.pk),
+            lambda: self._in_edges_from_db(to_node, ctype, etype, site, limit=size), self._in_list_member, size,
+            count_key=self._in_count_key(ctype.pk, to_node.pk, etype.pk, site.pk)
+        )
+
+    def _replace_list(self, list_key, state_key, load_edges, member, size=None, count_key=None):
+        """
+        Replaces the cached edge list list_key with the edges returned by load_edges() (its size most recent ones, or
+        all of them if size is None), as member(edge) members, and caches the edges.
+        The list is replaced, not added to: a smaller cached window may hold members that no longer match the edges.
+        It is only replaced if no write patched it while the edges were read (they would miss the write): the edges
+        are read again then, up to REBUILD_ATTEMPTS times, before dropping the list (to be rebuilt on the next read).
+        Returns whether the list got cached.
+        :param count_key: where to cache the number of edges, when they are all of them
+        """
+        edges = []
+
+        def load():
+            edges[:] = load_edges()
+            return [(member(edge), time_to_score(edge.time)) for edge in edges]
+
+        if EDGE_LIST_WINDOW:
+            self.cache.delete(state_key)  # the window is TRUNCATED until its state is known
+        for attempt in range(REBUILD_ATTEMPTS):
+            if self.cache.replace_sorted_set(list_key, load, self._timeout('list')):
+                break
+        else:
+            self.cache.delete(list_key)
+            return False
+        complete = size is None or len(edges) < size
+        transaction = self.cache.pipeline()
+        for edge in edges:
+            transaction.set(self._edge_key_for(edge), edge, self._timeout('edge'))
+        if EDGE_LIST_WINDOW:
+            transaction.set(state_key, COMPLETE if complete else TRUNCATED, self._timeout('list'))
+        if count_key is not None and complete:
+            transaction.set(count_key, len(edges), self._timeout('count'))
+        transaction.execute()
+        return True
+
+    def _list_miss(self, list_key, edges, page_size, state_key):
+        """
+        Tells whether edges, a page read from the cached edge list list_key, is all there is: returns None if so, or
+        else whether the list must be rebuilt (REBUILD) or only its cached window falls short of the page (TRUNCATED).
+        :param page_size: items requested, None if unknown
+        :param state_key: the edge list state key of list_key
+        """
+        if not EDGE_LIST_WINDOW:
+            return REBUILD if len(edges) == 0 else None
+        if page_size is not None and len(edges) >= page_size:
+            return None  # cached windows are the most recent edges of the lists, so a full page is all there is
+        state = self.cache.get(state_key)
+        if state == COMPLETE:
+            return REBUILD if len(edges) == 0 and list_key not in self.cache else None
+        if len(edges) == 0 and list_key not in self.cache:
+            return REBUILD
+        return TRUNCATED
+
+    def _read_or_rebuild(self, list_key, read, from_db, node, ctype, etype, site, page_size=None, depth=None,
+                         incoming=False):
+        """
+        Returns read() (a page of the cached edge list list_key), rebuilding the list first if it is missing.
+        Rebuilds are single-flight: while a process holds the rebuild lock of the list, the others wait for it (for up
+        to REBUILD_WAIT seconds), and then read the rebuilt list, or get their page from the database with from_db().
+        With EDGE_LIST_WINDOW, only the most recent edges are cached: depth is the number of them the page needs
+        (None for the whole list, or 0 when unknown, so pages past the cached window are read from the database).
+        :param incoming: whether the list is the incoming edge list of node (else its edge list)
+        """
+        if incoming:
+            state_key, rebuild = self._in_list_state_key(ctype.pk, node.pk, etype.pk, site.pk), self._rebuild_in_list
+        else:
+            state_key, rebuild = self._list_state_key(ctype.pk, node.pk, etype.pk, site.pk), self._rebuild_list
+
+        def missing(page):
+            return self._list_miss(list_key, page, page_size, state_key)
+
+        edges = read()
+        miss = missing(edges)
+        if miss is None:
+            return edges
+        if miss == TRUNCATED and depth == 0:
+            return from_db()
+        lock_key = REBUILD_LOCK_KEY_FORMAT % {'key': list_key}
+        token = self.cache.acquire_lock(lock_key, REBUILD_LOCK_TIMEOUT)
+        if token is None:
+            if self.cache.wait_for_lock(lock_key, REBUILD_WAIT):
+                edges = read()
+                if missing(edges) is None:
+                    self.rebuild_stats['coalesced'] += 1
+                    return edges
+            self.rebuild_stats['db_fallbacks'] += 1
+            return from_db()
+        try:
+            edges = read()  # rebuilt by another process before the lock was taken
+            if missing(edges) is None:
+                self.rebuild_stats['coalesced'] += 1
+                return edges
+            rebuilt = rebuild(node, ctype, etype, site, list_key, self._window_size(depth))
+        finally:
+            self.cache.release_lock(lock_key, token)
+        if not rebuilt:  # kept changing while rebuilt
+            self.rebuild_stats['db_fallbacks'] += 1
+            return from_db()
+        self.rebuild_stats['rebuilds'] += 1
+        edges = read()
+        if depth == 0 and missing(edges) == TRUNCATED:
+            return from_db()
+        return edges
+
+    @staticmethod
+    def _window_size(depth):
+        """
+        Returns the number of most recent edges to cache so that depth of them are, None for the whole list.
+        """
+        if not EDGE_LIST_WINDOW or depth is None:
+            return None
+        return max(int(ceil(float(depth) / EDGE_LIST_WINDOW)), 1) * EDGE_LIST_WINDOW
+
+    def _list_from_edges(self, from_node, edges, prefetched=False):
+        """
+        Returns edges (a database page of an edge list) the way cached edge list pages are returned.
+        :param prefetched: whether the nodes of edges are already loaded
+        """
+        edges = list(edges)
+        if COMPACT_EDGE_LISTS:
+            attributes = dict(((edge.toNode_type_id, u'%s' % edge.toNode_pk), edge.attributes) for edge in edges)
+            return EdgeList(
+                [(encode_member(edge.toNode_type_id, edge.toNode_pk), time_to_score(edge.time)) for edge in edges],
+                attributes_loader=lambda items: [attributes.get(item.key) for item in items]
+            )
+        if not prefetched:
+            prefetch_nodes(edges, known=(from_node,))
+        return [(edge.toNode, edge.attributes, edge.time) for edge in edges]
+
+    def _list_member(self, edge):
+        """
+        Returns the (raw) member that represents edge in a cached edge list.
+        """
+        if COMPACT_EDGE_LISTS:
+            return encode_member(edge.toNode_type_id, edge.toNode_pk)
+        return self.cache.prep_value((edge.toNode, edge.attributes, edge.time))
+
+    @staticmethod
+    def _in_list_member(edge):
+        """
+        Returns the member that represents edge in a cached incoming edge list (always compact: its from node).
+        """
+        return encode_member(edge.fromNode_type_id, edge.fromNode_pk)
+
+    def _list_add(self, list_key, edge):
+        """
+        Returns the update_graph() arguments that add edge to the cached list list_key (if cached), refreshing the
+        expiration of its window state along with the list's.
+        """
+        kwargs = {'sorted_set_adds': [(list_key, self._list_member(edge), time_to_score(edge.time))]}
+        if EDGE_LIST_WINDOW:
+            kwargs['touch'] = [
+                self._list_state_key(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)
+            ]
+        return kwargs
+
+    def _list_update(self, list_key, edge):
+        """
+        Returns the update_graph() arguments that refresh edge in the cached list list_key (if cached).
+        Compact members are found by node identity, so they are just re-scored (the attributes are read from the edge
+        key); non compact members embed the old edge data, so the whole list gets invalidated.
+        """
+        if COMPACT_EDGE_LISTS:
+            return self._list_add(list_key, edge)
+        return {'invalidate': [list_key]}
+
+    def _list_removal(self, list_key, edge):
+        """
+        Returns the update_graph() arguments that remove edge from the cached list list_key.
+        """
+        if COMPACT_EDGE_LISTS:
+            return {'sorted_set_rems': [(list_key, self._list_member(edge))]}
+        return {'invalidate': [list_key]}
+
+    def _in_list_change(self, edge, delta, kwargs):
+        """
+        Adds to the update_graph() arguments kwargs the maintenance of the in-degree counter and cached incoming edge
+        list of the to node of edge: delta is 1 for a created edge, -1 for a deleted one and 0 for an updated one.
+        """
+        ctype, pk, etype, site = edge.toNode_type_id, edge.toNode_pk, edge.type_id, edge.site_id
+        list_key = self._in_list_key(ctype, pk, etype, site)
+        member = self._in_list_member(edge)
+        if delta:
+            kwargs.setdefault('counters', {})[self._in_count_key(ctype, pk, etype, site)] = delta
+        if delta < 0:
+            kwargs.setdefault('sorted_set_rems', []).append((list_key, member))
+        else:
+            kwargs.setdefault('sorted_set_adds', []).append((list_key, member, time_to_score(edge.time)))
+            if EDGE_LIST_WINDOW:
+                kwargs.setdefault('touch', []).append(self._in_list_state_key(ctype, pk, etype, site))
+        return kwargs
+
+    @staticmethod
+    def _list_node_keys(edge_list):
+        """
+        Returns the (ctype_id, pk) references of the nodes in a cached edge list, in any members format.
+        """
+        if isinstance(edge_list, EdgeList):
+            return edge_list.keys()
+        return [(ContentType.objects.get_for_model(node).pk, node.pk) for node, attributes, time in edge_list]
+
+    def _touch_list_states(self, lists, incoming=False):
+        """
+        Refreshes the expiration of the window states of the cached edge lists read, lists being their
+        (ctype, pk, etype, site) references, so that the states don't expire before the lists.
+        :param incoming: whether the lists are incoming edge lists
+        """
+        touch = self._touch('list')
+        state_key = self._in_list_state_key if incoming else self._list_state_key
+        if EDGE_LIST_WINDOW and touch and lists:
+            self.cache.touch_many([state_key(*key) for key in lists], touch)
+
+    def _read_list(self, list_key, pos, limit, ctype, pk, etype, site):
+        self._touch_list_states([(ctype, pk, etype, site)])
+        if not COMPACT_EDGE_LISTS:
+            return self.cache.sorted_set_rev_range(list_key, pos, limit, touch=self._touch('list'))
+        return EdgeList(
+            self.cache.sorted_set_rev_range_with_scores(list_key, pos, limit, touch=self._touch('list')),
+            attributes_loader=self._attributes_loader(ctype, pk, etype, site)
+        )
+
+    def _read_list_by_score(self, list_key, low, high, limit, ctype, pk, etype, site):
+        self._touch_list_states([(ctype, pk, etype, site)])
+        if not COMPACT_EDGE_LISTS:
+            return self.cache.sorted_set_rev_range_by_score(list_key, low, high, 0, limit, touch=self._touch('list'))
+        return EdgeList(
+            self.cache.sorted_set_rev_range_by_score_with_scores(
+                list_key, low, high, 0, limit, touch=self._touch('list')
+            ),
+            attributes_loader=self._attributes_loader(ctype, pk, etype, site)
+        )
+
+    def _attributes_loader(self, ctype, pk, etype, site, incoming=False):
+        """
+        Returns the attributes loader of a compact edge list: attributes are read from the cached edges, falling back
+        to the database (one query per node content type) for the ones not cached.
+        :param incoming: whether the list is the incoming edge list of (ctype, pk), its items being the from nodes
+        """
+        node, other = ('toNode', 'fromNode') if incoming else ('fromNode', 'toNode')
+
+        def load(items):
+            from .models import Edge
+
+            if incoming:
+                keys = [self._edge_key(item.ctype_id, item.pk, etype, ctype, pk, site) for item in items]
+            else:
+                keys = [self._edge_key(ctype, pk, etype, item.ctype_id, item.pk, site) for item in items]
+            cached = self.cache.get_many(keys)
+            attributes = {}
+            missing = defaultdict(list)
+            for key, item in zip(keys, items):
+                edge = cached.get(key)
+                if edge is not None and edge != NO_EDGE:
+                    attributes[item.key] = edge.attributes
+                else:
+                    missing[item.ctype_id].append(item.pk)
+            found = {}
+            for ctype2, pks in missing.items():
+                edges = Edge.objects.filter(**{
+                    node + '_type_id': ctype, node + '_pk': pk, 'type_id': etype, 'site_id': site,
+                    other + '_type_id': ctype2, other + '_pk__in': pks
+                })
+                for edge in edges:
+                    attributes[(ctype2, getattr(edge, other + '_pk'))] = edge.attributes
+                    found[self._edge_key_for(edge)] = edge
+            if found:
+                self.cache.set_many(found, self._timeout('edge'))
+            return [attributes.get(item.key) for item in items]
+        return load
+
+    # Cache Timeouts #
+
+    @staticmethod
+    def _timeout(family):
+        return CACHE_TIMEOUTS.get(family, DEFAULT_TIMEOUT)
+
+    def _touch(self, family):
+        """
+        Returns the expiration to refresh the keys of family to when read, None if they don't expire.
+        """
+        timeout = self.cache.get_timeout(self._timeout(family))
+        return timeout if timeout is not None and timeout > 0 else None
+
+    def _caches_misses(self):
+        return self.cache.get_timeout(self._timeout('no_edge')) != 0
+
+    def _no_edge(self):
+        """
+        Returns the update_graph() arguments that leave the edge key of a deleted edge: a NO_EDGE entry, unless
+        negative caching is off.
+        """
+        if self._caches_misses():
+            return {'edge': NO_EDGE, 'timeout': self._timeout('no_edge')}
+        return {'edge': None}
+
+    def _update_graph_timeouts(self):
+        return {
+            'timeout': self._timeout('edge'),
+            'counters_timeout': self._timeout('count'),
+            'sorted_sets_timeout': self._timeout('list')
+        }
+
+    # In-process Cache #
+
+    def _local(self):
+        """
+        Returns the in-process cache (see LOCAL_CACHE), None if off.
+        """
+        if not LOCAL_CACHE:
+            return None
+        local = Graph._local_caches.get(self.cache_alias)
+        if local is None:
+            with Graph._local_caches_lock:
+                local = Graph._local_caches.get(self.cache_alias)
+                if local is None:
+                    local = Graph._local_caches[self.cache_alias] = LocalCache(self.cache, **LOCAL_CACHE)
+        return local
+
+    @classmethod
+    def stop_local_caches(cls):
+        """
+        Stops the in-process caches of this process (and their invalidations listeners), new ones being started on
+        demand.
+        """
+        with cls._local_caches_lock:
+            local_caches = list(cls._local_caches.values())
+            cls._local_caches.clear()
+        for local in local_caches:
+            local.stop()
+
+    def _locally(self, key, family, load, fits=None):
+        """
+        Returns load() (the value of key, read from the graph cache or the database) through the in-process cache.
+        """
+        local = self._local()
+        if local is None:
+            return load()
+        value = local.get(key, family, fits)
+        if value is MISSING:
+            generation = local.generation
+            value = load()
+            local.set(key, value, generation)
+        return value
+
+    def _invalidate_local(self, keys):
+        """
+        Drops keys from the in-process cache of every process, once they have been changed in the graph cache.
+        """
+        local = self._local()
+        if local is not None:
+            local.invalidate(keys)
+
+    # Cache Keys #
+
+    @staticmethod
+    def _edge_key(ctype1, pk1, etype, ctype2, pk2, site):
+        return EDGE_KEY_FORMAT % {
+            'ctype1': ctype1,
+            'pk1': pk1,
+            'etype': etype,
+            'ctype2': ctype2,
+            'pk2': pk2,
+            'site': site
+        }
+
+    def _edge_key_for(self, edge):
+        return self._edge_key(
+            edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.toNode_type_id, edge.toNode_pk, edge.site_id
+        )
+
+    @staticmethod
+    def _count_key(ctype, pk, etype, site):
+        return COUNT_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
+    @staticmethod
+    def _list_key(ctype, pk, etype, site):
+        return EDGE_LIST_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
+    @staticmethod
+    def _list_state_key(ctype, pk, etype, site):
+        return EDGE_LIST_STATE_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
+    @staticmethod
+    def _in_count_key(ctype, pk, etype, site):
+        return IN_COUNT_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
+    @staticmethod
+    def _in_list_key(ctype, pk, etype, site):
+        return IN_EDGE_LIST_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
+    @staticmethod
+    def _in_list_state_key(ctype, pk, etype, site):
+        return IN_EDGE_LIST_STATE_KEY_FORMAT % {'ctype': ctype, 'pk': pk, 'etype': etype, 'site': site}
+
     @atomic   # TODO make _add accepts content_type_id and pk instead of from_node and to_node
     def _add(self, from_node, to_node, etype, site, attributes="{}", auto=False):
         from .models import Edge
@@ -128,52 +1001,25 @@ class Graph(object):
             attributes=attributes,
             auto=auto
         )
+        prefetch_nodes([edge], known=(from_node, to_node))
 
         # write to cache, find all cached values that this new edge impacts on, and update them
         ctype1 = ContentType.objects.get_for_model(from_node)
         ctype2 = ContentType.objects.get_for_model(to_node)
-        edge_key = (
-            EDGE_KEY_FORMAT % {
-                'ctype1': ctype1.pk,
-                'pk1': from_node.pk,
-                'etype': etype.pk,
-                'ctype2': ctype2.pk,
-                'pk2': to_node.pk,
-                'site': site.pk
-            }
-        )
-        count_key = (
-            COUNT_KEY_FORMAT % {
-                'ctype': ctype1.pk,
-                'pk': from_node.pk,
-                'etype': etype.pk,
-                'site': site.pk
-            }
-        )
-        list_key = (
-            EDGE_LIST_KEY_FORMAT % {
-                'ctype': ctype1.pk,
-                'pk': from_node.pk,
-                'etype': etype.pk,
-                'site': site.pk
-            }
-        )
-
-        transaction = self.cache.pipeline()
-        transaction.set(edge_key, edge)
+        edge_key = self._edge_key(ctype1.pk, from_node.pk, etype.pk, ctype2.pk, to_node.pk, site.pk)
+        count_key = self._count_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
+        list_key = self._list_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
 
-        if count_key in self.cache:
-            transaction.incr(count_key)
-        if list_key in self.cache:
-            edge_rep = (edge.toNode, edge.attributes, edge.time)
-            transaction.add_to_sorted_set(list_key, edge_rep, mktime(edge.time.timetuple()))
-
-        transaction.execute()
+        kwargs = self._in_list_change(edge, 1, dict(counters={count_key: 1}, **self._list_add(list_key, edge)))
+        kwargs.update(self._update_graph_timeouts())
+        self.cache.update_graph(edge_key, edge, **kwargs)
+        self._invalidate_local([edge_key, count_key, list_key])
         signals.edge_created.send(sender=etype, instance=edge)
         return edge
 
     @atomic   # TODO make _update accepts content_type_id and pk instead of from_node and to_node
-    def _update(self, from_node, to_node, etype, site, attributes="{}"):
+    def _update(self, from_node, to_node, etype, site, attributes="{}", keep_time=False):
+        from django.utils import timezone
         from social_graph import signals
         from .models import Edge
 
@@ -188,43 +1034,22 @@ class Graph(object):
             type=etype,
             site=site
         )
-        edge.delete()
-
-        new_edge = Edge.objects.create(
-            fromNode=from_node,
-            toNode=to_node,
-            type=etype,
-            attributes=attributes,
-            site=site
-        )
+        # update in place: counters and symmetric edges are left alone
+        new_edge = edge
+        new_edge.attributes = attributes
+        if not keep_time:
+            new_edge.time = timezone.now()
+        Edge.objects.filter(pk=new_edge.pk).update(attributes=new_edge.attributes, time=new_edge.time)
+        prefetch_nodes([new_edge], known=(from_node, to_node))
 
         # find all cached values that this edge impacts on, and update them
-        edge_key = (
-            EDGE_KEY_FORMAT % {
-                'ctype1': ctype1.pk,
-                'pk1': from_node.pk,
-                'etype': etype.pk,
-                'ctype2': ctype2.pk,
-                'pk2': to_node.pk,
-                'site': site.pk
-            }
-        )
-        list_key = (
-            EDGE_LIST_KEY_FORMAT % {
-                'ctype': ctype1.pk,
-                'pk': from_node.pk,
-                'etype': etype.pk,
-                'site': site.pk
-            }
-        )
-
-        list_cached = list_key in self.cache
+        edge_key = self._edge_key(ctype1.pk, from_node.pk, etype.pk, ctype2.pk, to_node.pk, site.pk)
+        list_key = self._list_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
 
-        transaction = self.cache.pipeline()
-        transaction.set(edge_key, new_edge)
-        if list_cached:
-            transaction.delete(list_key)  # invalidate the hole list
-        transaction.execute()
+        kwargs = self._in_list_change(new_edge, 0, self._list_update(list_key, new_edge))
+        kwargs.update(self._update_graph_timeouts())
+        self.cache.update_graph(edge_key, new_edge, **kwargs)
+        self._invalidate_local([edge_key, list_key])
 
         signals.edge_updated.send(sender=etype, instance=new_edge)
         return new_edge
@@ -236,32 +1061,9 @@ class Graph(object):
 
         ctype1 = ContentType.objects.get_for_model(from_node)
         ctype2 = ContentType.objects.get_for_model(to_node)
-        edge_key = (
-            EDGE_KEY_FORMAT % {
-                'ctype1': ctype1.pk,
-                'pk1': from_node.pk,
-                'etype': etype.pk,
-                'ctype2': ctype2.pk,
-                'pk2': to_node.pk,
-                'site': site.pk
-            }
-        )
-        count_key = (
-            COUNT_KEY_FORMAT % {
-                'ctype': ctype1.pk,
-                'pk': from_node.pk,
-                'etype': etype.pk,
-                'site': site.pk
-            }
-        )
-        list_key = (
-            EDGE_LIST_KEY_FORMAT % {
-                'ctype': ctype1.pk,
-                'pk': from_node.pk,
-                'etype': etype.pk,
-                'site': site.pk
-            }
-        )
+        edge_key = self._edge_key(ctype1.pk, from_node.pk, etype.pk, ctype2.pk, to_node.pk, site.pk)
+        count_key = self._count_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
+        list_key = self._list_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
         try:
             edge = Edge.objects.get(
                 fromNode_pk=from_node.pk,
@@ -274,16 +1076,13 @@ class Graph(object):
             edge.delete()
 
             # delete from cache: update all cached values that this edge impacts on
-            count_cached = count_key in self.cache
-            list_cached = list_key in self.cache
-
-            transaction = self.cache.pipeline()
-            transaction.delete(edge_key)
-            if count_cached:
-                transaction.decr(count_key)
-            if list_cached:
-                transaction.delete(list_key)  # invalidate the hole list
-            transaction.execute()
+            kwargs = self._list_removal(list_key, edge)
+            kwargs['counters'] = {count_key: -1}
+            kwargs = self._in_list_change(edge, -1, kwargs)
+            kwargs.update(self._update_graph_timeouts())
+            kwargs.update(self._no_edge())
+            self.cache.update_graph(edge_key, **kwargs)
+            self._invalidate_local([edge_key, count_key, list_key])
             signals.edge_deleted.send(sender=etype, instance=edge)
             return True
         except Edge.DoesNotExist:
@@ -295,41 +1094,88 @@ class Graph(object):
 
         ctype1 = ContentType.objects.get_for_model(from_node)
         edges = Edge.objects.filter(fromNode_pk=from_node.pk, fromNode_type=ctype1, type=etype)
+        deleted = list(edges)
         edges.delete()
+        self._execute_chunked([
+            ('update_graph', (None, None), self._in_list_change(edge, -1, self._update_graph_timeouts()))
+            for edge in deleted
+        ])
+        local_keys = self._local_keys(deleted)
         # delete from cache: find all cached values that this edges impacts on, and delete them
         for site in Site.objects.all():
-            count_key = (COUNT_KEY_FORMAT
-                         % {'ctype': ctype1.pk,
-                            'pk': from_node.pk,
-                            'etype': etype.pk,
-                            'site': site.pk})
-            list_key = (EDGE_LIST_KEY_FORMAT
-                        % {'ctype': ctype1.pk,
-                           'pk': from_node.pk,
-                           'etype': etype.pk,
-                           'site': site.pk})
+            count_key = self._count_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
+            list_key = self._list_key(ctype1.pk, from_node.pk, etype.pk, site.pk)
 
             if list_key in self.cache:
                 count = self.edge_count(from_node, etype, site)
-                edge_list = self.cache.sorted_set_rev_range(list_key, 0, count)
+                edge_list = self._read_list(list_key, 0, count, ctype1.pk, from_node.pk, etype.pk, site.pk)
                 transaction = self.cache.pipeline()
-                for node, attributes, time in edge_list:
-                    ctype2 = ContentType.objects.get_for_model(node)
-                    edge_key = (EDGE_KEY_FORMAT
-                                % {'ctype1': ctype1.pk,
-                                   'pk1': from_node.pk,
-                                   'etype': etype.pk,
-                                   'ctype2': ctype2.pk,
-                                   'pk2': node.pk,
-                                   'site': site.pk})
+                for ctype2_id, pk2 in self._list_node_keys(edge_list):
+                    edge_key = self._edge_key(ctype1.pk, from_node.pk, etype.pk, ctype2_id, pk2, site.pk)
                     transaction.delete(edge_key)
                 transaction.delete(list_key)
+                transaction.delete(self._list_state_key(ctype1.pk, from_node.pk, etype.pk, site.pk))
                 transaction.delete(count_key)
                 transaction.execute()
             elif count_key in self.cache:
                 self.cache.delete(count_key)
+            local_keys.update([count_key, list_key])
+        self._invalidate_local(local_keys)
         return True
 
+    @atomic
+    def _delete_node(self, node):
+        """
+        Deletes every edge from or to node (a node about to be deleted), with one query, fixing the edge counters of
+        the other nodes with one update per (node, etype, site), and purging only the cache keys involved.
+        """
+        from django.db.models.sql.subqueries import DeleteQuery
+        from .models import Edge, EdgeCount
+
+        ctype = ContentType.objects.get_for_model(node)
+        pk = u'%s' % node.pk
+        edges = Edge.objects.filter(
+            Q(fromNode_type=ctype, fromNode_pk=pk) | Q(toNode_type=ctype, toNode_pk=pk)
+        ).order_by()
+        outgoing, incoming = [], []
+        for edge in edges:
+            if edge.fromNode_type_id == ctype.pk and edge.fromNode_pk == pk:
+                outgoing.append(edge)
+            else:
+                incoming.append(edge)
+        if not outgoing and not incoming:
+            return
+        DeleteQuery(Edge).delete_qs(edges, Edge.objects.db)
+
+        # the node counters go away with the node, the other nodes lose their edges to it
+        EdgeCount.objects.filter(fromNode_type=ctype, fromNode_pk=pk).delete()
+        deltas = defaultdict(int)
+        for edge in incoming:
+            deltas[(edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id)] -= 1
+        self._bulk_adjust_counts(deltas)
+
+        keys = set()
+        for edge in outgoing:
+            keys.update([
+                self._count_key(ctype.pk, pk, edge.type_id, edge.site_id),
+                self._list_key(ctype.pk, pk, edge.type_id, edge.site_id),
+                self._list_state_key(ctype.pk, pk, edge.type_id, edge.site_id),
+                self._edge_key_for(edge)
+            ])
+        for edge in incoming:
+            keys.update([
+                self._in_count_key(ctype.pk, pk, edge.type_id, edge.site_id),
+                self._in_list_key(ctype.pk, pk, edge.type_id, edge.site_id),
+                self._in_list_state_key(ctype.pk, pk, edge.type_id, edge.site_id)
+            ])
+        self.cache.delete_many(list(keys))
+        self._invalidate_local(self._local_keys(outgoing))
+        self._bulk_cache_delete(incoming)
+        self._execute_chunked([
+            ('update_graph', (None, None), self._in_list_change(edge, -1, self._update_graph_timeouts()))
+            for edge in outgoing
+        ])
+
     # Edges Reading #
 
     def edge_count(self, from_node, etype, site=None):
@@ -346,20 +1192,61 @@ class Graph(object):
         if site is None:
             site = Site.objects.get_current()
         ctype = ContentType.objects.get_for_model(from_node)
-        key = COUNT_KEY_FORMAT % {
-            'ctype': ctype.pk,
-            'pk': from_node.pk,
-            'etype': etype.pk,
-            'site': site.pk
-        }
-        count = self.cache.get(key)
-        if count is None:
-            try:
-                count = EdgeCount.objects.get(fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site).count
-            except EdgeCount.DoesNotExist:
-                count = 0
-            self.cache.set(key, int(count))
-        return count
+        key = self._count_key(ctype.pk, from_node.pk, etype.pk, site.pk)
+
+        def load():
+            count = self.cache.get_and_touch(key, self._touch('count'))
+            if count is None:
+                try:
+                    count = EdgeCount.objects.get(
+                        fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site
+                    ).count
+                except EdgeCount.DoesNotExist:
+                    count = 0
+                self.cache.set(key, int(count), self._timeout('count'))
+            return count
+        return self._locally(key, 'count', load)
+
+    def edge_counts_many(self, nodes, etypes, site=None):
+        """
+        Returns the number of edges of each type in etypes that originate at each node in nodes in site, with one
+        cache round trip, and one query for the counts not cached.
+        :param nodes:
+        :param etypes:
+        :param site:
+        :return: dict {(node, etype): int}
+        """
+        from .models import EdgeCount
+
+        if site is None:
+            site = Site.objects.get_current()
+        nodes, etypes = list(nodes), list(etypes)
+        ctypes = ContentType.objects.get_for_models(*set(type(node) for node in nodes))
+        keys = OrderedDict()
+        for node in nodes:
+            for etype in etypes:
+                keys[self._count_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk)] = (node, etype)
+        cached = self.cache.get_many(list(keys))
+        counts = dict((keys[key], count) for key, count in cached.items() if count is not None)
+
+        missing = [key for key in keys if cached.get(key) is None]
+        if missing:
+            pks = defaultdict(set)
+            for key in missing:
+                node, etype = keys[key]
+                pks[ctypes[type(node)].pk].add(u'%s' % node.pk)
+            found = {}
+            for edge_count in EdgeCount.objects.filter(
+                    reduce(or_, [Q(fromNode_type_id=ctype, fromNode_pk__in=list(ctype_pks))
+                                 for ctype, ctype_pks in pks.items()]),
+                    type__in=etypes, site=site
+            ).values_list('fromNode_type_id', 'fromNode_pk', 'type_id', 'count'):
+                found[self._count_key(*edge_count[:3] + (site.pk,))] = edge_count[3]
+            backfill = {}
+            for key in missing:
+                backfill[key] = counts[keys[key]] = int(found.get(key, 0))
+            self.cache.set_many(backfill, self._timeout('count'))
+        return counts
 
     def edge_range(self, from_node, etype, pos, limit, site=None):
 
@@ -377,41 +1264,300 @@ class Graph(object):
             site = Site.objects.get_current()
         ctype = ContentType.objects.get_for_model(from_node)
         # check if the count is already cached
-        count_key = (COUNT_KEY_FORMAT
-                     % {'ctype': ctype.pk,
-                        'pk': from_node.pk,
-                        'etype': etype.pk,
-                        'site': site.pk})
-        count = self.cache.get(count_key, None)
-        list_key = (EDGE_LIST_KEY_FORMAT
-                    % {'ctype': ctype.pk,
-                       'pk': from_node.pk,
-                       'etype': etype.pk,
-                       'site': site.pk})
+        count_key = self._count_key(ctype.pk, from_node.pk, etype.pk, site.pk)
+        count = self.cache.get_and_touch(count_key, self._touch('count'))
+        list_key = self._list_key(ctype.pk, from_node.pk, etype.pk, site.pk)
         if count != 0 or count is None:  # the edge list must be checked
-            edges = self.cache.sorted_set_rev_range(list_key, pos, limit)
-            if len(edges) != 0:
-                return edges
+            def read():
+                return self._read_list(list_key, pos, limit, ctype.pk, from_node.pk, etype.pk, site.pk)
+
+            def from_db():
+                edges = self._edges_from_db(from_node, ctype, etype, site, nodes=False)
+                if pos >= 0 and limit >= 0:
+                    edges = edges[pos:limit + 1]
+                else:  # negative indexes count from the end, the way Redis ranges do
+                    edges = list(edges)[pos:(limit + 1) or None]
+                return self._list_from_edges(from_node, edges)
+
+            if pos >= 0 and limit >= 0:
+                page_size, depth = max(limit + 1 - pos, 0), limit + 1
             else:
-                edge_list = Edge.objects.filter(fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site)
-                transaction = self.cache.pipeline()
-                for edge in edge_list:
-                    edge_key = (EDGE_KEY_FORMAT
-                                % {'ctype1': ctype.pk,
-                                   'pk1': from_node.pk,
-                                   'etype': etype.pk,
-                                   'ctype2': edge.toNode_type.pk,
-                                   'pk2': edge.toNode_pk,
-                                   'site': site.pk})
-                    edge_rep = (edge.toNode, edge.attributes, edge.time)
-                    transaction.add_to_sorted_set(list_key, edge_rep, mktime(edge.time.timetuple()))
-                    transaction.set(edge_key, edge)
-                transaction.execute()
-                return self.cache.sorted_set_rev_range(list_key, pos, limit)
+                page_size, depth = None, None
+            if pos != 0:
+                return self._read_or_rebuild(list_key, read, from_db, from_node, ctype, etype, site, page_size, depth)
+
+            # first pages are cached in process (for the last limit asked)
+            def load():
+                return limit, self._read_or_rebuild(
+                    list_key, read, from_db, from_node, ctype, etype, site, page_size, depth
+                )
+            return copy(self._locally(list_key, 'list', load, fits=lambda page: page[0] == limit)[1])
 
         else:  # if count is zero, the list is empty
             return []
 
+    def merged_edge_range(self, from_nodes, etype, limit, before=None, site=None):
+        """
+        Returns the limit most recent edges of type etype that originate at any of from_nodes in site (a timeline),
+        as (from_node, item) pairs, where item is an edge list item: (to_node, attributes, time).
+        The edge lists are read in one cache round trip, and the ones missing are rebuilt (their window only, with
+        EDGE_LIST_WINDOW) with one query each.
+        :param from_nodes:
+        :param etype:
+        :param limit:
+        :param before: timestamp, to get only the edges older than it (the next page, when the timestamp of the
+        last edge of a page is given)
+        :param site:
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        from_nodes = list(from_nodes)
+        ctypes = ContentType.objects.get_for_models(*set(type(node) for node in from_nodes))
+        max_score = '+inf' if before is None else '(%s' % before
+
+        counts = self.cache.get_many(
+            [self._count_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk) for node in from_nodes]
+        )
+        sources = [
+            node for node in from_nodes
+            if counts.get(self._count_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk)) != 0
+        ]
+        list_keys = [self._list_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk) for node in sources]
+        pages = self.cache.sorted_sets_rev_range_by_score_with_scores(
+            list_keys, '-inf', max_score, limit, touch=self._touch('list')
+        )
+        if EDGE_LIST_WINDOW:
+            self._touch_list_states([
+                (ctypes[type(node)].pk, node.pk, etype.pk, site.pk)
+                for node, page in zip(sources, pages) if page is not None
+            ])
+            # windows falling short of the page may be missing older edges: complete them
+            states = self.cache.get_many([
+                self._list_state_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk)
+                for node, page in zip(sources, pages) if page is not None and len(page) < limit
+            ])
+            for i, node in enumerate(sources):
+                state_key = self._list_state_key(ctypes[type(node)].pk, node.pk, etype.pk, site.pk)
+                if pages[i] is not None and len(pages[i]) < limit and states.get(state_key) != COMPLETE:
+                    pages[i] = None
+
+        streams = []
+        empty = []
+        for i, (node, page) in enumerate(zip(sources, pages)):
+            ctype = ctypes[type(node)]
+            if page is None:
+                # missing lists are rebuilt one by one (their window only, see _read_or_rebuild())
+                items = self._source_page(node, ctype, etype, site, max_score, before, limit)
+                if not items and before is None:
+                    empty.append(self._count_key(ctype.pk, node.pk, etype.pk, site.pk))
+                streams.append([
+                    (-self._item_position(item)[0], i, j, node, item) for j, item in enumerate(items)
+                ])
+                continue
+            if COMPACT_EDGE_LISTS:
+                items = EdgeList(page, attributes_loader=self._attributes_loader(ctype.pk, node.pk, etype.pk, site.pk))
+            else:
+                items = [self.cache.get_value(member) for member, score in page]
+            streams.append([
+                (-score, i, j, node, item) for j, (item, (member, score)) in enumerate(zip(items, page))
+            ])
+        if empty:
+            # no list to cache: cache their count instead, not to look for them again
+            transaction = self.cache.pipeline()
+            for count_key in empty:
+                transaction.add(count_key, 0, self._timeout('count'))
+            transaction.execute()
+
+        return [(node, item) for score, i, j, node, item in islice(merge(*streams), limit)]
+
+    def _source_page(self, from_node, ctype, etype, site, max_score, before, limit):
+        """
+        Returns the limit most recent edges of the (from_node, etype, site) edge list with a score up to max_score
+        (older than before, a timestamp, when given), rebuilding the list when missing.
+        """
+        list_key = self._list_key(ctype.pk, from_node.pk, etype.pk, site.pk)
+
+        def read():
+            return self._read_list_by_score(
+                list_key, max_score, '-inf', limit, ctype.pk, from_node.pk, etype.pk, site.pk
+            )
+
+        def from_db():
+            edges = self._edges_from_db(from_node, ctype, etype, site, nodes=False)
+            if before is not None:
+                # scores are whole seconds: score < before <=> time < ceil(before)
+                edges = edges.filter(time__lt=score_to_time(ceil(before)))
+            return self._list_from_edges(from_node, edges[:limit])
+
+        depth = limit if before is None else 0  # older pages may be past the cached window
+        return self._read_or_rebuild(list_key, read, from_db, from_node, ctype, etype, site, limit, depth)
+
+    def common_neighbors(self, node_a, node_b, etype, limit, site=None):
+        """
+        Returns the nodes that both node_a and node_b have an edge of type etype to, in site (e.g. mutual friends),
+        up to limit, most recent edges first.
+        :param node_a:
+        :param node_b:
+        :param etype:
+        :param limit:
+        :param site:
+        """
+        return self.common_neighbors_many([node_a, node_b], etype, limit, site)
+
+    def common_neighbors_many(self, nodes, etype, limit, site=None):
+        """
+        Returns the nodes that every node in nodes has an edge of type etype to, in site, up to limit, most recent
+        edges first. Intersects the cached edge lists when they are all cached (and hold node references, see
+        GRAPH_COMPACT_EDGE_LISTS), or else runs one grouped query.
+        :param nodes:
+        :param etype:
+        :param limit:
+        :param site:
+        """
+        from .models import Edge
+
+        if site is None:
+            site = Site.objects.get_current()
+        nodes = list(nodes)
+        if not nodes or limit <= 0:
+            return []
+        ctypes = ContentType.objects.get_for_models(*set(type(node) for node in nodes))
+        sources = set((ctypes[type(node)].pk, u'%s' % node.pk) for node in nodes)
+
+        if COMPACT_EDGE_LISTS:
+            list_keys = [self._list_key(ctype, pk, etype.pk, site.pk) for ctype, pk in sources]
+            warm = len(self.cache.has_keys(list_keys)) == len(list_keys)
+            if warm and EDGE_LIST_WINDOW:
+                state_keys = [self._list_state_key(ctype, pk, etype.pk, site.pk) for ctype, pk in sources]
+                states = self.cache.get_many(state_keys)
+                warm = all(states.get(key) == COMPLETE for key in state_keys)
+            if warm:
+                return [
+                    item.node for item in EdgeList(self.cache.intersect_sorted_sets(list_keys, 0, limit - 1)).hydrate()
+                    if item.node is not None
+                ]
+
+        # the nodes with as many edges as sources (an edge from each of them)
+        pks = defaultdict(list)
+        for ctype, pk in sources:
+            pks[ctype].append(pk)
+        neighbors = Edge.objects.filter(
+            reduce(or_, [Q(fromNode_type_id=ctype, fromNode_pk__in=ctype_pks) for ctype, ctype_pks in pks.items()]),
+            type=etype, site=site
+        ).values('toNode_type_id', 'toNode_pk').annotate(
+            sources=Count('id'), last=Max('time')
+        ).filter(sources=len(sources)).order_by('-last')[:limit]
+        keys = [(neighbor['toNode_type_id'], u'%s' % neighbor['toNode_pk']) for neighbor in neighbors]
+        found = load_nodes(keys)
+        return [found[key] for key in keys if key in found]
+
+    def neighborhood(self, node, etypes, depth, max_fanout, limit, site=None):
+        """
+        Yields the nodes reachable from node through edges of the etypes types in site, up to depth edges away (e.g.
+        friends of friends), as (node, distance) pairs, nearest first, each node once, up to limit nodes.
+        Breadth first, a level at a time: the edge lists of a whole level are read in one cache round trip (the ones
+        missing, with one query), and the nodes found are loaded with one query per content type.
+        :param node:
+        :param etypes: edge type, or list of edge types, of the edges followed
+        :param depth: maximum distance
+        :param max_fanout: maximum number of edges (the most recent ones) followed from each node, per edge type; or a
+        list of them, one per level
+        :param limit:
+        :param site:
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        etypes = [etypes] if hasattr(etypes, 'pk') else list(etypes)
+        fanouts = list(max_fanout) if hasattr(max_fanout, '__iter__') else [max_fanout] * depth
+        start = (ContentType.objects.get_for_model(node).pk, u'%s' % node.pk)
+        # compact "ctype_id:pk" ids of the nodes seen
+        visited = {encode_member(*start)}
+        frontier = [start]
+        found = 0
+        for distance in range(1, depth + 1):
+            if not frontier or found >= limit:
+                return
+            level = []
+            for ids in self._neighbor_ids(frontier, etypes, fanouts[distance - 1], site):
+                for key in ids:
+                    member = encode_member(*key)
+                    if member not in visited:
+                        visited.add(member)
+                        level.append(key)
+            level = level[:limit - found]
+            nodes = load_nodes(level)
+            frontier = [key for key in level if key in nodes]  # (nodes deleted without cleaning their edges are left)
+            for key in frontier:
+                found += 1
+                yield nodes[key], distance
+
+    def _neighbor_ids(self, sources, etypes, fanout, site):
+        """
+        Returns the (ctype_id, pk) ids of the nodes at the end of the fanout most recent edges of each of the etypes
+        types originating at each of sources ((ctype_id, pk) ids), as a list per source and edge type. Read from the
+        cached edge lists in one round trip, and from the database with one query for the lists missing (not cached).
+        """
+        from .models import Edge
+
+        lists = OrderedDict(((ctype, pk, etype.pk), []) for ctype, pk in sources for etype in etypes)
+        # lists known to be empty are not read
+        counts = self.cache.get_many([self._count_key(*(key + (site.pk,))) for key in lists])
+        keys = [key for key in lists if counts.get(self._count_key(*(key + (site.pk,)))) != 0]
+        pages = self.cache.sorted_sets_rev_range_by_score_with_scores(
+            [self._list_key(*(key + (site.pk,))) for key in keys], '-inf', '+inf', fanout, touch=self._touch('list')
+        )
+        if EDGE_LIST_WINDOW:
+            self._touch_list_states([key + (site.pk,) for key, page in zip(keys, pages) if page is not None])
+            # windows falling short of fanout may be missing older edges
+            states = self.cache.get_many([
+                self._list_state_key(*(key + (site.pk,)))
+                for key, page in zip(keys, pages) if page is not None and len(page) < fanout
+            ])
+            pages = [
+                None if page is not None and len(page) < fanout
+                and states.get(self._list_state_key(*(key + (site.pk,)))) != COMPLETE else page
+                for key, page in zip(keys, pages)
+            ]
+
+        missing = set()
+        for key, page in zip(keys, pages):
+            if page is None:
+                missing.add(key)
+            elif COMPACT_EDGE_LISTS:
+                lists[key] = [decode_member(member) for member, score in page]
+            else:
+                to_nodes = [self.cache.get_value(member)[TO_NODE] for member, score in page]
+                lists[key] = [
+                    (ContentType.objects.get_for_model(to_node).pk, u'%s' % to_node.pk) for to_node in to_nodes
+                ]
+
+        if missing:
+            pks = defaultdict(set)
+            for ctype, pk, etype in missing:
+                pks[ctype].add(pk)
+            rows = Edge.objects.filter(
+                reduce(or_, [Q(fromNode_type_id=ctype, fromNode_pk__in=list(ctype_pks))
+                             for ctype, ctype_pks in pks.items()]),
+                type__in=list(set(etype for ctype, pk, etype in missing)), site=site
+            ).order_by('-time').values_list('fromNode_type_id', 'fromNode_pk', 'type_id', 'toNode_type_id', 'toNode_pk')
+            # most recent edges first, until every list missing has its fanout edges
+            for from_ctype, from_pk, etype, to_ctype, to_pk in rows.iterator():
+                key = (from_ctype, u'%s' % from_pk, etype)
+                if key in missing:
+                    lists[key].append((to_ctype, u'%s' % to_pk))
+                    if len(lists[key]) >= fanout:
+                        missing.discard(key)
+                        if not missing:
+                            break
+            # cache the zero count of the lists found empty, not to query them again
+            transaction = self.cache.pipeline()
+            for key in missing:
+                if not lists[key]:
+                    # add() (not set()), not to hide the edges created meanwhile
+                    transaction.add(self._count_key(*(key + (site.pk,))), 0, self._timeout('count'))
+            transaction.execute()
+        return [ids for ids in lists.values() if ids]
+
     def edge_get(self, from_node, etype, to_node, site=None):
         """
         Returns the edge (from_node, etype, to_node) in site, and their time and data
@@ -426,29 +1572,32 @@ class Graph(object):
             site = Site.objects.get_current()
         ctype = ContentType.objects.get_for_model(from_node)
         ctype2 = ContentType.objects.get_for_model(to_node)
-        edge_key = (EDGE_KEY_FORMAT
-                    % {'ctype1': ctype.pk,
-                       'pk1': from_node.pk,
-                       'etype': etype.pk,
-                       'ctype2': ctype2.pk,
-                       'pk2': to_node.pk,
-                       'site': site.pk})
-        edge = self.cache.get(edge_key, None)
-        if edge:
-            return edge
-        else:
-            try:
-                edge = Edge.objects.get(
-                    fromNode_pk=from_node.pk,
-                    fromNode_type=ctype,
-                    toNode_pk=to_node.pk,
-                    toNode_type=ctype2,
-                    type=etype,
-                    site=site)
-                self.cache.set(edge_key, edge)
-                return edge
-            except Edge.DoesNotExist:
+        edge_key = self._edge_key(ctype.pk, from_node.pk, etype.pk, ctype2.pk, to_node.pk, site.pk)
+
+        def load():
+            edge = self.cache.get_and_touch(edge_key, self._touch('edge'))
+            if edge == NO_EDGE:
                 return None
+            elif edge:
+                return edge
+            else:
+                try:
+                    edge = Edge.objects.get(
+                        fromNode_pk=from_node.pk,
+                        fromNode_type=ctype,
+                        toNode_pk=to_node.pk,
+                        toNode_type=ctype2,
+                        type=etype,
+                        site=site)
+                    self.cache.set(edge_key, edge, self._timeout('edge'))
+                    return edge
+                except Edge.DoesNotExist:
+                    if self._caches_misses():
+                        # add() (not set()), not to hide the edge if it has been created meanwhile
+                        self.cache.add(edge_key, NO_EDGE, self._timeout('no_edge'))
+                    return None
+        edge = self._locally(edge_key, 'edge', load)
+        return copy(edge) if edge is not None else None
 
     def edges_get(self, from_node, etype, to_node_set, site=None):
 
@@ -460,51 +1609,53 @@ class Graph(object):
         :param to_node_set:
         :param site:
         """
-        from .models import Edge
-
         if site is None:
             site = Site.objects.get_current()
         ctype = ContentType.objects.get_for_model(from_node)
         result = []
+        found = []
         to_look = []
         if not isinstance(to_node_set, list):
             to_node_set = [to_node_set]
         for node in to_node_set:
             ctype2 = ContentType.objects.get_for_model(node)
-            edge_key = (EDGE_KEY_FORMAT
-                        % {'ctype1': ctype.pk,
-                           'pk1': from_node.pk,
-                           'etype': etype.pk,
-                           'ctype2': ctype2.pk,
-                           'pk2': node.pk,
-                           'site': site.pk})
-            edge = self.cache.get(edge_key, None)
-            if edge:
-                edge_rep = (edge.toNode, edge.attributes, edge.time)
-                result.append(edge_rep)
+            edge_key = self._edge_key(ctype.pk, from_node.pk, etype.pk, ctype2.pk, node.pk, site.pk)
+            edge = self.cache.get_and_touch(edge_key, self._touch('edge'))
+            if edge == NO_EDGE:
+                continue
+            elif edge:
+                found.append(edge)
             else:
                 to_look.append(node)
+        # edges cached by compact edge list rebuilds don't hold their nodes: take them from to_node_set
+        for edge in prefetch_nodes(found, fields=('toNode',), known=to_node_set):
+            result.append((edge.toNode, edge.attributes, edge.time))
         if len(to_look):
-            edges = Edge.objects.filter(fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site)
-            list_key = (EDGE_LIST_KEY_FORMAT
-                        % {'ctype': ctype.pk,
-                           'pk': from_node.pk,
-                           'etype': etype.pk,
-                           'site': site.pk})
+            edges = self._edges_from_db(from_node, ctype, etype, site, nodes=True)
+            look_keys = set(
+                (ContentType.objects.get_for_model(node).pk, u'%s' % node.pk) for node in to_look
+            )
+            list_key = self._list_key(ctype.pk, from_node.pk, etype.pk, site.pk)
             transaction = self.cache.pipeline()
             for edge in edges:
                 edge_rep = (edge.toNode, edge.attributes, edge.time)
-                transaction.add_to_sorted_set(list_key, edge_rep, mktime(edge.time.timetuple()))
-                edge_key = (EDGE_KEY_FORMAT
-                            % {'ctype1': edge.fromNode_type.pk,
-                               'pk1': edge.fromNode_pk,
-                               'etype': etype.pk,
-                               'ctype2': edge.toNode_type.pk,
-                               'pk2': edge.toNode_pk,
-                               'site': site.pk})
-                transaction.set(edge_key, edge)
-                if edge.toNode in to_look:
+                transaction.add_member_to_sorted_set(
+                    list_key, self._list_member(edge), time_to_score(edge.time), self._timeout('list')
+                )
+                transaction.set(self._edge_key_for(edge), edge, self._timeout('edge'))
+                if (edge.toNode_type_id, edge.toNode_pk) in look_keys:
                     result.append(edge_rep)
+                    look_keys.remove((edge.toNode_type_id, edge.toNode_pk))
+            if self._caches_misses():
+                for ctype2_id, pk2 in look_keys:  # not found
+                    transaction.add(
+                        self._edge_key(ctype.pk, from_node.pk, etype.pk, ctype2_id, pk2, site.pk),
+                        NO_EDGE, self._timeout('no_edge')
+                    )
+            if EDGE_LIST_WINDOW:
+                transaction.set(
+                    self._list_state_key(ctype.pk, from_node.pk, etype.pk, site.pk), COMPLETE, self._timeout('list')
+                )
             transaction.execute()
         return result
 
@@ -523,41 +1674,253 @@ class Graph(object):
 
         ctype = ContentType.objects.get_for_model(from_node)
         # check if the count is already cached
-        count_key = (COUNT_KEY_FORMAT
-                     % {'ctype': ctype.pk,
-                        'pk': from_node.pk,
-                        'etype': etype.pk,
-                        'site': site.pk})
-        count = self.cache.get(count_key, None)
-        list_key = (EDGE_LIST_KEY_FORMAT
-                    % {'ctype': ctype.pk,
-                       'pk': from_node.pk,
-                       'etype': etype.pk,
-                       'site': site.pk})
+        count_key = self._count_key(ctype.pk, from_node.pk, etype.pk, site.pk)
+        count = self.cache.get_and_touch(count_key, self._touch('count'))
+        list_key = self._list_key(ctype.pk, from_node.pk, etype.pk, site.pk)
         if count != 0 or count is None:  # the edge list must be checked
-            edges = self.cache.sorted_set_rev_range_by_score(list_key, low, high, 0, limit)
-            if len(edges) != 0:
-                return edges
-            else:
-                edge_list = Edge.objects.filter(fromNode_pk=from_node.pk, fromNode_type=ctype, type=etype, site=site)
-                transaction = self.cache.pipeline()
-                for edge in edge_list:
-                    edge_key = (EDGE_KEY_FORMAT
-                                % {'ctype1': ctype.pk,
-                                   'pk1': from_node.pk,
-                                   'etype': etype.pk,
-                                   'ctype2': edge.toNode_type.pk,
-                                   'pk2': edge.toNode_pk,
-                                   'site': site.pk})
-                    edge_rep = (edge.toNode, edge.attributes, edge.time)
-                    transaction.add_to_sorted_set(list_key, edge_rep, mktime(edge.time.timetuple()))
-                    transaction.set(edge_key, edge)
-                transaction.execute()
-                return self.cache.sorted_set_rev_range_by_score(list_key, low, high, 0, limit)
+            def read():
+                return self._read_list_by_score(list_key, low, high, limit, ctype.pk, from_node.pk, etype.pk, site.pk)
+
+            def from_db():
+                edges = self._edges_from_db(from_node, ctype, etype, site, nodes=False)
+                # scores are whole seconds: score ≥ min <=> time ≥ ceil(min), score ≤ max <=> time < floor(max) + 1
+                min_score, max_score = sorted([float(low), float(high)])
+                if min_score != float('-inf'):
+                    edges = edges.filter(time__gte=score_to_time(ceil(min_score)))
+                if max_score != float('inf'):
+                    edges = edges.filter(time__lt=score_to_time(floor(max_score) + 1))
+                return self._list_from_edges(from_node, edges[:limit])
+
+            return self._read_or_rebuild(list_key, read, from_db, from_node, ctype, etype, site, limit, 0)
         else:  # if count is zero, the list is empty
             return []
 
+    def edge_range_after(self, from_node, etype, cursor, limit, site=None):
+        """
+        Returns the limit edges of the (from_node, etype, site) edge list that follow cursor, most recent first, and the
+        cursor of the next page (None after the last page). Unlike edge_range() offsets, cursors don't shift when edges
+        are added while paging, and deep pages cost no more than the first one.
+        Edges of the same second are ordered by node reference ("ctype_id:pk"), the way compact edge lists are.
+        :param from_node:
+        :param etype:
+        :param cursor: opaque token returned by the previous call, None for the first page
+        :param limit:
+        :param site:
+        :return: (edges, next_cursor)
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        ctype = ContentType.objects.get_for_model(from_node)
+        count = self.cache.get_and_touch(
+            self._count_key(ctype.pk, from_node.pk, etype.pk, site.pk), self._touch('count')
+        )
+        if count == 0:  # the list is empty
+            return [], None
+        position = self._decode_cursor(cursor) if cursor else None
+        list_key = self._list_key(ctype.pk, from_node.pk, etype.pk, site.pk)
+
+        def read():
+            def at(score):
+                return self._read_list_by_score(list_key, score, score, -1, ctype.pk, from_node.pk, etype.pk, site.pk)
+
+            def before(score, num):  # exclusive upper bound
+                upper = '+inf' if score is None else '(%r' % score
+                return self._read_list_by_score(list_key, upper, '-inf', num, ctype.pk, from_node.pk, etype.pk, site.pk)
+            return self._keyset_page(at, before, position, limit)
+
+        def from_db():
+            edges = self._edges_from_db(from_node, ctype, etype, site, nodes=False)
+
+            # scores are whole seconds: score = s <=> s ≤ time < s + 1, score < s <=> time < s
+            def at(score):
+                return self._list_from_edges(
+                    from_node, edges.filter(time__gte=score_to_time(score), time__lt=score_to_time(score + 1))
+                )
+
+            def before(score, num):
+                page = edges if score is None else edges.filter(time__lt=score_to_time(score))
+                return self._list_from_edges(from_node, page[:num])
+            return self._keyset_page(at, before, position, limit)
+
+        page = self._read_or_rebuild(list_key, read, from_db, from_node, ctype, etype, site, limit, 0)
+        next_cursor = None
+        if len(page) >= limit:
+            next_cursor = self._encode_cursor(*self._item_position(page[-1]))
+        return page, next_cursor
+
+    @staticmethod
+    def _item_position(item):
+        """
+        Returns the (score, member) position of an edge list item, in any members format.
+        """
+        if isinstance(item, EdgeListItem):
+            return item.score, encode_member(*item.key)
+        node, attributes, time = item
+        return time_to_score(time), encode_member(ContentType.objects.get_for_model(node).pk, node.pk)
+
+    def _keyset_page(self, at, before, position, limit):
+        """
+        Returns the limit edge list items that follow position (a (score, member) pair, None for the first page), in
+        (score, member) descending order.
+        :param at: callable returning all of the items of a score
+        :param before: callable returning up to num items with a lower score (any score if None), by descending score
+        """
+        items = []
+        score, member = position or (None, None)
+        if position is not None:
+            items.extend(item for item in at(score) if self._item_position(item)[1] < member)
+        rest = before(score, limit)
+        if len(rest) >= limit:
+            # the page may end in the middle of the items of a second: complete them, to order them by member
+            last = self._item_position(rest[-1])[0]
+            rest = [item for item in rest if self._item_position(item)[0] != last]
+            rest.extend(at(last))
+        items.extend(rest)
+        items.sort(key=self._item_position, reverse=True)
+        if items and isinstance(items[0], EdgeListItem):
+            page = EdgeList(attributes_loader=items[0]._edge_list.attributes_loader)
+            for item in items[:limit]:
+                item._edge_list = page  # loads nodes and attributes for the page only
+                page.append(item)
+            return page
+        return items[:limit]
+
+    @staticmethod
+    def _encode_cursor(score, member):
+        return urlsafe_b64encode((u'%r|%s' % (score, member)).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        if not isinstance(cursor, bytes):
+            cursor = cursor.encode('ascii')
+        score, member = urlsafe_b64decode(cursor).decode('utf-8').split(u'|', 1)
+        return float(score), member
+
+    # Incoming Edges Reading #
+
+    def in_edge_count(self, to_node, etype, site=None):
+        """
+        Returns the number of edges of type etype that point to to_node in site (its in-degree)
+        :param to_node:
+        :param etype:
+        :param site:
+        :return: int
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        ctype = ContentType.objects.get_for_model(to_node)
+        key = self._in_count_key(ctype.pk, to_node.pk, etype.pk, site.pk)
+        count = self.cache.get_and_touch(key, self._touch('count'))
+        if count is None:
+            # counted over the (toNode, type, site, time) index: a stored in-degree would be a row every edge to a
+            # popular node updates
+            count = self._in_edges_from_db(to_node, ctype, etype, site).count()
+            self.cache.set(key, count, self._timeout('count'))
+        return count
+
+    def in_edge_range(self, to_node, etype, pos, limit, site=None):
+        """
+        Returns elements of the incoming (to_node, etype, site) edge list, most recent first, with index
+        i ∈ [pos, limit] (the way edge_range() does): (from_node, attributes, time) items.
+        :param to_node:
+        :param etype:
+        :param pos:
+        :param limit:
+        :param site:
+        """
+        if site is None:
+            site = Site.objects.get_current()
+        ctype = ContentType.objects.get_for_model(to_node)
+        count = self.cache.get_and_touch(
+            self._in_count_key(ctype.pk, to_node.pk, etype.pk, site.pk), self._touch('count')
+        )
+        if count == 0:
+            return EdgeList()
+        list_key = self._in_list_key(ctype.pk, to_node.pk, etype.pk, site.pk)
+
+        def read():
+            self._touch_list_states([(ctype.pk, to_node.pk, etype.pk, site.pk)], incoming=True)
+            return EdgeList(
+                self.cache.sorted_set_rev_range_with_scores(list_key, pos, limit, touch=self._touch('list')),
+                attributes_loader=self._attributes_loader(ctype.pk, to_node.pk, etype.pk, site.pk, incoming=True)
+            )
+
+        def from_db():
+            edges = self._in_edges_from_db(to_node, ctype, etype, site)
+            if pos >= 0 and limit >= 0:
+                edges = edges[pos:limit + 1]
+            else:  # negative indexes count from the end, the way Redis ranges do
+                edges = list(edges)[pos:(limit + 1) or None]
+            attributes = dict(((edge.fromNode_type_id, edge.fromNode_pk), edge.attributes) for edge in edges)
+            return EdgeList(
+                [(self._in_list_member(edge), time_to_score(edge.time)) for edge in edges],
+                attributes_loader=lambda items: [attributes.get(item.key) for item in items]
+            )
+
+        if pos >= 0 and limit >= 0:
+            page_size, depth = max(limit + 1 - pos, 0), limit + 1
+        else:
+            page_size, depth = None, None
+        return self._read_or_rebuild(
+            list_key, read, from_db, to_node, ctype, etype, site, page_size, depth, incoming=True
+        )
+
+    def in_edges_get(self, to_node, etype, from_node_set, site=None):
+        """
+        Returns all of the edges (from_node, etype, to_node) in site, where from_node ∈ from_node_set, as
+        (from_node, attributes, time) items, with one cache round trip and one query per content type of the from
+        nodes whose edges are not cached.
+        :param to_node:
+        :param etype:
+        :param from_node_set:
+        :param site:
+        """
+        from .models import Edge
+
+        if site is None:
+            site = Site.objects.get_current()
+        if not isinstance(from_node_set, list):
+            from_node_set = [from_node_set]
+        ctype = ContentType.objects.get_for_model(to_node)
+        nodes = OrderedDict()
+        for node in from_node_set:
+            ctype1 = ContentType.objects.get_for_model(node)
+            nodes[self._edge_key(ctype1.pk, node.pk, etype.pk, ctype.pk, to_node.pk, site.pk)] = (ctype1.pk, node)
+        cached = self.cache.get_many(list(nodes))
+
+        missing = defaultdict(list)
+        for key, (ctype1, node) in nodes.items():
+            if cached.get(key) is None:
+                missing[ctype1].append(u'%s' % node.pk)
+        if missing:
+            found = {}
+            for ctype1, pks in missing.items():
+                for edge in Edge.objects.filter(
+                        toNode_pk=to_node.pk, toNode_type=ctype, type=etype, site=site,
+                        fromNode_type_id=ctype1, fromNode_pk__in=pks
+                ):
+                    found[self._edge_key_for(edge)] = edge
+            cached.update(found)
+            transaction = self.cache.pipeline()
+            for key, edge in found.items():
+                transaction.set(key, edge, self._timeout('edge'))
+            if self._caches_misses():
+                for key in nodes:
+                    if key not in cached:
+                        transaction.add(key, NO_EDGE, self._timeout('no_edge'))
+            transaction.execute()
+
+        result = []
+        for key, (ctype1, node) in nodes.items():
+            edge = cached.get(key)
+            if edge is not None and edge != NO_EDGE:
+                result.append((node, edge.attributes, edge.time))
+        return result
+
     # Utils #
 
     def clear_cache(self):
-        self.cache.clear()
\ No newline at end of file
+        self.cache.clear()
+        local = self._local()
+        if local is not None:
+            local.clear()
\ No newline at end of file
@@ -1,3 +1,4 @@
+# coding=utf-8
 from redis_cache.compat import DEFAULT_TIMEOUT
 
 try:
@@ -5,11 +6,105 @@ try:
 except ImportError:
     import pickle
 import random
+from collections import OrderedDict, Counter
+from threading import local
+from time import time, sleep
+from uuid import uuid4
 
+from redis import ConnectionPool, ResponseError, WatchError
 from redis_cache.backends.base import BaseRedisCache, get_client as get_client_decorator
+from redis_cache.sharder import HashRing
+
+# Applies the cache maintenance of a graph mutation atomically, see ExtendedRedisCache.update_graph()
+# KEYS: edge key, counter keys, sorted set keys to add to, sorted set keys to remove from, keys to touch (refresh
+#       their expiration to the sorted sets timeout), keys to delete
+# ARGV: edge mode (set/del/keep), edge value, edge timeout, #counters, #adds, #removals, counters timeout,
+#       sorted sets timeout, #touched, counter deltas, (member, score) pairs to add, members to remove
+# (timeouts in seconds, 0 for no expiration)
+UPDATE_GRAPH_SCRIPT = """
+local mode, value, timeout = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local counters, adds, removals = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local counters_timeout, sorted_sets_timeout = tonumber(ARGV[7]), tonumber(ARGV[8])
+local touched = tonumber(ARGV[9])
+local k, a = 2, 10
+if mode == 'set' then
+    if timeout > 0 then
+        redis.call('SETEX', KEYS[1], timeout, value)
+    else
+        redis.call('SET', KEYS[1], value)
+    end
+elseif mode == 'del' then
+    redis.call('DEL', KEYS[1])
+end
+for i = 1, counters do
+    if redis.call('EXISTS', KEYS[k]) == 1 then
+        redis.call('INCRBY', KEYS[k], ARGV[a])
+        if counters_timeout > 0 then
+            redis.call('EXPIRE', KEYS[k], counters_timeout)
+        end
+    end
+    k, a = k + 1, a + 1
+end
+for i = 1, adds do
+    if redis.call('EXISTS', KEYS[k]) == 1 then
+        redis.call('ZADD', KEYS[k], ARGV[a + 1], ARGV[a])
+        if sorted_sets_timeout > 0 then
+            redis.call('EXPIRE', KEYS[k], sorted_sets_timeout)
+        end
+    end
+    k, a = k + 1, a + 2
+end
+for i = 1, removals do
+    redis.call('ZREM', KEYS[k], ARGV[a])
+    k, a = k + 1, a + 1
+end
+for i = 1, touched do
+    if sorted_sets_timeout > 0 then
+        redis.call('EXPIRE', KEYS[k], sorted_sets_timeout)
+    end
+    k = k + 1
+end
+for i = k, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+return 1
+"""
+
+# Releases a lock only if it is still held by the given token (it may have expired and been taken by someone else)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# keys written by each thread, with the time until which they are read from the master (see ExtendedRedisCache)
+_recent_writes = local()
+
+
+def recent_writes():
+    try:
+        return _recent_writes.keys
+    except AttributeError:
+        _recent_writes.keys = OrderedDict()
+        return _recent_writes.keys
+
+
+def key_name(key):
+    # the unversioned name of key
+    return u'%s' % getattr(key, '_original_key', key)
 
 
 class ExtendedRedisCache(BaseRedisCache):
+    """
+    Extended cache api over a master and its replicas (LOCATION, with the master in the MASTER_CACHE option).
+    Reads are spread over all the servers, except the reads of the keys written by the same thread in the last
+    READ_YOUR_WRITES_WINDOW seconds (option, default 1), which go to the master so that they can't miss the write in a
+    lagging replica.
+    """
+    # reads of this process pinned to the master because their key was written recently ('redirected'), and reads
+    # spread over all the servers ('spread')
+    read_stats = Counter()
 
     def __init__(self, server, params):
         """
@@ -23,12 +118,62 @@ class ExtendedRedisCache(BaseRedisCache):
 
         self.client_list = self.clients.values()
         self.master_client = self.get_master_client()
+        # the clients every key is written to (one per shard when sharded)
+        self.shard_masters = [self.master_client]
+        self.update_graph_script = self.master_client.register_script(UPDATE_GRAPH_SCRIPT)
+        self.release_lock_script = self.master_client.register_script(RELEASE_LOCK_SCRIPT)
+        # no need to track the writes without replicas
+        self.read_your_writes_window = self.get_read_your_writes_window() if len(self.clients) > 1 else 0
+
+    def get_read_your_writes_window(self):
+        return float(self.options.get('READ_YOUR_WRITES_WINDOW', 1))
 
     def get_client(self, key, write=False):
         if write and self.master_client is not None:
+            self.track_writes([key])
             return self.master_client
+        if self.read_your_writes_window and self.master_client is not None:
+            written = recent_writes().get(key_name(key))
+            if written is not None and written > time():
+                self.read_stats['redirected'] += 1
+                return self.master_client
+            self.read_stats['spread'] += 1
         return random.choice(list(self.client_list))
 
+    def track_writes(self, keys):
+        """
+        Records that the current thread wrote keys, for its reads of them to go to the master for a while.
+        """
+        if not self.read_your_writes_window:
+            return
+        now = time()
+        recent = recent_writes()
+        for key in keys:
+            key = key_name(key)
+            recent.pop(key, None)
+            recent[key] = now + self.read_your_writes_window
+        # forget the keys written before the window (the oldest first)
+        while recent:
+            key, until = next(iter(recent.items()))
+            if until > now:
+                break
+            recent.popitem(last=False)
+
+    def master_for(self, key):
+        """
+        Returns the client key is written to.
+        """
+        return self.master_client
+
+    def group_by_master(self, keys):
+        """
+        Returns the (versioned) keys grouped by the client they are written to, as a {client: [key, ...]} dict.
+        """
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.master_for(key), []).append(key)
+        return groups
+
     ####################
     # Django cache api #
     ####################
@@ -36,8 +181,9 @@ class ExtendedRedisCache(BaseRedisCache):
     def delete_many(self, keys, version=None):
         """Remove multiple keys at once."""
         versioned_keys = self.make_keys(keys, version=version)
-        if versioned_keys:
-            self._delete_many(self.master_client, versioned_keys)
+        self.track_writes(versioned_keys)
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            self._delete_many(client, client_keys)
 
     def clear(self, version=None):
         """Flush cache keys.
@@ -46,13 +192,19 @@ class ExtendedRedisCache(BaseRedisCache):
         namespace will be deleted.  Otherwise, all keys will be deleted.
         """
         if version is None:
-            self._clear(self.master_client)
+            for client in self.shard_masters:
+                self._clear(client)
         else:
             self.delete_pattern('*', version=version)
 
     def get_many(self, keys, version=None):
+        data = {}
         versioned_keys = self.make_keys(keys, version=version)
-        return self._get_many(self.master_client, keys, versioned_keys=versioned_keys)
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            data.update(self._get_many(
+                client, [key._original_key for key in client_keys], versioned_keys=client_keys
+            ))
+        return data
 
     def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
         """
@@ -65,17 +217,20 @@ class ExtendedRedisCache(BaseRedisCache):
         timeout = self.get_timeout(timeout)
 
         versioned_keys = self.make_keys(data.keys(), version=version)
-        if timeout is None:
-            new_data = {}
-            for key in versioned_keys:
-                new_data[key] = self.prep_value(data[key._original_key])
-            return self._set_many(self.master_client, new_data)
-
-        pipeline = self.master_client.pipeline()
-        for key in versioned_keys:
-            value = self.prep_value(data[key._original_key])
-            self._set(pipeline, key, value, timeout)
-        pipeline.execute()
+        self.track_writes(versioned_keys)
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            if timeout is None:
+                new_data = {}
+                for key in client_keys:
+                    new_data[key] = self.prep_value(data[key._original_key])
+                self._set_many(client, new_data)
+                continue
+
+            pipeline = client.pipeline()
+            for key in client_keys:
+                value = self.prep_value(data[key._original_key])
+                self._set(pipeline, key, value, timeout)
+            pipeline.execute()
 
     def incr_version(self, key, delta=1, version=None):
         """
@@ -88,8 +243,10 @@ class ExtendedRedisCache(BaseRedisCache):
 
         old = self.make_key(key, version)
         new = self.make_key(key, version=version + delta)
+        self.track_writes([old])
 
-        return self._incr_version(self.master_client, old, new, delta, version)
+        # both versions of a key live in the same shard (keys are routed by their unversioned name)
+        return self._incr_version(self.master_for(old), old, new, delta, version)
 
     #####################
     # Extra api methods #
@@ -97,13 +254,15 @@ class ExtendedRedisCache(BaseRedisCache):
 
     def delete_pattern(self, pattern, version=None):
         pattern = self.make_key(pattern, version=version)
-        self._delete_pattern(self.master_client, pattern)
+        for client in self.shard_masters:
+            self._delete_pattern(client, pattern)
 
     def reinsert_keys(self):
         """
         Reinsert cache entries using the current pickle protocol version.
         """
-        self._reinsert_keys(self.master_client)
+        for client in self.shard_masters:
+            self._reinsert_keys(client)
 
     ########################
     # Extended api methods #
@@ -115,13 +274,11 @@ class ExtendedRedisCache(BaseRedisCache):
 
     @get_client_decorator(write=True)
     def add_to_sorted_set(self, client, key, value, score, timeout=DEFAULT_TIMEOUT):
-        timeout = self.get_timeout(timeout)
-        return client.zadd(key, self.prep_value(value), score)
+        return self._expiring(client, key, timeout, client.zadd(key, self.prep_value(value), score))
 
     @get_client_decorator(write=True)
     def rem_from_sorted_set(self, client, key, value, timeout=DEFAULT_TIMEOUT):
-        timeout = self.get_timeout(timeout)
-        return client.zrem(key, self.prep_value(value)) != 0
+        return self._expiring(client, key, timeout, client.zrem(key, self.prep_value(value))) != 0
 
     @get_client_decorator(write=True)
     def rem_from_sorted_set_by_rank(self, client, key, min_rank, max_rank=None):
@@ -142,8 +299,8 @@ class ExtendedRedisCache(BaseRedisCache):
         return result
 
     @get_client_decorator()
-    def sorted_set_rev_range(self, client, key, start, num):
-        items = client.zrevrange(key, start, num)
+    def sorted_set_rev_range(self, client, key, start, num, touch=None):
+        items = self._touching(client, key, touch, lambda c: c.zrevrange(key, start, num))
         result = []
         for item in items:
             try:
@@ -166,8 +323,8 @@ class ExtendedRedisCache(BaseRedisCache):
         return result
 
     @get_client_decorator()
-    def sorted_set_rev_range_by_score(self, client, key, min, max, start=None, num=None):
-        items = client.zrevrangebyscore(key, min, max, start, num)
+    def sorted_set_rev_range_by_score(self, client, key, min, max, start=None, num=None, touch=None):
+        items = self._touching(client, key, touch, lambda c: c.zrevrangebyscore(key, min, max, start, num))
         result = []
         for item in items:
             try:
@@ -181,14 +338,408 @@ class ExtendedRedisCache(BaseRedisCache):
     def sorted_set_count(self, client, key):
         return client.zcard(key)
 
+    # raw members (stored as given, not pickled)
+
+    @get_client_decorator(write=True)
+    def add_member_to_sorted_set(self, client, key, member, score, timeout=DEFAULT_TIMEOUT):
+        return self._expiring(client, key, timeout, client.zadd(key, member, score))
+
+    @get_client_decorator(write=True)
+    def rem_member_from_sorted_set(self, client, key, member, timeout=DEFAULT_TIMEOUT):
+        return self._expiring(client, key, timeout, client.zrem(key, member)) != 0
+
+    @get_client_decorator()
+    def sorted_set_rev_range_with_scores(self, client, key, start, num, touch=None):
+        return self._touching(client, key, touch, lambda c: c.zrevrange(key, start, num, withscores=True))
+
+    @get_client_decorator()
+    def sorted_set_rev_range_by_score_with_scores(self, client, key, min, max, start=None, num=None, touch=None):
+        return self._touching(
+            client, key, touch, lambda c: c.zrevrangebyscore(key, min, max, start, num, withscores=True)
+        )
+
+    def sorted_sets_rev_range_by_score_with_scores(self, keys, min, max, num=None, touch=None, version=None):
+        """
+        Reads the same score range of many sorted sets (up to num items each, by descending score) in one round trip
+        (per shard), refreshing their expiration to touch seconds when given.
+        Returns a list with, for each key, its (member, score) pairs read, or None if the sorted set isn't cached.
+        """
+        versioned_keys = self.make_keys(keys, version=version)
+        pages = {}
+        step = 3 if touch else 2
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            pipeline = client.pipeline(transaction=False)
+            for key in client_keys:
+                pipeline.exists(key)
+                pipeline.zrevrangebyscore(key, max, min, None if num is None else 0, num, withscores=True)
+                if touch:
+                    pipeline.expire(key, touch)
+            results = pipeline.execute()
+            for key, i in zip(client_keys, range(0, len(results), step)):
+                pages[key] = results[i + 1] if results[i] else None
+        return [pages[key] for key in versioned_keys]
+
+    def replace_sorted_set(self, key, load, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Replaces the sorted set key with the (member, score) pairs (raw members) returned by load(), in one transaction,
+        unless key is written while load() runs (it is watched from before load() is called): then key is left as it
+        is, and False is returned.
+        """
+        key = self.make_key(key, version=version)
+        timeout = self.get_timeout(timeout)
+        self.track_writes([key])
+        with self.master_for(key).pipeline() as transaction:
+            transaction.watch(key)
+            items = load()
+            transaction.multi()
+            transaction.delete(key)
+            if items:
+                transaction.zadd(key, *[value for item in items for value in item])
+                if timeout is not None and timeout > 0:
+                    transaction.expire(key, timeout)
+            try:
+                transaction.execute()
+            except WatchError:
+                return False
+        return True
+
+    def intersect_sorted_sets(self, keys, start, num, aggregate='MAX', version=None):
+        """
+        Returns the (member, score) pairs of the intersection of the sorted sets keys, by descending score, with index
+        i ∈ [start, num]. The intersection is stored in a temporary key, in the same transaction (or computed here, when
+        the sorted sets live in different shards).
+        """
+        versioned_keys = self.make_keys(keys, version=version)
+        groups = self.group_by_master(versioned_keys)
+        if len(groups) > 1:
+            return self._intersect_across_shards(groups, start, num, aggregate)
+        temp_key = self.make_key('intersection:%s' % uuid4().hex, version=version)
+        transaction = next(iter(groups)).pipeline() if groups else self.master_client.pipeline()
+        transaction.zinterstore(temp_key, versioned_keys, aggregate=aggregate)
+        transaction.zrevrange(temp_key, start, num, withscores=True)
+        transaction.delete(temp_key)
+        return transaction.execute()[1]
+
+    @staticmethod
+    def _intersect_across_shards(groups, start, num, aggregate):
+        sorted_sets = []
+        for client, client_keys in groups.items():
+            pipeline = client.pipeline(transaction=False)
+            for key in client_keys:
+                pipeline.zrange(key, 0, -1, withscores=True)
+            sorted_sets.extend(dict(items) for items in pipeline.execute())
+        combine = {'MAX': max, 'MIN': min, 'SUM': sum}[aggregate.upper()]
+        members = set(sorted_sets[0]).intersection(*sorted_sets[1:])
+        items = sorted(
+            ((member, combine([scores[member] for scores in sorted_sets])) for member in members),
+            key=lambda item: (item[1], item[0]), reverse=True
+        )
+        return items[start:num + 1 or None]
+
+    def push_to_list(self, key, values, version=None):
+        """
+        Appends values (stored as given, raw) to the list key.
+        """
+        if values:
+            key = self.make_key(key, version=version)
+            return self.master_for(key).rpush(key, *values)
+
+    def pop_from_list(self, key, num, version=None):
+        """
+        Removes and returns the num first values of the list key, atomically.
+        """
+        key = self.make_key(key, version=version)
+        transaction = self.master_for(key).pipeline()
+        transaction.lrange(key, 0, num - 1)
+        transaction.ltrim(key, num, -1)
+        return transaction.execute()[0]
+
+    def publish(self, channel, message, version=None):
+        """
+        Publishes message (a string) on the pub/sub channel, returns the number of subscribers that received it.
+        """
+        channel = self.make_key(channel, version=version)
+        return self.master_for(channel).publish(channel, message)
+
+    def subscribe(self, channel, version=None):
+        """
+        Returns a pub/sub object subscribed to channel, whose listen() generator yields the messages published on it.
+        The subscription holds a connection of its own, out of the cache connection pools (it would keep one of them
+        for as long as it listens): close() it when done.
+        """
+        channel = self.make_key(channel, version=version)
+        client = self.master_for(channel)
+        pool = client.connection_pool
+        dedicated = ConnectionPool(connection_class=pool.connection_class, max_connections=1, **pool.connection_kwargs)
+        pubsub = client.__class__(connection_pool=dedicated).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return pubsub
+
+    def get_and_touch(self, key, touch=None, default=None, version=None):
+        """
+        Like get(), refreshing the key expiration to touch seconds (when given) in the same round trip.
+        """
+        key = self.make_key(key, version=version)
+        value = self._touching(self.get_client(key), key, touch, lambda c: c.get(key))
+        if value is None:
+            return default
+        return self.get_value(value)
+
+    def _expiring(self, client, key, timeout, result):
+        """
+        Sets the expiration of key (written by the command that returned result) to timeout.
+        """
+        timeout = self.get_timeout(timeout)
+        if timeout is not None and timeout > 0:
+            client.expire(key, timeout)
+        return result
+
+    def _touching(self, client, key, touch, command):
+        """
+        Returns command(client), a read of key, also refreshing the key expiration to touch seconds (when given) in
+        the same round trip (in a master pipeline, expirations being writes).
+        """
+        if not touch:
+            return command(client)
+        pipeline = self.master_for(key).pipeline(transaction=False)
+        command(pipeline)
+        pipeline.expire(key, touch)
+        return pipeline.execute()[0]
+
+    def update_graph(self, edge_key, edge, counters=None, sorted_set_adds=(), sorted_set_rems=(), invalidate=(),
+                     touch=(), timeout=DEFAULT_TIMEOUT, counters_timeout=DEFAULT_TIMEOUT,
+                     sorted_sets_timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Applies the cache maintenance of one graph mutation atomically, in one round trip (a server side script):
+        :param edge_key: set to edge, deleted if edge is None (left untouched if edge_key is None)
+        :param counters: {key: delta} dict, each cached counter gets incremented by delta (missing ones stay missing)
+        :param sorted_set_adds: (key, member, score) items, members are only added to sorted sets already cached
+        :param sorted_set_rems: (key, member) items, to remove from sorted sets
+        :param invalidate: keys to delete
+        :param touch: keys whose expiration is refreshed to sorted_sets_timeout (if cached), like the sorted sets'
+        :param timeout: of the edge key
+        :param counters_timeout: expiration set on the counters incremented
+        :param sorted_sets_timeout: expiration set on the sorted sets added to
+        Sorted set members are stored as given (raw).
+        When the keys live in different shards, each shard runs the script on its own keys (atomic per shard).
+        """
+        counters = counters or {}
+        if edge_key is None:
+            mode, value = 'keep', ''
+        elif edge is None:
+            mode, value = 'del', ''
+        else:
+            mode, value = 'set', self.prep_value(edge)
+        timeout = self.get_timeout(timeout)
+        if edge_key is not None and timeout is not None and timeout < 0:
+            mode, value = 'del', ''
+
+        counters_timeout = self.get_timeout(counters_timeout)
+        sorted_sets_timeout = self.get_timeout(sorted_sets_timeout)
+
+        # per client: edge key, counters, sorted set adds, sorted set removals, keys to touch, keys to delete
+        calls = OrderedDict()
+        written = []
+
+        def call_for(key):
+            written.append(key)
+            return calls.setdefault(self.master_for(key), (['', 'keep', ''], [], [], [], [], []))
+
+        if edge_key is not None:
+            key = self.make_key(edge_key, version=version)
+            call_for(key)[0][:] = [key, mode, value]
+        for key, delta in counters.items():
+            key = self.make_key(key, version=version)
+            call_for(key)[1].append((key, delta))
+        for key, member, score in sorted_set_adds:
+            key = self.make_key(key, version=version)
+            call_for(key)[2].append((key, member, score))
+        for key, member in sorted_set_rems:
+            key = self.make_key(key, version=version)
+            call_for(key)[3].append((key, member))
+        for key in touch:
+            key = self.make_key(key, version=version)
+            call_for(key)[4].append(key)
+        for key in invalidate:
+            key = self.make_key(key, version=version)
+            call_for(key)[5].append(key)
+
+        self.track_writes(written)
+        result = None
+        for client, ((key, mode, value), call_counters, adds, rems, touched, invalidations) in calls.items():
+            keys = [key]
+            args = [mode, value, timeout or 0, len(call_counters), len(adds), len(rems),
+                    max(counters_timeout or 0, 0), max(sorted_sets_timeout or 0, 0), len(touched)]
+            for key, delta in call_counters:
+                keys.append(key)
+                args.append(delta)
+            for key, member, score in adds:
+                keys.append(key)
+                args.extend([member, score])
+            for key, member in rems:
+                keys.append(key)
+                args.append(member)
+            keys.extend(touched)
+            keys.extend(invalidations)
+            result = self.update_graph_script(keys=[u'%s' % key for key in keys], args=args, client=client)
+        return result
+
+    def has_keys(self, keys, version=None):
+        """
+        Returns the subset of keys that are present in the cache, checking all of them in one round trip (per shard).
+        """
+        versioned_keys = self.make_keys(keys, version=version)
+        if not versioned_keys:
+            return set()
+        found = set()
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            pipeline = client.pipeline(transaction=False)
+            for key in client_keys:
+                pipeline.exists(key)
+            found.update(key._original_key for key, exists in zip(client_keys, pipeline.execute()) if exists)
+        return found
+
+    def touch_many(self, keys, touch, version=None):
+        """
+        Refreshes the expiration of keys (the ones cached) to touch seconds, in one round trip (per shard).
+        """
+        versioned_keys = self.make_keys(keys, version=version)
+        for client, client_keys in self.group_by_master(versioned_keys).items():
+            pipeline = client.pipeline(transaction=False)
+            for key in client_keys:
+                pipeline.expire(key, touch)
+            pipeline.execute()
+
+    def acquire_lock(self, key, timeout, version=None):
+        """
+        Tries to take the lock key, held for timeout seconds at most.
+        Returns the token to release it with, or None if the lock is held by someone else.
+        """
+        token = uuid4().hex
+        key = self.make_key(key, version=version)
+        if self.master_for(key).set(key, token, px=int(timeout * 1000), nx=True):
+            return token
+        return None
+
+    def release_lock(self, key, token, version=None):
+        key = self.make_key(key, version=version)
+        return self.release_lock_script(keys=[u'%s' % key], args=[token], client=self.master_for(key)) == 1
+
+    def wait_for_lock(self, key, wait, interval=0.01, version=None):
+        """
+        Waits up to wait seconds for the lock key to be released. Returns whether it got released.
+        """
+        key = self.make_key(key, version=version)
+        deadline = time() + wait
+        while self.master_for(key).exists(key):
+            if time() >= deadline:
+                return False
+            sleep(interval)
+        return True
+
     def pipeline(self, transaction=True, shard_hint=None):
-        return RedisPipeline(self.server, self.params, transaction, shard_hint)
+        return RedisPipeline(self, transaction, shard_hint)
 
 
 class RedisPipeline(ExtendedRedisCache):
-    def __init__(self, server, params, transaction=True, shard_hint=None):
-        super(RedisPipeline, self).__init__(server, params)
-        self.master_client = self.master_client.pipeline(transaction, shard_hint)
+    """
+    Extended cache api whose write commands are queued in pipelines of the parent cache master clients (one per
+    shard written to), until execute() is called.
+    """
+    def __init__(self, cache, transaction=True, shard_hint=None):
+        # borrow the parent cache state (clients, connection pools, serializer...) instead of building a new cache
+        self.__dict__.update(cache.__dict__)
+        self.cache = cache
+        self.transaction = transaction
+        self.shard_hint = shard_hint
+        self.pipelines = OrderedDict()
+        self.master_client = self._pipeline(cache.master_client)
+
+    def _pipeline(self, client):
+        if client not in self.pipelines:
+            self.pipelines[client] = client.pipeline(self.transaction, self.shard_hint)
+        return self.pipelines[client]
+
+    def get_client(self, key, write=False):
+        if write:
+            self.track_writes([key])
+            return self.master_for(key)
+        return self.cache.get_client(key)
+
+    def master_for(self, key):
+        return self._pipeline(self.cache.master_for(key))
 
     def execute(self):
-        return self.master_client.execute()
+        results = []
+        for pipeline in self.pipelines.values():
+            results.extend(pipeline.execute())
+        return results
+
+
+def routing_key(key):
+    """
+    Returns the part of key (versioned or not) its shard is picked by: its {hash tag} if it has one, or else its whole
+    unversioned name (so that all the versions of a key live in the same shard).
+    """
+    key = u'%s' % getattr(key, '_original_key', key)
+    start = key.find(u'{')
+    if start != -1:
+        end = key.find(u'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class ShardedRedisCache(ExtendedRedisCache):
+    """
+    Extended cache api spreading the keys over all the servers in LOCATION (each one the master of its shard), through
+    a consistent hash ring: adding a server only moves a share of the keys to it (see rebalance()).
+    Graph keys tag their node, so that the edges, edge count and edge list of a node live in the same shard.
+    """
+
+    def __init__(self, server, params):
+        super(ShardedRedisCache, self).__init__(server, params)
+        self.ring = HashRing()
+        for identifier in self.clients:
+            self.ring.add(identifier)
+        self.shard_masters = list(self.client_list)
+        self.read_your_writes_window = 0  # every key is read from its master
+
+    def get_client(self, key, write=False):
+        return self.master_for(key)
+
+    def master_for(self, key):
+        return self.clients[self.ring.get_node(routing_key(key))]
+
+    def rebalance(self, drop=False, version=None):
+        """
+        Moves the keys stored in a shard other than the one they are routed to (after servers were added to LOCATION)
+        to their shard, with their expiration. Keys already written to their new shard are kept as they are there.
+        :param drop: delete the misplaced keys instead of moving them (graph keys are loaded again when missed)
+        Returns the number of keys moved and the number of keys dropped.
+        """
+        prefix = u'%s' % self.make_key('', version=version)
+        pattern = u'%s' % self.make_key('*', version=version)
+        moved = dropped = 0
+        for client in self.shard_masters:
+            for key in client.scan_iter(match=pattern):
+                name = key.decode('utf-8') if isinstance(key, bytes) else key
+                target = self.master_for(name[len(prefix):])
+                if target is client:
+                    continue
+                if drop:
+                    dropped += 1
+                else:
+                    pipeline = client.pipeline(transaction=False)
+                    pipeline.dump(key)
+                    pipeline.pttl(key)
+                    dump, ttl = pipeline.execute()
+                    if dump is None:  # expired meanwhile
+                        continue
+                    try:
+                        target.restore(key, max(ttl, 0), dump)
+                        moved += 1
+                    except ResponseError:  # the key exists in its new shard already
+                        dropped += 1
+                client.delete(key)
+        return moved, dropped
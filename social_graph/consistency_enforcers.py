@@ -1,4 +1,15 @@
 # coding=utf-8
+from . import outbox
+
+
+def _identity(edge):
+    return (
+        edge.fromNode_type_id, edge.fromNode_pk, edge.toNode_type_id, edge.toNode_pk, edge.type_id, edge.site_id
+    )
+
+
+def _count_identity(edge):
+    return edge.fromNode_type_id, edge.fromNode_pk, edge.type_id, edge.site_id
 
 
 class SymmetricEdgeManager(object):
@@ -6,9 +17,13 @@ class SymmetricEdgeManager(object):
     @staticmethod
     def create_symmetric_edge(sender, instance, created, **kwargs):
         from .models import EdgeTypeAssociation, Edge
+        if outbox.deferred():
+            if not instance.auto:
+                outbox.enqueue(outbox.SYMMETRIC_ADD, *_identity(instance))
+            return
         if not instance.auto:
             try:
-                symmetric_type = EdgeTypeAssociation.objects.get(direct=instance.type).inverse
+                symmetric_type = EdgeTypeAssociation.objects.get_for_direct_edge_type(instance.type).inverse
                 try:
                     Edge.objects.get(fromNode_pk=instance.toNode.pk,
                                      fromNode_type_id=instance.toNode_type_id,
@@ -32,8 +47,11 @@ class SymmetricEdgeManager(object):
     @staticmethod
     def delete_symmetric_edge(sender, instance, **kwargs):
         from .models import EdgeTypeAssociation
+        if outbox.deferred():
+            outbox.enqueue(outbox.SYMMETRIC_DELETE, *_identity(instance))
+            return
         try:
-            symmetric_type = EdgeTypeAssociation.objects.get(direct=instance.type).inverse
+            symmetric_type = EdgeTypeAssociation.objects.get_for_direct_edge_type(instance.type).inverse
             from .api import Graph
             Graph()._delete(instance.toNode, instance.fromNode, symmetric_type, instance.site)
         except EdgeTypeAssociation.DoesNotExist:
@@ -68,6 +86,9 @@ class EdgeCounter(object):
     def increase_count(sender, instance, created, **kwargs):
         from django.db.models import F
         from .models import EdgeCount
+        if outbox.deferred():
+            outbox.enqueue(outbox.COUNT, *_count_identity(instance))
+            return
         counter, is_new = EdgeCount.objects.get_or_create(
             fromNode_pk=instance.fromNode_pk,
             fromNode_type_id=instance.fromNode_type_id,
@@ -85,6 +106,9 @@ class EdgeCounter(object):
     def decrease_count(sender, instance, **kwargs):
         from django.db.models import F
         from .models import EdgeCount
+        if outbox.deferred():
+            outbox.enqueue(outbox.COUNT, *_count_identity(instance))
+            return
         counter, is_new = EdgeCount.objects.get_or_create(
             fromNode_pk=instance.fromNode_pk,
             fromNode_type_id=instance.fromNode_type_id,
@@ -102,10 +126,8 @@ class EdgeCounter(object):
 class EdgeCleaner(object):
     @staticmethod
     def clean_edges(sender, instance, **kwargs):
-        from social_graph.models import EdgeTypeAssociation, Edge, EdgeCount, EdgeType
-        if sender in (Edge, EdgeType, EdgeTypeAssociation, EdgeCount):
+        from .api import Graph
+        # only graph nodes (registered with Graph.register_node_type() or @crud_aware) have edges to clean
+        if not Graph.is_registered_type(sender):
             return
-        types = EdgeType.objects.all()
-        for e_type in types:
-            from .api import Graph
-            Graph()._delete_all(instance, e_type)
+        Graph()._delete_node(instance)
@@ -0,0 +1,169 @@
+# coding=utf-8
+from collections import defaultdict
+from datetime import datetime
+from time import mktime
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils import six
+
+_MISSING = object()
+
+
+def encode_member(ctype_id, pk):
+    """
+    Compact edge list member: the node identity, as "ctype_id:pk".
+    """
+    return u'%s:%s' % (ctype_id, pk)
+
+
+def decode_member(member):
+    if isinstance(member, six.binary_type):
+        member = member.decode('utf-8')
+    ctype_id, pk = member.split(u':', 1)
+    return int(ctype_id), pk
+
+
+def time_to_score(time):
+    return mktime(time.timetuple())
+
+
+def score_to_time(score):
+    time = datetime.fromtimestamp(score)
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils.timezone import utc
+        time = time.replace(tzinfo=utc)
+    return time
+
+
+def load_nodes(keys):
+    """
+    Loads the nodes referenced by (ctype_id, pk) pairs, with one in_bulk() query per content type.
+    Returns a dict {(ctype_id, pk): node}, pks as text (the way Edge stores them).
+    """
+    by_ctype = defaultdict(set)
+    for ctype_id, pk in keys:
+        by_ctype[ctype_id].add(u'%s' % pk)
+    nodes = {}
+    for ctype_id, pks in by_ctype.items():
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        if model is None:
+            continue
+        for pk, node in model._default_manager.in_bulk(list(pks)).items():
+            nodes[(ctype_id, u'%s' % pk)] = node
+    return nodes
+
+
+def prefetch_nodes(edges, fields=('fromNode', 'toNode'), known=()):
+    """
+    Loads the nodes referenced by the generic foreign key fields of edges (Edge or EdgeCount instances) with one
+    in_bulk() query per content type, and caches them on the edges, so that accessing them runs no more queries.
+    :param known: nodes already at hand, used instead of being loaded again
+    Returns the list of edges.
+    """
+    edges = list(edges)
+    if not edges:
+        return edges
+    model = type(edges[0])
+    descriptors = [getattr(model, field) for field in fields]
+
+    def node_key(edge, descriptor):
+        return getattr(edge, descriptor.ct_field + '_id'), u'%s' % getattr(edge, descriptor.fk_field)
+
+    nodes = dict(((ContentType.objects.get_for_model(node).pk, u'%s' % node.pk), node) for node in known)
+    nodes.update(load_nodes(set(
+        node_key(edge, descriptor) for edge in edges for descriptor in descriptors
+    ).difference(nodes)))
+    for edge in edges:
+        for descriptor in descriptors:
+            setattr(edge, descriptor.cache_attr, nodes.get(node_key(edge, descriptor)))
+    return edges
+
+
+class EdgeListItem(object):
+    """
+    Compact edge list entry. The node is referenced by (ctype_id, pk), and both the node and the edge attributes are
+    only loaded when accessed (for the whole list at once).
+    Can be indexed (and unpacked) as the (node, attributes, time) tuples of non compact edge lists.
+    """
+    __slots__ = ('ctype_id', 'pk', 'score', '_edge_list', '_node', '_attributes')
+    _fields = ('node', 'attributes', 'time')
+
+    def __init__(self, ctype_id, pk, score, edge_list):
+        self.ctype_id = ctype_id
+        self.pk = pk
+        self.score = score
+        self._edge_list = edge_list
+        self._node = _MISSING
+        self._attributes = _MISSING
+
+    @property
+    def key(self):
+        return self.ctype_id, self.pk
+
+    @property
+    def node(self):
+        if self._node is _MISSING:
+            self._edge_list.hydrate()
+        return self._node
+
+    @property
+    def attributes(self):
+        if self._attributes is _MISSING:
+            self._edge_list.load_attributes()
+        return self._attributes
+
+    @property
+    def time(self):
+        return score_to_time(self.score)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(getattr(self, field) for field in self._fields[index])
+        return getattr(self, self._fields[index])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __repr__(self):
+        return '<EdgeListItem %s>' % encode_member(self.ctype_id, self.pk)
+
+
+class EdgeList(list):
+    """
+    List of compact edge list entries, built from (member, score) pairs.
+    :param attributes_loader: callable receiving a list of items and returning their attributes, in the same order
+    """
+
+    def __init__(self, entries=(), attributes_loader=None):
+        super(EdgeList, self).__init__()
+        self.attributes_loader = attributes_loader
+        for member, score in entries:
+            ctype_id, pk = decode_member(member)
+            self.append(EdgeListItem(ctype_id, pk, score, self))
+
+    def keys(self):
+        """
+        Returns the (ctype_id, pk) node references, without touching the database.
+        """
+        return [item.key for item in self]
+
+    def hydrate(self):
+        pending = [item for item in self if item._node is _MISSING]
+        nodes = load_nodes(item.key for item in pending)
+        for item in pending:
+            item._node = nodes.get(item.key)
+        return self
+
+    def load_attributes(self):
+        pending = [item for item in self if item._attributes is _MISSING]
+        if self.attributes_loader is None:
+            values = [None] * len(pending)
+        else:
+            values = self.attributes_loader(pending)
+        for item, attributes in zip(pending, values):
+            item._attributes = attributes
+        return self
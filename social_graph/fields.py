@@ -2,8 +2,9 @@
 # Courtesy of django-social-auth
 import json
 
-from django.core.exceptions import ValidationError
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import models, connections, DEFAULT_DB_ALIAS
 from django.utils import six
 
 try:
@@ -59,9 +60,106 @@ class JSONField(six.with_metaclass(models.SubfieldBase,
         return self.get_prep_value(self._get_val_from_obj(obj))
 
 
+# NODE PK STORAGE: 'text' (TextField, the default), 'integer' (BigIntegerField, for nodes with integer pks only) or
+# 'char' (CharField of NODE_PK_MAX_LENGTH characters). Migration 0006 converts the columns to it, the convert_node_pks
+# command when changed later.
+NODE_PK_FIELD = getattr(settings, 'GRAPH_NODE_PK_FIELD', 'text')
+NODE_PK_MAX_LENGTH = getattr(settings, 'GRAPH_NODE_PK_MAX_LENGTH', 255)
+
+# (table, column) of the node pks
+NODE_PK_COLUMNS = [
+    (u'social_graph_edge', 'fromNode_pk'),
+    (u'social_graph_edge', 'toNode_pk'),
+    (u'social_graph_edgecount', 'fromNode_pk'),
+]
+
+
+class IntegerNodePkField(six.with_metaclass(models.SubfieldBase,
+                                            models.BigIntegerField)):
+    """Node pk stored as a big integer, but handled as text in python, the
+    way node pks stored in text columns are.
+    """
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return value
+        return u'%s' % value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return int(value)
+
+
+def node_pk_field(verbose_name=None, storage=None):
+    """
+    Returns the field that stores node pks (Edge and EdgeCount fromNode_pk and toNode_pk), as selected by storage
+    ('text', 'integer' or 'char'), the GRAPH_NODE_PK_FIELD setting by default.
+    """
+    storage = storage or NODE_PK_FIELD
+    if storage == 'integer':
+        return IntegerNodePkField(verbose_name)
+    if storage == 'char':
+        return models.CharField(verbose_name, max_length=NODE_PK_MAX_LENGTH)
+    return models.TextField(verbose_name)
+
+
+def node_pk_storage(table, column, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the storage ('text', 'integer' or 'char') of the node pk column of table, as found in the database.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for description in connection.introspection.get_table_description(cursor, table):
+        if description[0].lower() == column.lower():
+            field_type = connection.introspection.get_field_type(description[1], description)
+            return {'BigIntegerField': 'integer', 'CharField': 'char'}.get(field_type, 'text')
+
+
+def convert_node_pk_columns(db, storage=None):
+    """
+    Converts the node pk columns (and the pks they hold) to storage (the GRAPH_NODE_PK_FIELD setting by default), with
+    db, the South database api. The columns already stored that way are left alone. The conversion to 'integer' fails
+    if any node pk is not an integer.
+    Returns the (table, column) converted.
+    """
+    storage = storage or NODE_PK_FIELD
+    converted = []
+    for table, column in NODE_PK_COLUMNS:
+        if node_pk_storage(table, column, db.db_alias) == storage:
+            continue
+        if storage == 'integer' and db.backend_name == 'postgres':
+            # PostgreSQL doesn't cast text to bigint implicitly
+            db.execute('ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE bigint USING %(column)s::bigint' % {
+                'table': db.quote_name(table), 'column': db.quote_name(column)
+            })
+        else:
+            db.alter_column(table, column, node_pk_field(storage=storage))
+        converted.append((table, column))
+    return converted
+
+
+def check_node_pk_columns(using=DEFAULT_DB_ALIAS):
+    """
+    Raises ImproperlyConfigured if the node pk columns in the database are not stored the way the GRAPH_NODE_PK_FIELD
+    setting says (it changed after migration 0006 converted them), and the models would disagree with them.
+    """
+    connection = connections[using]
+    tables = connection.introspection.table_names()
+    for table, column in NODE_PK_COLUMNS:
+        if table not in tables:  # not migrated yet
+            continue
+        storage = node_pk_storage(table, column, using)
+        if storage != NODE_PK_FIELD:
+            raise ImproperlyConfigured(
+                "%s.%s stores node pks as %s, but GRAPH_NODE_PK_FIELD is '%s': run python manage.py convert_node_pks"
+                % (table, column, storage, NODE_PK_FIELD)
+            )
+
+
 try:
     from south.modelsinspector import add_introspection_rules
-    add_introspection_rules([], ["^social_graph\.fields\.JSONField"])
+    add_introspection_rules([], ["^social_graph\.fields\.JSONField", "^social_graph\.fields\.IntegerNodePkField"])
 except:
     pass
 
@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+Optional in-process cache (GRAPH_LOCAL_CACHE setting) in front of the graph cache, for edge counts, edges and first
+edge list pages: bounded (least recently used entries go first) and short lived (entries expire after a timeout).
+Graph writes invalidate the keys they change in every process, through a Redis pub/sub channel each process listens to.
+"""
+import json
+import os
+from collections import OrderedDict, Counter
+from threading import Lock, Thread
+from time import time, sleep
+
+MISSING = object()
+
+# invalidation message clearing the whole cache
+ALL = '*'
+
+
+class LocalCache(object):
+    """
+    Bounded LRU + TTL cache of one process, invalidated through the channel of the graph cache.
+    :param cache: the graph cache, whose pub/sub channel carries the invalidations
+    :param size: maximum number of entries
+    :param timeout: seconds an entry lives (bounding how stale it can get if an invalidation is lost)
+    :param channel: pub/sub channel name
+    """
+
+    def __init__(self, cache, size=10000, timeout=5, channel='graph_invalidations'):
+        self.cache = cache
+        self.size = size
+        self.timeout = timeout
+        self.channel = channel
+        # hits and misses per key family ('count', 'edge', 'list')
+        self.stats = Counter()
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._pid = None
+        self._listening = False
+        self._pubsub = None
+        self._stopped = False
+
+    def get(self, key, family, fits=None):
+        """
+        Returns the value cached under key, or MISSING.
+        :param fits: callable telling whether a cached value can be used, for values that depend on more than the key
+        """
+        self._ensure_listener()
+        value = MISSING
+        if self._listening:
+            with self._lock:
+                entry = self._entries.pop(key, None)
+                if entry is not None and entry[1] > time():
+                    self._entries[key] = entry  # most recently used
+                    if fits is None or fits(entry[0]):
+                        value = entry[0]
+        self.stats[(family, 'hits' if value is not MISSING else 'misses')] += 1
+        return value
+
+    def set(self, key, value, generation):
+        """
+        Caches value under key, unless anything was invalidated since generation (read before loading value), as the
+        value loaded could already be stale, or invalidations are not being received.
+        """
+        with self._lock:
+            if generation != self.generation or not self._listening:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time() + self.timeout)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys, publish=True):
+        """
+        Drops keys from the cache of this process, and from the caches of every other process if publish.
+        """
+        keys = list(keys)
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+        if publish and keys:
+            self.cache.publish(self.channel, json.dumps(keys))
+
+    def clear(self, publish=True):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+        if publish:
+            self.cache.publish(self.channel, json.dumps(ALL))
+
+    def hit_ratios(self):
+        """
+        Returns the ratio of reads served from this cache, per key family.
+        """
+        families = set(family for family, outcome in self.stats)
+        return dict(
+            (family, float(self.stats[(family, 'hits')]) /
+             (self.stats[(family, 'hits')] + self.stats[(family, 'misses')]))
+            for family in families
+        )
+
+    def stop(self):
+        """
+        Stops listening to invalidations, releasing the connection of the listener. As invalidations are no longer
+        received, nothing is cached anymore.
+        """
+        with self._lock:
+            self._stopped = True
+            self._listening = False
+            self._entries.clear()
+            pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            try:
+                pubsub.unsubscribe()  # ends the listener loop
+            except Exception:
+                pubsub.close()
+
+    def _ensure_listener(self):
+        # one listener thread per process (forked workers don't inherit the thread of their parent)
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._lock:
+            if self._pid == os.getpid() or self._stopped:
+                return
+            self._pid = os.getpid()
+            self._listening = False
+            self._entries.clear()
+            listener = Thread(target=self._listen, name='graph-local-cache-invalidations')
+            listener.daemon = True
+            listener.start()
+
+    def _listen(self):
+        while not self._stopped:
+            pubsub = None
+            try:
+                pubsub = self.cache.subscribe(self.channel)
+                with self._lock:
+                    if self._stopped:
+                        break
+                    self._pubsub = pubsub
+                    self._listening = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    keys = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+                    if keys == ALL:
+                        self.clear(publish=False)
+                    else:
+                        self.invalidate(keys, publish=False)
+            except Exception:
+                if self._stopped:
+                    break
+                # invalidations may have been lost while disconnected: serve nothing until subscribed again
+                self._listening = False
+                self.clear(publish=False)
+                sleep(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
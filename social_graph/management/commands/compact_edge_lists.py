@@ -0,0 +1,50 @@
+# coding=utf-8
+import re
+from django.core.management.base import NoArgsCommand
+
+COMPACT_MEMBER = re.compile(br'^\d+:')
+
+
+class Command(NoArgsCommand):
+    help = "Rewrites the cached edge lists, from pickled (node, attributes, time) members to compact node references."
+
+    def handle_noargs(self, **options):
+        from django.contrib.contenttypes.models import ContentType
+        from social_graph import Graph
+        from social_graph.api import EDGE_LIST_KEY_FORMAT
+        from social_graph.edge_list import encode_member
+
+        cache = Graph().cache
+        pattern = u'%s' % cache.make_key(EDGE_LIST_KEY_FORMAT.split(':', 1)[0] + ':*')
+
+        def edge_list_keys():
+            for shard in cache.shard_masters:
+                for key in shard.scan_iter(match=pattern):
+                    yield shard, key
+
+        rewritten = 0
+        for client, key in edge_list_keys():
+            members = []
+            for member, score in client.zrange(key, 0, -1, withscores=True):
+                if COMPACT_MEMBER.match(member):
+                    members.append((member, score))
+                    continue
+                node = cache.get_value(member)[0]
+                members.append((encode_member(ContentType.objects.get_for_model(node).pk, node.pk), score))
+
+            # build the new list aside, and swap it atomically (keeping the original expiration)
+            temp_key = key + b':compacting'
+            ttl = client.pttl(key)
+            transaction = client.pipeline()
+            transaction.delete(temp_key)
+            for member, score in members:
+                transaction.zadd(temp_key, member, score)
+            if members:
+                transaction.rename(temp_key, key)
+                if ttl and ttl > 0:
+                    transaction.pexpire(key, ttl)
+            else:
+                transaction.delete(key)
+            transaction.execute()
+            rewritten += 1
+        self.stdout.write("%d edge lists rewritten" % rewritten)
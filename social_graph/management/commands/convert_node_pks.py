@@ -0,0 +1,18 @@
+# coding=utf-8
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = "Converts the node pk columns of Edge and EdgeCount to the storage selected by GRAPH_NODE_PK_FIELD, after " \
+           "the setting was changed."
+
+    def handle_noargs(self, **options):
+        from django.db.transaction import atomic
+        from south.db import db
+        from social_graph.fields import NODE_PK_FIELD, convert_node_pk_columns
+
+        with atomic(using=db.db_alias):
+            converted = convert_node_pk_columns(db)
+        for table, column in converted:
+            self.stdout.write("%s.%s converted to %s" % (table, column, NODE_PK_FIELD))
+        self.stdout.write("%d node pk columns converted" % len(converted))
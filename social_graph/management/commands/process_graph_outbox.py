@@ -0,0 +1,29 @@
+# coding=utf-8
+from optparse import make_option
+from time import sleep
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Processes the deferred graph consistency tasks (symmetric edges and edge counters), in batches."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of tasks processed at once.'),
+        make_option('--interval', type='float', dest='interval', default=1,
+                    help='Seconds to wait when the outbox is empty.'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Process the tasks pending, and exit.'),
+    )
+
+    def handle(self, *args, **options):
+        from social_graph import outbox
+
+        processed = 0
+        while True:
+            count = outbox.process(options['batch_size'])
+            processed += count
+            if not count:
+                if options['once']:
+                    break
+                sleep(options['interval'])
+        self.stdout.write("%d tasks processed" % processed)
@@ -0,0 +1,20 @@
+# coding=utf-8
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+
+
+class Command(NoArgsCommand):
+    help = "Moves the keys of a sharded graph cache to the shards they are routed to, after servers were added."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--drop', action='store_true', dest='drop', default=False,
+                    help='Delete the misplaced keys instead of moving them (they are loaded again when missed).'),
+    )
+
+    def handle_noargs(self, **options):
+        from social_graph import Graph
+
+        cache = Graph().cache
+        if not hasattr(cache, 'rebalance'):
+            raise CommandError("The graph cache is not sharded (see social_graph.cache_backend.ShardedRedisCache)")
+        moved, dropped = cache.rebalance(drop=options['drop'])
+        self.stdout.write("%d keys moved, %d keys dropped" % (moved, dropped))
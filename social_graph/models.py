@@ -1,20 +1,124 @@
 # coding=utf-8
+from threading import local
+from time import time
+from django.conf import settings
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
+from django.core.signals import request_finished
 from django.db import models
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
-from .fields import JSONField
+from .fields import JSONField, node_pk_field
 from .consistency_enforcers import *
 
 
+# EDGE TYPES REGISTRY: every process caches all of the edge types and associations (types without association
+# included), and reloads them when the registry version, shared through the graph cache, changes: saving or deleting an
+# edge type or association bumps it. Processes check the version at most every REGISTRY_CHECK_INTERVAL seconds.
+REGISTRY_VERSION_KEY = getattr(settings, 'GRAPH_REGISTRY_VERSION_KEY', 'registry:version')
+REGISTRY_CHECK_INTERVAL = getattr(settings, 'GRAPH_REGISTRY_CHECK_INTERVAL', 1)
+
+
+class EdgeTypeRegistry(object):
+    _loaded = {}  # version loaded, per database
+    _checked = {}  # time of the last version check, per database
+    _state = local()
+
+    @classmethod
+    def ensure_loaded(cls, using):
+        """
+        Loads the whole registry of database using in the manager caches, unless the version loaded is current.
+        """
+        cls.bump_pending()
+        now = time()
+        if using in cls._loaded and now - cls._checked.get(using, 0) < REGISTRY_CHECK_INTERVAL:
+            return
+        version = cls._cache().get(REGISTRY_VERSION_KEY, 0)
+        cls._checked[using] = now
+        if cls._loaded.get(using) != version:
+            cls.load(using)
+            cls._loaded[using] = version
+
+    @staticmethod
+    def load(using):
+        edge_types = list(EdgeType._default_manager.db_manager(using).all())
+        associations = list(
+            EdgeTypeAssociation._default_manager.db_manager(using).select_related('direct', 'inverse')
+        )
+        EdgeType.objects.clear_cache(using)
+        EdgeTypeAssociation.objects.clear_cache(using)
+        for et in edge_types:
+            EdgeType.objects._add_to_cache(using, et)
+            # negative entries, overwritten by the associations
+            EdgeTypeAssociation.objects._add_negative_to_cache(using, et)
+        for eta in associations:
+            EdgeTypeAssociation.objects._add_to_cache(using, eta)
+
+    @classmethod
+    def changed(cls, using):
+        """
+        Reloads the registry of this process and bumps the shared version, so that every other process does. The
+        version is bumped again once the transaction is committed, not to let others reload uncommitted data only.
+        """
+        from django.db import connections, transaction
+
+        cls.invalidate(using)
+        cls._bump()
+        on_commit = getattr(transaction, 'on_commit', None)
+        if on_commit is not None:
+            on_commit(cls._bump, using=using)
+        elif connections[using].in_atomic_block:
+            # no commit hooks: bumped by the first registry access out of the transaction, or at the end of the request
+            cls._state.pending = getattr(cls._state, 'pending', set()) | {using}
+
+    @classmethod
+    def invalidate(cls, using=None):
+        if using is None:
+            cls._loaded.clear()
+        else:
+            cls._loaded.pop(using, None)
+
+    @classmethod
+    def bump_pending(cls):
+        """
+        Bumps the version for the changes this thread made in transactions now over (out of every atomic block).
+        """
+        from django.db import connections
+
+        pending = getattr(cls._state, 'pending', None)
+        if not pending:
+            return
+        over = set(using for using in pending if not connections[using].in_atomic_block)
+        if over:
+            cls._state.pending = pending - over
+            cls._bump()
+
+    @classmethod
+    def _bump(cls):
+        cache = cls._cache()
+        cache.add(REGISTRY_VERSION_KEY, 0, None)
+        cache.incr(REGISTRY_VERSION_KEY)
+
+    @staticmethod
+    def _cache():
+        from .api import Graph
+        return Graph().cache
+
+
+# noinspection PyUnusedLocal
+@receiver(request_finished, dispatch_uid='bump_edge_type_registry')
+def _bump_registry_on_request_finished(sender, **kwargs):
+    EdgeTypeRegistry.bump_pending()
+
+
 class EdgeTypeManager(models.Manager):
-    # Cache to avoid re-looking up EdgeType objects all over the place.
+    # Cache to avoid re-looking up EdgeType objects all over the place (the whole EdgeTypeRegistry).
     _cache = {}
 
     def get(self, *args, **kwargs):
+        EdgeTypeRegistry.ensure_loaded(self.db)
         et = None
         if 'id' in kwargs:
             try:
@@ -48,11 +152,15 @@ class EdgeTypeManager(models.Manager):
         except KeyError:
             pass
 
-    def clear_cache(self):
+    def clear_cache(self, using=None):
         """
-        Clear out the edge-type cache.
+        Clear out the edge-type cache (of database using, or all of them).
         """
-        self.__class__._cache.clear()
+        if using is None:
+            self.__class__._cache.clear()
+        else:
+            self.__class__._cache.pop(using, None)
+        EdgeTypeRegistry.invalidate(using)
 
 
 class EdgeType(models.Model):
@@ -84,6 +192,7 @@ class EdgeTypeAssociationManager(models.Manager):
     _inverse_cache = {}
 
     def get(self, *args, **kwargs):
+        EdgeTypeRegistry.ensure_loaded(self.db)
         eta = None
         if 'id' in kwargs:
             try:
@@ -101,19 +210,30 @@ class EdgeTypeAssociationManager(models.Manager):
         return eta
 
     def get_for_direct_edge_type(self, et):
-        try:
-            eta = self.__class__._direct_cache[self.db][et.id]
-        except KeyError:
-            eta = self.get(direct=et)
-            self._add_to_cache(self.db, eta)
-        return eta
+        return self._get_for_edge_type(self.__class__._direct_cache, 'direct', et)
 
     def get_for_inverse_edge_type(self, et):
+        return self._get_for_edge_type(self.__class__._inverse_cache, 'inverse', et)
+
+    def _get_for_edge_type(self, cache, field, et):
+        """
+        Returns the association of et as field (direct or inverse), raises DoesNotExist if it has none. Edge types
+        without association have negative entries in the cache, so that they don't hit the database either.
+        """
+        EdgeTypeRegistry.ensure_loaded(self.db)
         try:
-            eta = self.__class__._inverse_cache[self.db][et.id]
+            eta = cache[self.db][et.id]
         except KeyError:
-            eta = self.get(inverse=et)
-            self._add_to_cache(self.db, eta)
+            try:
+                eta = self.get(**{field: et})
+                self._add_to_cache(self.db, eta)
+            except self.model.DoesNotExist:
+                cache.setdefault(self.db, {})[et.id] = None
+                raise
+        if eta is None:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % self.model._meta.object_name
+            )
         return eta
 
     def _add_to_cache(self, using, eta):
@@ -121,6 +241,10 @@ class EdgeTypeAssociationManager(models.Manager):
         self.__class__._direct_cache.setdefault(using, {})[eta.direct.id] = eta
         self.__class__._inverse_cache.setdefault(using, {})[eta.inverse.id] = eta
 
+    def _add_negative_to_cache(self, using, et):
+        self.__class__._direct_cache.setdefault(using, {})[et.id] = None
+        self.__class__._inverse_cache.setdefault(using, {})[et.id] = None
+
     def rem_from_cache(self, using, eta):
         try:
             del self.__class__._cache.setdefault(using, {})[eta.id]
@@ -129,11 +253,16 @@ class EdgeTypeAssociationManager(models.Manager):
         except KeyError:
             pass
 
-    def clear_cache(self):
+    def clear_cache(self, using=None):
         """
-        Clear out the edge-type-association cache.
+        Clear out the edge-type-association cache (of database using, or all of them).
         """
-        self.__class__._cache.clear()
+        for cache in (self.__class__._cache, self.__class__._direct_cache, self.__class__._inverse_cache):
+            if using is None:
+                cache.clear()
+            else:
+                cache.pop(using, None)
+        EdgeTypeRegistry.invalidate(using)
 
 
 class EdgeTypeAssociation(models.Model):
@@ -158,14 +287,14 @@ class Edge(models.Model):
     fromNode_type = models.ForeignKey(ContentType,
                                       verbose_name=_(u'from node type'),
                                       related_name="from_node_type_set_for_%(class)s")
-    fromNode_pk = models.TextField(_(u'fromNode ID'))
+    fromNode_pk = node_pk_field(_(u'fromNode ID'))
     fromNode = generic.GenericForeignKey(ct_field="fromNode_type", fk_field="fromNode_pk")
 
     # toNode field
     toNode_type = models.ForeignKey(ContentType,
                                     verbose_name=_(u'to node type'),
                                     related_name="to_node_type_set_for_%(class)s")
-    toNode_pk = models.TextField(_(u'toNode ID'))
+    toNode_pk = node_pk_field(_(u'toNode ID'))
     toNode = generic.GenericForeignKey(ct_field="toNode_type", fk_field="toNode_pk")
 
     # edge attributes
@@ -182,6 +311,10 @@ class Edge(models.Model):
 
     class Meta(object):
         unique_together = ['fromNode_type', 'fromNode_pk', 'toNode_type', 'toNode_pk', 'type', 'site']
+        index_together = [
+            ['fromNode_type', 'fromNode_pk', 'type', 'site', 'time'],
+            ['toNode_type', 'toNode_pk', 'type', 'site', 'time']
+        ]
         ordering = ['-time']
 
     def __unicode__(self):
@@ -204,7 +337,7 @@ class EdgeCount(models.Model):
     # fromNode field
     fromNode_type = models.ForeignKey(ContentType,
                                       verbose_name=_(u'from node type'))
-    fromNode_pk = models.TextField(_(u'fromNode ID'))
+    fromNode_pk = node_pk_field(_(u'fromNode ID'))
     fromNode = generic.GenericForeignKey(ct_field="fromNode_type", fk_field="fromNode_pk")
 
     # edge attributes
@@ -237,6 +370,17 @@ def pre_save_count_handler(instance, **kwargs):
         instance.site = getattr(instance.fromNode, 'site', Site.objects.get_current())
 
 
+# KEEP THE EDGE TYPES REGISTRY COHERENT ACROSS PROCESSES
+
+# noinspection PyUnusedLocal
+@receiver(models.signals.post_save, sender=EdgeType, dispatch_uid='edge_type_saved')
+@receiver(models.signals.post_delete, sender=EdgeType, dispatch_uid='edge_type_deleted')
+@receiver(models.signals.post_save, sender=EdgeTypeAssociation, dispatch_uid='edge_type_association_saved')
+@receiver(models.signals.post_delete, sender=EdgeTypeAssociation, dispatch_uid='edge_type_association_deleted')
+def registry_changed(sender, instance, using, **kwargs):
+    EdgeTypeRegistry.changed(using)
+
+
 # CONNECT LISTENERS TO ENFORCE GRAPH CONSISTENCY
 
 models.signals.post_save.connect(
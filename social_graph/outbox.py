@@ -0,0 +1,198 @@
+# coding=utf-8
+"""
+Deferred consistency enforcement: with GRAPH_DEFERRED_CONSISTENCY on, the symmetric edges and edge counters of the edges
+created or deleted by edge() and no_edge() are not maintained in the request path, but queued in an outbox (a Redis
+list in the graph cache) and processed in batches by the process_graph_outbox management command.
+
+Tasks are idempotent: they re-check the database when processed, so they can be repeated, and the ones queued by
+transactions rolled back do nothing.
+"""
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import reduce
+from operator import or_
+from threading import local
+from django.conf import settings
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+DEFERRED_CONSISTENCY = getattr(settings, 'GRAPH_DEFERRED_CONSISTENCY', False)
+OUTBOX_KEY = getattr(settings, 'GRAPH_OUTBOX_KEY', 'outbox')
+
+# TASKS
+COUNT = 'count'  # (ctype_id, pk, etype_id, site_id): recount the edges of a node
+SYMMETRIC_ADD = 'symmetric_add'  # (ctype1_id, pk1, ctype2_id, pk2, etype_id, site_id): create the symmetric edge
+SYMMETRIC_DELETE = 'symmetric_delete'  # (ctype1_id, pk1, ctype2_id, pk2, etype_id, site_id): delete it
+
+_state = local()
+
+
+def _pending():
+    if not hasattr(_state, 'pending'):
+        _state.pending = []
+    return _state.pending
+
+
+def deferred():
+    """
+    Tells whether consistency enforcement is deferred (it is not while processing the outbox).
+    """
+    return DEFERRED_CONSISTENCY and not getattr(_state, 'immediate', False)
+
+
+@contextmanager
+def immediate():
+    """
+    Runs consistency enforcement synchronously in the block, deferred mode or not.
+    """
+    previous = getattr(_state, 'immediate', False)
+    _state.immediate = True
+    try:
+        yield
+    finally:
+        _state.immediate = previous
+
+
+def enqueue(task, *args):
+    """
+    Queues a task, to be pushed to the outbox once the current transaction is committed.
+    """
+    from django.db import connection, transaction
+
+    _pending().append(json.dumps([task] + [u'%s' % arg for arg in args]))
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(flush)  # per task: the first one to run pushes them all, and the hooks rolled back are dropped
+    elif not connection.in_atomic_block:
+        flush()
+    # else (no commit hooks): flushed once out of the transaction (see atomic()), or at the end of the request
+
+
+def flush():
+    """
+    Pushes the tasks queued by this thread to the outbox, in one round trip.
+    """
+    from .api import Graph
+
+    pending = _pending()
+    if pending:
+        Graph().cache.push_to_list(OUTBOX_KEY, list(pending))
+        del pending[:]
+
+
+@contextmanager
+def atomic():
+    """
+    Runs the block in a transaction, pushing the tasks queued to the outbox once out of every transaction, or dropping
+    the tasks queued by the block if it is rolled back.
+    """
+    from django.db import connection, transaction
+
+    pending = _pending()
+    queued = len(pending)
+    try:
+        with transaction.atomic():
+            yield
+    except Exception:
+        del pending[queued:]
+        raise
+    if not connection.in_atomic_block:
+        flush()
+
+
+# noinspection PyUnusedLocal
+@receiver(request_finished, dispatch_uid='flush_graph_outbox')
+def _flush_on_request_finished(sender, **kwargs):
+    flush()
+
+
+def process(batch_size=500):
+    """
+    Pops up to batch_size tasks from the outbox and processes them. Returns the number of tasks processed.
+    """
+    from .api import Graph
+
+    tasks = Graph().cache.pop_from_list(OUTBOX_KEY, batch_size)
+    by_type = defaultdict(set)
+    for task in tasks:
+        task = json.loads(task.decode('utf-8') if isinstance(task, bytes) else task)
+        by_type[task[0]].add(tuple(task[1:]))
+    with immediate():
+        for identity in by_type[SYMMETRIC_ADD]:
+            _ensure_symmetric_edge(*identity)
+        for identity in by_type[SYMMETRIC_DELETE]:
+            _ensure_no_symmetric_edge(*identity)
+        _recount(by_type[COUNT])
+    return len(tasks)
+
+
+def _edges(ctype1, pk1, ctype2, pk2, etype, site):
+    from .models import Edge
+
+    return Edge.objects.filter(
+        fromNode_type_id=ctype1, fromNode_pk=pk1, toNode_type_id=ctype2, toNode_pk=pk2, type_id=etype, site_id=site
+    )
+
+
+def _ensure_symmetric_edge(ctype1, pk1, ctype2, pk2, etype, site):
+    from .api import Graph
+
+    edge = _edges(ctype1, pk1, ctype2, pk2, etype, site).select_related('type', 'site').first()
+    if edge is None or edge.auto:
+        return
+    symmetric_type = Graph._inverse_type(edge.type)
+    if symmetric_type is None or _edges(ctype2, pk2, ctype1, pk1, symmetric_type.pk, site).exists():
+        return
+    if edge.fromNode is not None and edge.toNode is not None:
+        Graph()._add(edge.toNode, edge.fromNode, symmetric_type, edge.site, edge.attributes, auto=True)
+
+
+def _ensure_no_symmetric_edge(ctype1, pk1, ctype2, pk2, etype, site):
+    from django.contrib.sites.models import Site
+    from .api import Graph
+    from .edge_list import load_nodes
+    from .models import EdgeType
+
+    if _edges(ctype1, pk1, ctype2, pk2, etype, site).exists():
+        return  # created again meanwhile
+    symmetric_type = Graph._inverse_type(EdgeType.objects.get(pk=int(etype)))
+    if symmetric_type is None:
+        return
+    nodes = load_nodes([(int(ctype1), pk1), (int(ctype2), pk2)])
+    from_node, to_node = nodes.get((int(ctype1), pk1)), nodes.get((int(ctype2), pk2))
+    if from_node is not None and to_node is not None:
+        Graph()._delete(to_node, from_node, symmetric_type, Site.objects.get(pk=site))
+
+
+def _recount(identities):
+    """
+    Sets the EdgeCount (and cached count) of each (ctype_id, pk, etype_id, site_id) to its number of edges, with one
+    grouped query per chunk of identities.
+    """
+    from django.db.models import Count, Q
+    from .api import Graph, chunks
+    from .models import Edge, EdgeCount
+
+    graph = Graph()
+    for chunk in chunks(identities):
+        counts = dict(((ctype, pk, etype, site), 0) for ctype, pk, etype, site in chunk)
+        edges = Edge.objects.filter(reduce(or_, [
+            Q(fromNode_type_id=ctype, fromNode_pk=pk, type_id=etype, site_id=site) for ctype, pk, etype, site in chunk
+        ])).order_by().values_list('fromNode_type_id', 'fromNode_pk', 'type_id', 'site_id').annotate(Count('id'))
+        for ctype, pk, etype, site, count in edges:
+            counts[(u'%s' % ctype, u'%s' % pk, u'%s' % etype, u'%s' % site)] = count
+
+        missing = []
+        for (ctype, pk, etype, site), count in counts.items():
+            updated = EdgeCount.objects.filter(
+                fromNode_type_id=ctype, fromNode_pk=pk, type_id=etype, site_id=site
+            ).update(count=count)
+            if not updated and count:
+                missing.append(
+                    EdgeCount(fromNode_type_id=ctype, fromNode_pk=pk, type_id=etype, site_id=site, count=count)
+                )
+        EdgeCount.objects.bulk_create(missing)
+        cached_counts = dict((graph._count_key(*identity), count) for identity, count in counts.items())
+        graph.cache.set_many(cached_counts, graph._timeout('count'))
+        graph._invalidate_local(cached_counts)
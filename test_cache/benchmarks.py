@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backend benchmarks. They are not collected by the default test discovery, run them explicitly:
+
+    python manage.py test test_cache.benchmarks
+"""
+from time import time
+from django.core.cache import get_cache
+from django.test import TestCase
+from social_graph.cache_backend import ExtendedRedisCache, RedisPipeline
+
+
+class PipelineBenchmark(TestCase):
+    iterations = 5000
+
+    def setUp(self):
+        self.cache = get_cache('default')
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def report(self, name, elapsed):
+        print("\n%s: %d pipelines in %.2fs (%.1f us/pipeline)" % (
+            name, self.iterations, elapsed, elapsed * 1000000 / self.iterations
+        ))
+
+    def test_new_cache_per_pipeline(self):
+        # what pipeline() used to do: build a whole new cache (clients, pools lookup, serializer...) every time
+        start = time()
+        for i in range(self.iterations):
+            pipeline = RedisPipeline(ExtendedRedisCache(self.cache.server, self.cache.params))
+            pipeline.set('key', i)
+            pipeline.execute()
+        self.report("new cache per pipeline", time() - start)
+
+    def test_borrowed_pipeline(self):
+        start = time()
+        for i in range(self.iterations):
+            pipeline = self.cache.pipeline()
+            pipeline.set('key', i)
+            pipeline.execute()
+        self.report("pipeline()", time() - start)
@@ -24,6 +24,20 @@ CACHES = {
             }
         },
     },
+    # three databases of the local server, standing in for the servers of a sharded cache
+    'sharded': {
+        'BACKEND': 'social_graph.cache_backend.ShardedRedisCache',
+        'LOCATION': ['redis://127.0.0.1:6379/11', 'redis://127.0.0.1:6379/12', 'redis://127.0.0.1:6379/13'],
+    },
+    # two databases of the local server, the second one standing in for a replica (that never gets the writes)
+    'replicated': {
+        'BACKEND': 'social_graph.cache_backend.ExtendedRedisCache',
+        'LOCATION': ['redis://127.0.0.1:6379/14', 'redis://127.0.0.1:6379/15'],
+        'OPTIONS': {
+            'MASTER_CACHE': 'redis://127.0.0.1:6379/14',
+            'READ_YOUR_WRITES_WINDOW': 0.5,
+        },
+    },
 }
 
 ROOT_URLCONF = 'test_cache.urls'
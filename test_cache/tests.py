@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import time
+from threading import Thread
 
 try:
     import cPickle as pickle
@@ -20,6 +21,7 @@ from test_cache.models import Poll, expensive_calculation
 import redis
 from redis.connection import UnixDomainSocketConnection
 from redis_cache.cache import RedisCache, ImproperlyConfigured, pool
+from social_graph.cache_backend import ExtendedRedisCache, ShardedRedisCache, routing_key
 
 
 # functions/classes for complex data type test_graph
@@ -416,6 +418,278 @@ class RedisCacheTests(TestCase):
         pipeline.execute()
         self.assertEqual(self.cache.get(key).question, poll.question)
 
+    def test_update_graph(self):
+        # counters and sorted sets are only updated when they are cached
+        self.cache.update_graph('edge1', 'value1', counters={'count': 1}, sorted_set_adds=[('list', 'member1', 1)])
+        self.assertEqual(self.cache.get('edge1'), 'value1')
+        self.assertFalse(self.cache.has_key('count'))
+        self.assertFalse(self.cache.has_key('list'))
+
+        self.cache.set('count', 1)
+        self.cache.add_member_to_sorted_set('list', 'member0', 0)
+        self.cache.update_graph('edge2', 'value2', counters={'count': 1}, sorted_set_adds=[('list', 'member2', 2)])
+        self.assertEqual(self.cache.get('edge2'), 'value2')
+        self.assertEqual(self.cache.get('count'), 2)
+        self.assertEqual(self.cache.sorted_set_rev_range_with_scores('list', 0, 10),
+                         [(b'member2', 2.0), (b'member0', 0.0)])
+
+        self.cache.set('other', 'value')
+        self.cache.update_graph('edge2', None, counters={'count': -1}, sorted_set_rems=[('list', 'member2')],
+                                invalidate=['other'])
+        self.assertFalse(self.cache.has_key('edge2'))
+        self.assertEqual(self.cache.get('count'), 1)
+        self.assertEqual(self.cache.sorted_set_rev_range_with_scores('list', 0, 10), [(b'member0', 0.0)])
+        self.assertFalse(self.cache.has_key('other'))
+
+        # touched keys get the expiration of the sorted sets
+        self.cache.set('state', 'value', None)
+        self.cache.update_graph(None, None, sorted_set_adds=[('list', 'member3', 3)], touch=['state'],
+                                sorted_sets_timeout=100)
+        self.assertTrue(0 < self.cache.master_client.ttl(self.cache.make_key('state')) <= 100)
+
+    def test_update_graph_in_pipeline(self):
+        self.cache.set('count', 0)
+        pipeline = self.cache.pipeline()
+        pipeline.update_graph('edge1', 'value1', counters={'count': 1})
+        pipeline.update_graph('edge2', 'value2', counters={'count': 1})
+        self.assertEqual(self.cache.get('count'), 0)
+        pipeline.execute()
+        self.assertEqual(self.cache.get('count'), 2)
+        self.assertEqual(self.cache.get_many(['edge1', 'edge2']), {'edge1': 'value1', 'edge2': 'value2'})
+
+    def test_pipeline_reuses_connection_pool(self):
+        pipeline = self.cache.pipeline()
+        self.assertIs(pipeline.master_client.connection_pool, self.cache.master_client.connection_pool)
+        self.assertIs(pipeline.clients, self.cache.clients)
+        pipeline.add_to_sorted_set("key", "object", 1)
+        pipeline.rem_from_sorted_set("key", "object")
+        pipeline.add_to_sorted_set("key", "object2", 2)
+        self.assertEqual(self.cache.sorted_set_count("key"), 0)
+        pipeline.execute()
+        self.assertEqual(self.cache.sorted_set_range("key", 0, 10), ["object2"])
+
+    def test_replace_sorted_set(self):
+        self.cache.add_member_to_sorted_set('list', 'member0', 0)
+        self.assertTrue(self.cache.replace_sorted_set('list', lambda: [('member1', 1), ('member2', 2)], timeout=100))
+        self.assertEqual(self.cache.sorted_set_rev_range_with_scores('list', 0, 10),
+                         [(b'member2', 2.0), (b'member1', 1.0)])
+        self.assertTrue(0 < self.cache.master_client.ttl(self.cache.make_key('list')) <= 100)
+
+        # written while loaded: left as it is
+        def load():
+            self.cache.add_member_to_sorted_set('list', 'member3', 3)
+            return [('member1', 1)]
+        self.assertFalse(self.cache.replace_sorted_set('list', load))
+        self.assertEqual(self.cache.sorted_set_count('list'), 3)
+
+        self.assertTrue(self.cache.replace_sorted_set('list', lambda: []))
+        self.assertFalse(self.cache.has_key('list'))
+
+    def test_locks(self):
+        token = self.cache.acquire_lock('lock', 10)
+        self.assertTrue(token)
+        self.assertIsNone(self.cache.acquire_lock('lock', 10))
+        self.assertFalse(self.cache.release_lock('lock', 'not the token'))
+        self.assertFalse(self.cache.wait_for_lock('lock', 0.05))
+        self.assertTrue(self.cache.release_lock('lock', token))
+        self.assertTrue(self.cache.wait_for_lock('lock', 0.05))
+        self.assertTrue(self.cache.acquire_lock('lock', 10))
+
+    def test_sorted_set_timeouts(self):
+        self.cache.add_to_sorted_set("key", "object", 1, timeout=100)
+        self.cache.add_member_to_sorted_set("key2", "member", 1, timeout=None)
+        self.assertTrue(0 < self.cache.master_client.ttl(self.cache.make_key("key")) <= 100)
+        self.assertIn(self.cache.master_client.ttl(self.cache.make_key("key2")), (None, -1))
+
+        # sliding expiration
+        self.cache.master_client.expire(self.cache.make_key("key"), 10)
+        self.assertEqual(self.cache.sorted_set_rev_range("key", 0, 10, touch=100), ["object"])
+        self.assertTrue(10 < self.cache.master_client.ttl(self.cache.make_key("key")) <= 100)
+        self.cache.set("value", 1, 10)
+        self.assertEqual(self.cache.get_and_touch("value", 100), 1)
+        self.assertTrue(10 < self.cache.master_client.ttl(self.cache.make_key("value")) <= 100)
+
+    def test_update_graph_timeouts(self):
+        self.cache.set('count', 0)
+        self.cache.add_member_to_sorted_set('list', 'member', 1)
+        self.cache.update_graph(
+            'edge', 'value', counters={'count': 1}, sorted_set_adds=[('list', 'member2', 2)],
+            timeout=100, counters_timeout=200, sorted_sets_timeout=300
+        )
+        ttl = lambda key: self.cache.master_client.ttl(self.cache.make_key(key))
+        self.assertTrue(0 < ttl('edge') <= 100)
+        self.assertTrue(100 < ttl('count') <= 200)
+        self.assertTrue(200 < ttl('list') <= 300)
+
+
+class ShardedRedisCacheTests(TestCase):
+    """
+    Sharded cache, over three databases of the local server standing in for three Redis servers.
+    """
+    def setUp(self):
+        self.cache = get_cache('sharded')
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def shards_of(self, key):
+        # indexes of the shards holding key
+        key = self.cache.make_key(key)
+        return [i for i, client in enumerate(self.cache.shard_masters) if client.exists(key)]
+
+    def tags_in_two_shards(self):
+        tags = ['7:%d' % i for i in range(100)]
+        first = self.cache.master_for(tags[0])
+        return tags[0], next(tag for tag in tags if self.cache.master_for(tag) is not first)
+
+    def test_routing(self):
+        data = dict(('key%d' % i, i) for i in range(100))
+        self.cache.set_many(data)
+        self.assertEqual(self.cache.get_many(list(data)), data)
+        self.assertEqual(self.cache.has_keys(list(data) + ['missing']), set(data))
+        # every key lives in one shard, and every shard gets keys
+        shards = [self.shards_of(key) for key in data]
+        self.assertTrue(all(len(key_shards) == 1 for key_shards in shards))
+        self.assertEqual(set(key_shards[0] for key_shards in shards), set(range(3)))
+        self.cache.touch_many(list(data), 100)
+        for key in data:
+            key = self.cache.make_key(key)
+            self.assertTrue(0 < self.cache.master_for(key).ttl(key) <= 100)
+        self.cache.delete_many(list(data))
+        self.assertEqual(self.cache.get_many(list(data)), {})
+
+        # keys with the same hash tag live in the same shard
+        for i in range(20):
+            keys = ['count:{7:%d}:1:1' % i, 'elist:{7:%d}:1:1' % i, 'edge:{7:%d}:1:8:3:1' % i]
+            self.assertEqual(routing_key(keys[0]), '7:%d' % i)
+            self.cache.set_many(dict((key, 1) for key in keys))
+            self.assertEqual(len(set(self.shards_of(key)[0] for key in keys)), 1)
+
+    def test_update_graph_across_shards(self):
+        a, b = self.tags_in_two_shards()
+        self.cache.set('count:{%s}' % a, 1)
+        self.cache.set('icount:{%s}' % b, 1)
+        self.cache.add_member_to_sorted_set('ielist:{%s}' % b, 'member0', 0)
+        self.cache.set('estate:{%s}' % b, 'state')
+        self.cache.update_graph(
+            'edge:{%s}:1' % a, 'value', counters={'count:{%s}' % a: 1, 'icount:{%s}' % b: 1},
+            sorted_set_adds=[('ielist:{%s}' % b, 'member1', 1)], invalidate=['estate:{%s}' % b]
+        )
+        self.assertEqual(self.cache.get('edge:{%s}:1' % a), 'value')
+        self.assertEqual(self.cache.get_many(['count:{%s}' % a, 'icount:{%s}' % b]),
+                         {'count:{%s}' % a: 2, 'icount:{%s}' % b: 2})
+        self.assertEqual(self.cache.sorted_set_rev_range_with_scores('ielist:{%s}' % b, 0, 10),
+                         [(b'member1', 1.0), (b'member0', 0.0)])
+        self.assertFalse(self.cache.has_key('estate:{%s}' % b))
+        self.assertEqual(self.shards_of('edge:{%s}:1' % a), self.shards_of('count:{%s}' % a))
+        self.assertNotEqual(self.shards_of('count:{%s}' % a), self.shards_of('icount:{%s}' % b))
+
+    def test_pipeline_across_shards(self):
+        a, b = self.tags_in_two_shards()
+        self.cache.set('count:{%s}' % b, 0)
+        pipeline = self.cache.pipeline()
+        pipeline.set('edge:{%s}:1' % a, 'value')
+        pipeline.update_graph('edge:{%s}:2' % a, 'value2', counters={'count:{%s}' % b: 1})
+        self.assertFalse(self.cache.has_key('edge:{%s}:1' % a))
+        self.assertEqual(self.cache.get('count:{%s}' % b), 0)
+        pipeline.execute()
+        self.assertEqual(self.cache.get_many(['edge:{%s}:1' % a, 'edge:{%s}:2' % a]),
+                         {'edge:{%s}:1' % a: 'value', 'edge:{%s}:2' % a: 'value2'})
+        self.assertEqual(self.cache.get('count:{%s}' % b), 1)
+
+    def test_sorted_sets_across_shards(self):
+        a, b = self.tags_in_two_shards()
+        for key, members in [('elist:{%s}' % a, [('m1', 1), ('m2', 2), ('m3', 3)]),
+                             ('elist:{%s}:2' % a, [('m2', 5), ('m3', 1), ('m4', 4)]),
+                             ('elist:{%s}' % b, [('m2', 5), ('m3', 1), ('m4', 4)])]:
+            for member, score in members:
+                self.cache.add_member_to_sorted_set(key, member, score)
+        # intersected by the server when in the same shard, or here, with the same result
+        expected = [(b'm2', 5.0), (b'm3', 3.0)]
+        self.assertEqual(self.cache.intersect_sorted_sets(['elist:{%s}' % a, 'elist:{%s}:2' % a], 0, -1), expected)
+        self.assertEqual(self.cache.intersect_sorted_sets(['elist:{%s}' % a, 'elist:{%s}' % b], 0, -1), expected)
+        self.assertEqual(self.cache.intersect_sorted_sets(['elist:{%s}' % a, 'elist:{%s}' % b], 1, 1), expected[1:])
+        self.assertEqual(
+            self.cache.sorted_sets_rev_range_by_score_with_scores(
+                ['elist:{%s}' % b, 'missing', 'elist:{%s}' % a], 0, 10, num=1
+            ),
+            [[(b'm2', 5.0)], None, [(b'm3', 3.0)]]
+        )
+
+    def test_rebalance(self):
+        # keys written through a ring of two of the servers
+        old = ShardedRedisCache(self.cache.servers[:2], {})
+        data = dict(('count:{7:%d}:1:1' % i, i) for i in range(200))
+        old.set_many(data, timeout=1000)
+        old_nodes = dict((key, old.ring.get_node(routing_key(key))) for key in data)
+        new_nodes = dict((key, self.cache.ring.get_node(routing_key(key))) for key in data)
+        new_server = set(self.cache.clients) - set(old.clients)
+        # consistent hashing: keys only move to the server added
+        misplaced = [key for key in data if new_nodes[key] != old_nodes[key]]
+        self.assertTrue(misplaced)
+        self.assertTrue(all(new_nodes[key] in new_server for key in misplaced))
+
+        # a key written to its new shard before the rebalance is kept
+        self.cache.set(misplaced[0], 'new')
+        self.assertEqual(self.cache.rebalance(), (len(misplaced) - 1, 1))
+        data[misplaced[0]] = 'new'
+        self.assertEqual(self.cache.get_many(list(data)), data)
+        self.assertTrue(all(len(self.shards_of(key)) == 1 for key in data))
+        self.assertTrue(0 < self.cache.ttl(misplaced[1]) <= 1000)
+        self.assertEqual(self.cache.rebalance(), (0, 0))
+
+        old.set_many(dict((key, 0) for key in misplaced))
+        self.assertEqual(self.cache.rebalance(drop=True), (0, len(misplaced)))
+        self.assertEqual(self.cache.get_many(list(data)), data)
+
+
+class ReadYourWritesTests(TestCase):
+    """
+    Cache over a master and a replica that never gets the writes (two databases of the local server).
+    """
+    def setUp(self):
+        self.cache = get_cache('replicated')
+
+    def tearDown(self):
+        for client in self.cache.client_list:
+            client.flushdb()
+
+    def redirected(self):
+        return ExtendedRedisCache.read_stats['redirected']
+
+    def test_read_your_writes(self):
+        redirected = self.redirected()
+        self.cache.set('key', 'value')
+        self.cache.add_member_to_sorted_set('list', 'member', 1)
+        pipeline = self.cache.pipeline()
+        pipeline.update_graph('edge', 'value', sorted_set_adds=[('list', 'member2', 2)])
+        pipeline.execute()
+
+        # the keys written by this thread are read from the master
+        for i in range(20):
+            self.assertEqual(self.cache.get('key'), 'value')
+            self.assertEqual(self.cache.get('edge'), 'value')
+            self.assertEqual(self.cache.sorted_set_rev_range_with_scores('list', 0, 10),
+                             [(b'member2', 2.0), (b'member', 1.0)])
+        self.assertEqual(self.redirected() - redirected, 60)
+
+        # other keys, and keys written by other threads, are read from any server
+        thread = Thread(target=self.cache.set, args=('other', 'value'))
+        thread.start()
+        thread.join()
+        self.assertEqual(set(self.cache.get('other') for i in range(50)), {'value', None})
+        self.assertEqual(self.redirected() - redirected, 60)
+
+        # once the window is over
+        time.sleep(0.6)
+        self.assertEqual(set(self.cache.get('key') for i in range(50)), {'value', None})
+        self.assertEqual(self.redirected() - redirected, 60)
+
+    def test_without_replicas(self):
+        self.assertEqual(get_cache('default').read_your_writes_window, 0)
+        self.assertEqual(get_cache('sharded').read_your_writes_window, 0)
+        self.assertEqual(self.cache.read_your_writes_window, 0.5)
+
 
 if __name__ == '__main__':
     import unittest
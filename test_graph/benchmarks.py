@@ -0,0 +1,310 @@
+# coding=utf-8
+"""
+Graph api benchmarks. They are not collected by the default test discovery, run them explicitly:
+
+    python manage.py test test_graph.benchmarks
+"""
+import os
+from datetime import timedelta
+from time import time
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from social_graph import api, outbox
+from social_graph.api import Graph, TO_NODE
+from social_graph.fields import NODE_PK_FIELD
+from social_graph.models import EdgeType, EdgeTypeAssociation, Edge
+
+
+class GraphBenchmark(TestCase):
+    nodes = 50
+
+    def setUp(self):
+        self.graph = Graph()
+        self.graph.clear_cache()
+        self.site = Site.objects.get_current()
+        self.users = [User.objects.create(username="user%d" % i) for i in range(self.nodes)]
+        self.groups = [Group.objects.create(name="group%d" % i) for i in range(self.nodes)]
+        self.like = EdgeType.objects.create(name="Like", read_as="likes")
+        self.liked_by = EdgeType.objects.create(name="Liked By", read_as="is liked by")
+        EdgeTypeAssociation.objects.create(direct=self.like, inverse=self.liked_by)
+
+    def edge_rows(self):
+        return [(user, group, self.like, self.site) for user in self.users for group in self.groups]
+
+    @staticmethod
+    def report(name, count, elapsed):
+        print("\n%s: %d edges in %.2fs (%.0f edges/sec)" % (name, count, elapsed, count / elapsed))
+
+
+class EdgesBulkBenchmark(GraphBenchmark):
+
+    def test_edge_per_edge(self):
+        rows = self.edge_rows()
+        start = time()
+        for from_node, to_node, etype, site in rows:
+            self.graph.edge(from_node, to_node, etype, site)
+        self.report("edge()", len(rows), time() - start)
+
+    def test_edges_bulk(self):
+        rows = self.edge_rows()
+        start = time()
+        self.graph.edges_bulk(rows)
+        self.report("edges_bulk()", len(rows), time() - start)
+
+    def test_no_edge_per_edge(self):
+        rows = self.edge_rows()
+        self.graph.edges_bulk(rows)
+        start = time()
+        for from_node, to_node, etype, site in rows:
+            self.graph.no_edge(from_node, to_node, etype, site)
+        self.report("no_edge()", len(rows), time() - start)
+
+    def test_no_edges_bulk(self):
+        rows = self.edge_rows()
+        self.graph.edges_bulk(rows)
+        start = time()
+        self.graph.no_edges_bulk(rows)
+        self.report("no_edges_bulk()", len(rows), time() - start)
+
+
+class DeferredConsistencyBenchmark(GraphBenchmark):
+    """
+    Write latency seen by the request path, with consistency enforcers run synchronously or deferred to the outbox.
+    """
+
+    def run_edges(self, name):
+        rows = self.edge_rows()[:500]
+        start = time()
+        for from_node, to_node, etype, site in rows:
+            self.graph.edge(from_node, to_node, etype, site)
+        elapsed = time() - start
+        print("\n%s: %.2f ms/edge" % (name, elapsed * 1000 / len(rows)))
+        return rows
+
+    def test_immediate(self):
+        self.run_edges("edge(), immediate consistency")
+
+    def test_deferred(self):
+        deferred = outbox.DEFERRED_CONSISTENCY
+        outbox.DEFERRED_CONSISTENCY = True
+        try:
+            rows = self.run_edges("edge(), deferred consistency")
+            outbox.flush()
+            start = time()
+            while outbox.process():
+                pass
+            self.report("outbox processing", len(rows), time() - start)
+        finally:
+            outbox.DEFERRED_CONSISTENCY = deferred
+
+
+class LocalCacheBenchmark(GraphBenchmark):
+    """
+    Read latency percentiles of a hot node, with and without the in-process cache (GRAPH_LOCAL_CACHE).
+    """
+    iterations = 5000
+
+    def setUp(self):
+        super(LocalCacheBenchmark, self).setUp()
+        self.graph.edges_bulk(self.edge_rows()[:self.nodes])
+
+    def run_reads(self, name):
+        user, group = self.users[0], self.groups[0]
+        reads = [
+            lambda: self.graph.edge_count(user, self.like, self.site),
+            lambda: self.graph.edge_get(user, self.like, group, self.site),
+            lambda: self.graph.edge_range(user, self.like, 0, 19, self.site),
+        ]
+        latencies = []
+        for i in range(self.iterations):
+            read = reads[i % len(reads)]
+            start = time()
+            read()
+            latencies.append(time() - start)
+        latencies.sort()
+        print("\n%s: p50 %.3f ms, p99 %.3f ms" % (
+            name, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+        ))
+
+    def test_graph_cache(self):
+        self.run_reads("graph cache")
+
+    def test_local_cache(self):
+        local_cache = api.LOCAL_CACHE
+        api.LOCAL_CACHE = {'size': 10000, 'timeout': 5}
+        try:
+            self.run_reads("local cache")
+            print("hit ratios: %s" % ', '.join(
+                '%s %.2f' % item for item in sorted(self.graph._local().hit_ratios().items())
+            ))
+        finally:
+            api.LOCAL_CACHE = local_cache
+            Graph.stop_local_caches()
+
+
+class NeighborhoodBenchmark(GraphBenchmark):
+    """
+    2 edges away neighborhood of a node (the users liking the groups a user likes), with nested edge_range() calls
+    or with neighborhood().
+    """
+
+    def setUp(self):
+        super(NeighborhoodBenchmark, self).setUp()
+        self.graph.edges_bulk(self.edge_rows())
+
+    def nested_edge_range(self):
+        neighbors = set()
+        for group in self.graph.edge_range(self.users[0], self.like, 0, self.nodes, self.site):
+            neighbors.add(group[TO_NODE])
+            for user in self.graph.edge_range(group[TO_NODE], self.liked_by, 0, self.nodes, self.site):
+                neighbors.add(user[TO_NODE])
+        return neighbors
+
+    def neighborhood(self):
+        return list(self.graph.neighborhood(
+            self.users[0], [self.like, self.liked_by], 2, self.nodes, 2 * self.nodes, self.site
+        ))
+
+    def run_reads(self, name, read):
+        self.graph.clear_cache()
+        start = time()
+        read()
+        print("\n%s, cold cache: %.2f ms" % (name, (time() - start) * 1000))
+        self.nested_edge_range()  # caches every edge list read
+        start = time()
+        read()
+        print("%s, warm cache: %.2f ms" % (name, (time() - start) * 1000))
+
+    def test_nested_edge_range(self):
+        self.run_reads("nested edge_range()", self.nested_edge_range)
+
+    def test_neighborhood(self):
+        self.run_reads("neighborhood()", self.neighborhood)
+
+
+class EdgeDatasetBenchmark(TestCase):
+    """
+    Database query benchmarks, over a synthetic dataset of GRAPH_BENCHMARK_EDGES edges (environment variable, 10M for
+    the reference figures; inserted with bulk queries, bypassing the graph api).
+    """
+    edges = int(os.environ.get('GRAPH_BENCHMARK_EDGES', 100000))
+    fanout = 100
+    iterations = 200
+
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.like = EdgeType.objects.create(name="Like", read_as="likes")
+        self.ctype = ContentType.objects.get_for_model(User)
+        nodes = self.edges // self.fanout
+        now = timezone.now()
+        time_field = Edge._meta.get_field('time')
+        time_field.auto_now_add = False  # keep the synthetic times
+        try:
+            for offset in range(0, self.edges, 5000):
+                Edge.objects.bulk_create([
+                    Edge(fromNode_type=self.ctype, fromNode_pk=u'%d' % (i // self.fanout), toNode_type=self.ctype,
+                         toNode_pk=u'%d' % ((i * 7919) % nodes), type=self.like, site=self.site,
+                         time=now - timedelta(seconds=i))
+                    for i in range(offset, min(offset + 5000, self.edges))
+                ])
+        finally:
+            time_field.auto_now_add = True
+
+    def queries(self):
+        pk = u'%d' % (self.edges // self.fanout // 2)
+        return [
+            ("edge list page", Edge.objects.filter(
+                fromNode_type=self.ctype, fromNode_pk=pk, type=self.like, site=self.site
+            ).order_by('-time')[:20]),
+            ("edge list time range", Edge.objects.filter(
+                fromNode_type=self.ctype, fromNode_pk=pk, type=self.like, site=self.site,
+                time__lt=timezone.now() - timedelta(seconds=self.edges // 2)
+            ).order_by('-time')[:20]),
+            ("incoming edge list page", Edge.objects.filter(
+                toNode_type=self.ctype, toNode_pk=pk, type=self.like, site=self.site
+            ).order_by('-time')[:20]),
+            ("in-degree", Edge.objects.filter(
+                toNode_type=self.ctype, toNode_pk=pk, type=self.like, site=self.site
+            ).values('id')),
+        ]
+
+    @staticmethod
+    def explain(queryset):
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        return '\n'.join('    %s' % ' '.join('%s' % column for column in row) for row in cursor.fetchall())
+
+    def run_queries(self, name):
+        print("\n%s (%d edges, %s):" % (name, self.edges, connection.vendor))
+        for query_name, queryset in self.queries():
+            start = time()
+            for i in range(self.iterations):
+                list(queryset.all())
+            elapsed = time() - start
+            print("  %s: %.3f ms/query\n%s" % (query_name, elapsed * 1000 / self.iterations, self.explain(queryset)))
+
+
+
+class EdgeIndexBenchmark(EdgeDatasetBenchmark):
+    """
+    Query plans and timings of the edge list and incoming edge queries, with and without the composite indexes of
+    migrations 0004 and 0005:
+
+        GRAPH_BENCHMARK_EDGES=10000000 python manage.py test test_graph.benchmarks.EdgeIndexBenchmark
+    """
+    indexes = [
+        ['fromNode_type_id', 'fromNode_pk', 'type_id', 'site_id', 'time'],
+        ['toNode_type_id', 'toNode_pk', 'type_id', 'site_id', 'time']
+    ]
+
+    def test_indexes(self):
+        from south.db import db
+
+        self.run_queries("composite indexes")
+        for columns in self.indexes:
+            db.delete_index(Edge._meta.db_table, columns)
+        try:
+            self.run_queries("unique constraint only")
+        finally:
+            for columns in self.indexes:
+                db.create_index(Edge._meta.db_table, columns)
+
+
+class NodePkStorageBenchmark(EdgeDatasetBenchmark):
+    """
+    Index sizes and query timings with the node pk storage selected by GRAPH_NODE_PK_FIELD (an environment variable
+    in the test settings), to compare the layouts run by run:
+
+        GRAPH_NODE_PK_FIELD=text python manage.py test test_graph.benchmarks.NodePkStorageBenchmark
+        GRAPH_NODE_PK_FIELD=integer python manage.py test test_graph.benchmarks.NodePkStorageBenchmark
+    """
+
+    @staticmethod
+    def index_sizes():
+        cursor = connection.cursor()
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT indexname, pg_relation_size(quote_ident(indexname)::regclass) FROM pg_indexes "
+                "WHERE tablename = %s", [Edge._meta.db_table]
+            )
+        elif connection.vendor == 'sqlite':  # requires SQLite built with SQLITE_ENABLE_DBSTAT_VTAB
+            cursor.execute(
+                "SELECT name, SUM(pgsize) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s) GROUP BY name",
+                [Edge._meta.db_table]
+            )
+        else:
+            return []
+        return cursor.fetchall()
+
+    def test_node_pk_storage(self):
+        print("\n%s node pks, index sizes:" % NODE_PK_FIELD)
+        for name, size in self.index_sizes():
+            print("  %s: %.1f MB" % (name, size / 1048576.0))
+        self.run_queries("%s node pks" % NODE_PK_FIELD)
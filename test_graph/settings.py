@@ -1,4 +1,5 @@
 # coding=utf-8
+import os
 
 DEBUG = True
 
@@ -23,6 +24,11 @@ CACHES = {
             }
         },
     },
+    # three databases of the local server, standing in for the servers of a sharded cache
+    'sharded': {
+        'BACKEND': 'social_graph.cache_backend.ShardedRedisCache',
+        'LOCATION': ['redis://127.0.0.1:6379/11', 'redis://127.0.0.1:6379/12', 'redis://127.0.0.1:6379/13'],
+    },
 }
 
 INSTALLED_APPS = [
@@ -39,3 +45,5 @@ ROOT_URLCONF = 'test_graph.urls'
 SITE_ID = 1
 
 SECRET_KEY = 'blabla'
+
+GRAPH_NODE_PK_FIELD = os.environ.get('GRAPH_NODE_PK_FIELD', 'text')
@@ -1,12 +1,25 @@
+import json
+from collections import Counter
+from datetime import timedelta
 from time import sleep, time
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, Group
 from django import forms
 from django.contrib.sites.models import Site
-from django.test import TestCase
-from social_graph.api import Graph, TO_NODE, ATTRIBUTES
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from social_graph import api, outbox
+from social_graph.api import Graph, TO_NODE, ATTRIBUTES, TIME
+from social_graph.edge_list import EdgeList, time_to_score
+from social_graph.fields import (
+    IntegerNodePkField, NODE_PK_FIELD, NODE_PK_COLUMNS, node_pk_storage, convert_node_pk_columns, check_node_pk_columns
+)
 from social_graph.forms import BaseEdgeForm, SpecificTypeEdgeForm
-from social_graph.models import EdgeType, EdgeTypeAssociation, Edge
+from social_graph.models import EdgeType, EdgeTypeAssociation, Edge, EdgeCount
 from social_graph.signals import (
     edge_created, edge_deleted, object_created, object_deleted, edge_updated, object_visited
 )
@@ -228,6 +241,42 @@ class SocialGraphTest(TestCase):
         self.assertEqual(edges[1][TO_NODE].name, self.objects['admin'].name)
         self.assertEqual(edges[2][TO_NODE].name, self.objects['advanced'].name)
 
+    def test_edge_range_after(self):
+        like = self.relationships['like']
+        targets = list(self.objects.values()) + [Group.objects.create(name="group")]
+        now = timezone.now().replace(microsecond=0)
+        for target, seconds in zip(targets, [40, 30, 30, 30, 10]):
+            edge = self.graph.edge(self.users[0], target, like, self.site)
+            Edge.objects.filter(pk=edge.pk).update(time=now - timedelta(seconds=seconds))
+        ctype = ContentType.objects.get_for_model(Group).pk
+        expected = [target for seconds, member, target in sorted(
+            [(-seconds, u'%s:%s' % (ctype, target.pk), target) for target, seconds in zip(targets, [40, 30, 30, 30, 10])],
+            key=lambda position: position[:2], reverse=True
+        )]
+
+        def read_all():
+            edges, cursor = self.graph.edge_range_after(self.users[0], like, None, 2, self.site)
+            self.graph.edge(self.users[0], Group.objects.create(name="newer %d" % len(Group.objects.all())), like,
+                            self.site)  # doesn't shift the pages
+            pages = [edges]
+            while cursor is not None:
+                edges, cursor = self.graph.edge_range_after(self.users[0], like, cursor, 2, self.site)
+                pages.append(edges)
+            return [len(page) for page in pages], [edge[TO_NODE] for page in pages for edge in page]
+
+        self.graph.clear_cache()
+        self.assertEqual(read_all(), ([2, 2, 1], expected))
+        newer = Group.objects.get(name__startswith="newer")  # added while paging: the most recent edge now
+
+        window = api.EDGE_LIST_WINDOW
+        api.EDGE_LIST_WINDOW = 1  # pages past the cached window are read from the database
+        try:
+            self.graph.clear_cache()
+            # (a full last page still has a next cursor, to an empty page)
+            self.assertEqual(read_all(), ([2, 2, 2, 0], [newer] + expected))
+        finally:
+            api.EDGE_LIST_WINDOW = window
+
     def test_edge_change(self):
         self.graph.edge(self.users[0], self.objects['advanced'], self.relationships['like'], self.site)
 
@@ -262,6 +311,26 @@ class SocialGraphTest(TestCase):
             {"quantity": 3}
         )
 
+    def test_edge_change_in_place(self):
+        like = self.relationships['like']
+        edge = self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 1})
+        inverse = Edge.objects.get(type=self.relationships['liked_by'])
+
+        updated = self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 2},
+                                  keep_time=True)
+        self.assertEqual(updated.pk, edge.pk)
+        self.assertEqual(Edge.objects.get(pk=edge.pk).time, edge.time)
+        self.assertEqual(Edge.objects.get(pk=edge.pk).attributes, {"quantity": 2})
+        self.assertEqual(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site).attributes,
+                         {"quantity": 2})
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+        # the symmetric edge is left alone
+        self.assertEqual(Edge.objects.get(type=self.relationships['liked_by']).pk, inverse.pk)
+        self.assertEqual(Edge.objects.get(type=self.relationships['liked_by']).time, inverse.time)
+
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 3})
+        self.assertTrue(Edge.objects.get(pk=edge.pk).time > edge.time)
+
     def test_edge_change_atomicity(self):
         edge_updated.connect(raise_exception, Graph)
         try:
@@ -299,6 +368,534 @@ class SocialGraphTest(TestCase):
         self.assertEqual(edges[0][TO_NODE].name, self.objects['advanced'].name)
         self.assertEqual(edges[1][TO_NODE].name, self.objects['limited'].name)
 
+    def test_edges_bulk(self):
+        like = self.relationships['like']
+        self.graph.edge(self.users[0], self.objects['dummy'], like, self.site)
+        # warm up the cached count and list
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 1)
+
+        edges = self.graph.edges_bulk([
+            (self.users[0], self.objects['advanced'], like, self.site),
+            (self.users[0], self.objects['admin'], like, self.site, {"quantity": 2}),
+            (self.users[0], self.objects['dummy'], like, self.site, {"quantity": 3}),
+        ])
+        # 2 created + 1 updated, and the symmetric edges of the created ones (the updated edge keeps its own)
+        self.assertEqual(len(edges), 5)
+        self.assertEqual(Counter(edge.type for edge in edges),
+                         Counter({like: 3, self.relationships['liked_by']: 2}))
+        self.assertEqual(set(edge.fromNode for edge in edges if edge.type == self.relationships['liked_by']),
+                         {self.objects['advanced'], self.objects['admin']})
+
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 3)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 3)
+        self.assertEqual(len(Edge.objects.filter(fromNode_pk=self.users[0].pk,
+                                                 fromNode_type=ContentType.objects.get_for_model(self.users[0]),
+                                                 type=like,
+                                                 site=self.site)), 3)
+        self.assertEqual(self.graph.edge_get(self.users[0], like, self.objects['dummy'], self.site).attributes,
+                         {"quantity": 3})
+
+        # inverse edges and counters
+        self.assertEqual(self.graph.edge_count(self.objects['admin'], self.relationships['liked_by'], self.site), 1)
+        inverse_edges = self.graph.edge_range(self.objects['admin'], self.relationships['liked_by'], 0, 10, self.site)
+        self.assertEqual(inverse_edges[0][TO_NODE].username, self.users[0].username)
+        self.assertEqual(inverse_edges[0][ATTRIBUTES], {"quantity": 2})
+
+    def test_no_edges_bulk(self):
+        like = self.relationships['like']
+        self.graph.edges_bulk([
+            (self.users[0], self.objects['advanced'], like, self.site),
+            (self.users[0], self.objects['admin'], like, self.site),
+            (self.users[0], self.objects['limited'], like, self.site),
+        ])
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 3)
+
+        deleted = self.graph.no_edges_bulk([
+            (self.users[0], self.objects['advanced'], like, self.site),
+            (self.users[0], self.objects['admin'], like, self.site),
+            (self.users[0], self.objects['dummy'], like, self.site),
+        ])
+        # 2 existing edges + their symmetric edges
+        self.assertEqual(deleted, 4)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+        edges = self.graph.edge_range(self.users[0], like, 0, 10, self.site)
+        self.assertEqual(len(edges), 1)
+        self.assertEqual(edges[0][TO_NODE].name, self.objects['limited'].name)
+        self.assertEqual(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site), None)
+        self.assertEqual(self.graph.edge_count(self.objects['advanced'], self.relationships['liked_by'], self.site), 0)
+        self.assertEqual(self.graph.edge_count(self.objects['limited'], self.relationships['liked_by'], self.site), 1)
+
+    def test_edge_list_rebuild_queries(self):
+        like = self.relationships['like']
+
+        def rebuild_queries(targets):
+            self.graph.edges_bulk([(self.users[0], target, like, self.site) for target in targets])
+            self.graph.clear_cache()
+            with CaptureQueriesContext(connection) as context:
+                edges = self.graph.edge_range(self.users[0], like, 0, 100, self.site)
+                self.assertEqual(set(edge[TO_NODE].pk for edge in edges), set(target.pk for target in targets))
+                self.graph.edges_get(self.users[0], like, targets, self.site)
+            return len(context.captured_queries)
+
+        small = rebuild_queries(list(self.objects.values())[:2])
+        large = rebuild_queries(
+            list(self.objects.values()) + [Group.objects.create(name="group %d" % i) for i in range(10)]
+        )
+        # the number of queries doesn't grow with the size of the list
+        self.assertEqual(small, large)
+
+    def test_edge_list_rebuild_lock(self):
+        like = self.relationships['like']
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 1})
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.clear_cache()
+        list_key = self.graph._list_key(
+            ContentType.objects.get_for_model(self.users[0]).pk, self.users[0].pk, like.pk, self.site.pk
+        )
+        stats = Counter(Graph.rebuild_stats)
+
+        # another process is rebuilding the list: the page is served from the database, and the list isn't rebuilt
+        token = self.graph.cache.acquire_lock(api.REBUILD_LOCK_KEY_FORMAT % {'key': list_key}, 10)
+        edges = self.graph.edge_range(self.users[0], like, 0, 0, self.site)
+        self.assertEqual(len(edges), 1)
+        self.assertEqual(edges[0][TO_NODE].name, self.objects['admin'].name)
+        self.assertEqual(self.graph.cache.sorted_set_count(list_key), 0)
+        self.assertEqual(Graph.rebuild_stats['db_fallbacks'] - stats['db_fallbacks'], 1)
+
+        edges = self.graph.edge_time_range(self.users[0], like, 0, time(), 10, self.site)
+        self.assertEqual([edge[ATTRIBUTES] for edge in edges][1], {"quantity": 1})
+        self.assertEqual(Graph.rebuild_stats['db_fallbacks'] - stats['db_fallbacks'], 2)
+
+        self.graph.cache.release_lock(api.REBUILD_LOCK_KEY_FORMAT % {'key': list_key}, token)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 2)
+        self.assertEqual(self.graph.cache.sorted_set_count(list_key), 2)
+        self.assertEqual(Graph.rebuild_stats['rebuilds'] - stats['rebuilds'], 1)
+
+    def test_edge_list_window(self):
+        like = self.relationships['like']
+        targets = list(self.objects.values()) + [Group.objects.create(name="group %d" % i) for i in range(2)]
+        for target in targets:
+            self.graph.edge(self.users[0], target, like, self.site)
+        ctype = ContentType.objects.get_for_model(self.users[0]).pk
+        list_key = self.graph._list_key(ctype, self.users[0].pk, like.pk, self.site.pk)
+        state_key = self.graph._list_state_key(ctype, self.users[0].pk, like.pk, self.site.pk)
+
+        window = api.EDGE_LIST_WINDOW
+        api.EDGE_LIST_WINDOW = 2
+        try:
+            self.graph.clear_cache()
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 1, self.site)), 2)
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 2)
+            self.assertEqual(self.graph.cache.get(state_key), api.TRUNCATED)
+
+            # deeper pages extend the cached window
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 2, self.site)), 3)
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 4)
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), len(targets))
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), len(targets))
+            self.assertEqual(self.graph.cache.get(state_key), api.COMPLETE)
+
+            # the state expires along with its list: reading or adding to the list refreshes both
+            def expire_soon():
+                for key in (list_key, state_key):
+                    key = self.graph.cache.make_key(key)
+                    self.graph.cache.master_for(key).expire(key, 10)
+
+            def ttl(key):
+                key = self.graph.cache.make_key(key)
+                return self.graph.cache.master_for(key).ttl(key)
+
+            timeouts = api.CACHE_TIMEOUTS
+            api.CACHE_TIMEOUTS = dict(timeouts, list=200)
+            try:
+                expire_soon()
+                self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), len(targets))
+                self.assertTrue(10 < ttl(state_key) <= 200)
+                expire_soon()
+                targets.append(Group.objects.create(name="group 2"))
+                self.graph.edge(self.users[0], targets[-1], like, self.site)
+                self.assertTrue(10 < ttl(list_key) <= 200)
+                self.assertTrue(10 < ttl(state_key) <= 200)
+            finally:
+                api.CACHE_TIMEOUTS = timeouts
+
+            # time ranges past the cached window are read from the database
+            self.graph.clear_cache()
+            edges = self.graph.edge_time_range(self.users[0], like, 0, time() + 1, 10, self.site)
+            self.assertEqual(len(edges), len(targets))
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 2)
+        finally:
+            api.EDGE_LIST_WINDOW = window
+
+    def test_edge_list_rebuild_race(self):
+        like = self.relationships['like']
+        targets = list(self.objects.values())[:3]
+        for target in targets:
+            self.graph.edge(self.users[0], target, like, self.site)
+        newer = self.objects['dummy']
+        list_key = self.graph._list_key(
+            ContentType.objects.get_for_model(self.users[0]).pk, self.users[0].pk, like.pk, self.site.pk
+        )
+        edges_from_db = Graph._edges_from_db
+        reads = []
+
+        def racing_edges_from_db(*args, **kwargs):
+            edges = list(edges_from_db(*args, **kwargs))
+            reads.append(len(edges))
+            if len(reads) == 1:  # an edge is added between the snapshot and the rebuilt list write
+                self.graph.edge(self.users[0], newer, like, self.site)
+            return edges
+
+        window = api.EDGE_LIST_WINDOW
+        api.EDGE_LIST_WINDOW = 1
+        try:
+            self.graph.clear_cache()
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 0, self.site)), 1)
+            self.graph._edges_from_db = racing_edges_from_db
+            try:
+                # extending the window: the list patched meanwhile is read again, not overwritten
+                edges = self.graph.edge_range(self.users[0], like, 0, 2, self.site)
+            finally:
+                del self.graph._edges_from_db
+            self.assertEqual(reads, [3, 3])
+            self.assertEqual(edges[0][TO_NODE], newer)
+            self.assertEqual(self.graph.edge_range(self.users[0], like, 0, 0, self.site)[0][TO_NODE], newer)
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 3)
+        finally:
+            api.EDGE_LIST_WINDOW = window
+
+    def test_cache_timeouts(self):
+        like = self.relationships['like']
+        ctype = ContentType.objects.get_for_model(self.users[0]).pk
+        ctype2 = ContentType.objects.get_for_model(self.objects['advanced']).pk
+        keys = {
+            'count': self.graph._count_key(ctype, self.users[0].pk, like.pk, self.site.pk),
+            'list': self.graph._list_key(ctype, self.users[0].pk, like.pk, self.site.pk),
+            'edge': self.graph._edge_key(ctype, self.users[0].pk, like.pk, ctype2, self.objects['advanced'].pk,
+                                         self.site.pk)
+        }
+
+        def ttl(key):
+            key = self.graph.cache.make_key(key)
+            return self.graph.cache.master_for(key).ttl(key)
+
+        def read():
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 1)
+            self.assertIsNotNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+
+        timeouts = api.CACHE_TIMEOUTS
+        api.CACHE_TIMEOUTS = {'count': 100, 'list': 200, 'edge': 300}
+        try:
+            self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+            self.graph.clear_cache()
+            read()
+            for family, key in keys.items():
+                self.assertTrue(0 < ttl(key) <= api.CACHE_TIMEOUTS[family], family)
+
+            # reads refresh the expiration
+            for key in keys.values():
+                key = self.graph.cache.make_key(key)
+                self.graph.cache.master_for(key).expire(key, 10)
+            read()
+            for family, key in keys.items():
+                self.assertTrue(10 < ttl(key) <= api.CACHE_TIMEOUTS[family], family)
+
+            # expired keys are loaded again from the database
+            api.CACHE_TIMEOUTS = {'count': 1, 'list': 1, 'edge': 1}
+            self.graph.clear_cache()
+            read()
+            sleep(2)
+            for family, key in keys.items():
+                self.assertFalse(key in self.graph.cache, family)
+            read()
+        finally:
+            api.CACHE_TIMEOUTS = timeouts
+
+    def test_edge_get_negative_caching(self):
+        like = self.relationships['like']
+        self.assertIsNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+        with CaptureQueriesContext(connection) as context:
+            self.assertIsNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+            self.assertEqual(self.graph.edges_get(self.users[0], like, [self.objects['advanced']], self.site), [])
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # add after miss
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 1})
+        self.assertEqual(
+            self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site).attributes, {"quantity": 1}
+        )
+        self.assertEqual(len(self.graph.edges_get(self.users[0], like, [self.objects['advanced']], self.site)), 1)
+
+        # update after miss
+        self.assertEqual(self.graph.edges_get(self.users[0], like, [self.objects['admin']], self.site), [])
+        with CaptureQueriesContext(connection) as context:
+            self.assertIsNone(self.graph.edge_get(self.users[0], like, self.objects['admin'], self.site))
+        self.assertEqual(len(context.captured_queries), 0)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site, {"quantity": 2})
+        self.assertEqual(
+            self.graph.edge_get(self.users[0], like, self.objects['admin'], self.site).attributes, {"quantity": 2}
+        )
+
+        # delete, and add again
+        self.graph.no_edge(self.users[0], self.objects['advanced'], like, self.site)
+        with CaptureQueriesContext(connection) as context:
+            self.assertIsNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+        self.assertEqual(len(context.captured_queries), 0)
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.assertIsNotNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 2)
+
+    def test_edge_counts_many(self):
+        like, liked_by = self.relationships['like'], self.relationships['liked_by']
+        self.users.append(User.objects.create(username="juan"))
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.edge(self.users[1], self.objects['admin'], like, self.site)
+        nodes = [self.users[0], self.users[1], self.objects['advanced'], self.objects['admin']]
+        expected = {
+            (self.users[0], like): 2, (self.users[0], liked_by): 0,
+            (self.users[1], like): 1, (self.users[1], liked_by): 0,
+            (self.objects['advanced'], like): 0, (self.objects['advanced'], liked_by): 1,
+            (self.objects['admin'], like): 0, (self.objects['admin'], liked_by): 2,
+        }
+
+        self.graph.clear_cache()
+        self.graph.edge_count(self.users[0], like, self.site)  # some counts cached, some not
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.graph.edge_counts_many(nodes, [like, liked_by], self.site), expected)
+        self.assertEqual(len(context.captured_queries), 1)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.graph.edge_counts_many(nodes, [like, liked_by], self.site), expected)
+        self.assertEqual(len(context.captured_queries), 0)
+        for (node, etype), count in expected.items():
+            self.assertEqual(self.graph.edge_count(node, etype, self.site), count)
+
+    def test_merged_edge_range(self):
+        like = self.relationships['like']
+        self.users.append(User.objects.create(username="juan"))
+        now = timezone.now()
+        for seconds, from_node, to_node in [(30, self.users[0], self.objects['advanced']),
+                                            (20, self.users[1], self.objects['admin']),
+                                            (10, self.users[0], self.objects['limited'])]:
+            edge = self.graph.edge(from_node, to_node, like, self.site, {"seconds": seconds})
+            Edge.objects.filter(pk=edge.pk).update(time=now - timedelta(seconds=seconds))
+        sources = [self.users[0], self.users[1], self.objects['dummy']]
+        expected = [(self.users[0], 'limited users', 10), (self.users[1], 'administrators', 20),
+                    (self.users[0], 'advanced users', 30)]
+
+        def read(*args):
+            return [(node, item[TO_NODE].name, item[ATTRIBUTES]['seconds'])
+                    for node, item in self.graph.merged_edge_range(sources, like, *args, site=self.site)]
+
+        self.graph.clear_cache()
+        self.assertEqual(read(10), expected)
+        # all the lists are cached now
+        with CaptureQueriesContext(connection) as context:
+            self.graph.merged_edge_range(sources, like, 10, site=self.site)
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(read(10), expected)
+
+        # keyset pagination
+        page = self.graph.merged_edge_range(sources, like, 2, site=self.site)
+        self.assertEqual(len(page), 2)
+        self.assertEqual(read(2, time_to_score(page[-1][1][TIME])), expected[2:])
+
+        # missing lists are rebuilt through their window only
+        list_key = self.graph._list_key(ContentType.objects.get_for_model(User).pk, self.users[0].pk, like.pk,
+                                        self.site.pk)
+        window = api.EDGE_LIST_WINDOW
+        api.EDGE_LIST_WINDOW = 1
+        try:
+            self.graph.clear_cache()
+            stats = Counter(Graph.rebuild_stats)
+            self.assertEqual(read(1), expected[:1])
+            self.assertEqual(Graph.rebuild_stats['rebuilds'] - stats['rebuilds'], len(sources))
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 1)
+            self.assertEqual(read(10), expected)
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 2)
+            self.graph.clear_cache()
+            self.assertEqual(read(2, time_to_score(page[-1][1][TIME])), expected[2:])
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 1)
+        finally:
+            api.EDGE_LIST_WINDOW = window
+
+    def _mutual_likes(self):
+        like = self.relationships['like']
+        self.users.extend([User.objects.create(username="juan"), User.objects.create(username="maria")])
+        for user, group in [(0, 'advanced'), (0, 'admin'), (1, 'admin'), (1, 'limited'), (2, 'admin'), (2, 'advanced')]:
+            self.graph.edge(self.users[user], self.objects[group], like, self.site)
+
+    def test_common_neighbors(self):
+        like = self.relationships['like']
+        self._mutual_likes()
+        self.graph.clear_cache()
+        self.assertEqual(self.graph.common_neighbors(self.users[0], self.users[1], like, 10, self.site),
+                         [self.objects['admin']])
+        self.assertEqual(set(self.graph.common_neighbors(self.users[0], self.users[2], like, 10, self.site)),
+                         {self.objects['admin'], self.objects['advanced']})
+        self.assertEqual(len(self.graph.common_neighbors(self.users[0], self.users[2], like, 1, self.site)), 1)
+        self.assertEqual(self.graph.common_neighbors_many(self.users, like, 10, self.site), [self.objects['admin']])
+        self.assertEqual(
+            self.graph.common_neighbors_many(self.users + [self.objects['dummy']], like, 10, self.site), []
+        )
+
+    def test_neighborhood(self):
+        like, liked_by = self.relationships['like'], self.relationships['liked_by']
+        self._mutual_likes()
+        etypes = [like, liked_by]
+        expected = {
+            self.objects['advanced']: 1, self.objects['admin']: 1, self.users[1]: 2, self.users[2]: 2,
+            self.objects['limited']: 3
+        }
+        self.graph.clear_cache()
+        self.assertEqual(dict(self.graph.neighborhood(self.users[0], etypes, 3, 10, 10, self.site)), expected)
+
+        # from the cached edge lists: only the nodes found are loaded, one query per level (one content type each)
+        # (the lists found empty, e.g. users liked by nobody, got their zero count cached by the first traversal)
+        for user in self.users:
+            self.graph.edge_range(user, like, 0, 10, self.site)
+        for group in self.objects.values():
+            self.graph.edge_range(group, liked_by, 0, 10, self.site)
+        with self.assertNumQueries(3):
+            neighbors = list(self.graph.neighborhood(self.users[0], etypes, 3, 10, 10, self.site))
+        self.assertEqual(dict(neighbors), expected)
+        self.assertEqual([distance for neighbor, distance in neighbors], [1, 1, 2, 2, 3])
+
+        # limits and fan-out caps
+        self.assertEqual(
+            [distance for neighbor, distance in self.graph.neighborhood(self.users[0], etypes, 3, 10, 3, self.site)],
+            [1, 1, 2]
+        )
+        self.assertEqual(len(list(self.graph.neighborhood(self.users[0], like, 2, 1, 10, self.site))), 1)
+        neighbors = list(self.graph.neighborhood(self.users[0], etypes, 2, [10, 1], 10, self.site))
+        self.assertEqual(len([neighbor for neighbor, distance in neighbors if distance == 1]), 2)
+        self.assertTrue(len(neighbors) <= 4)
+        self.assertEqual(list(self.graph.neighborhood(self.objects['dummy'], etypes, 3, 10, 10, self.site)), [])
+
+    def test_in_edges(self):
+        follow = EdgeType.objects.create(name="Follow", read_as="follows")  # one-directional: no inverse type
+        self.users.append(User.objects.create(username="juan"))
+        node = A.objects.create(a=1)
+        group = self.objects['advanced']
+        self.graph.edge(self.users[0], group, follow, self.site, {'since': 2010})
+        self.graph.edge(self.users[1], group, follow, self.site)
+        self.assertEqual(
+            Edge.objects.filter(toNode_type=ContentType.objects.get_for_model(User), toNode_pk=self.users[0].pk).count(), 0
+        )
+
+        self.graph.clear_cache()
+        self.assertEqual(self.graph.in_edge_count(group, follow, self.site), 2)
+        self.assertEqual(self.graph.in_edge_count(self.objects['admin'], follow, self.site), 0)
+        self.assertEqual(len(self.graph.in_edge_range(self.objects['admin'], follow, 0, 10, self.site)), 0)
+        followers = self.graph.in_edge_range(group, follow, 0, 10, self.site)
+        self.assertEqual(set(item.node for item in followers), {self.users[0], self.users[1]})
+        self.assertEqual(dict((item.node, item.attributes) for item in followers)[self.users[0]], {'since': 2010})
+
+        # the cached incoming list and in-degree follow the writes
+        self.graph.edge(node, group, follow, self.site)
+        self.graph.no_edge(self.users[1], group, follow, self.site)
+        with CaptureQueriesContext(connection) as context:
+            followers = self.graph.in_edge_range(group, follow, 0, 10, self.site)
+            self.assertEqual(self.graph.in_edge_count(group, follow, self.site), 2)
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(set(item.node for item in followers), {self.users[0], node})
+
+        edges = self.graph.in_edges_get(group, follow, self.users + [node], self.site)
+        self.assertEqual([edge[0] for edge in edges], [self.users[0], node])
+        self.assertEqual(edges[0][ATTRIBUTES], {'since': 2010})
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(len(self.graph.in_edges_get(group, follow, self.users + [node], self.site)), 2)
+        self.assertEqual(len(context.captured_queries), 0)
+
+        node.delete()
+        self.assertEqual(self.graph.in_edge_count(group, follow, self.site), 1)
+        self.assertEqual([item.node for item in self.graph.in_edge_range(group, follow, 0, 10, self.site)],
+                         [self.users[0]])
+
+        # incoming lists are rebuilt the way edge lists are: single-flight, and through their window
+        self.graph.edge(self.users[1], group, follow, self.site)
+        ctype = ContentType.objects.get_for_model(group).pk
+        list_key = self.graph._in_list_key(ctype, group.pk, follow.pk, self.site.pk)
+        state_key = self.graph._in_list_state_key(ctype, group.pk, follow.pk, self.site.pk)
+        window = api.EDGE_LIST_WINDOW
+        api.EDGE_LIST_WINDOW = 1
+        try:
+            self.graph.clear_cache()
+            stats = Counter(Graph.rebuild_stats)
+            token = self.graph.cache.acquire_lock(api.REBUILD_LOCK_KEY_FORMAT % {'key': list_key}, 10)
+            self.assertEqual([item.node for item in self.graph.in_edge_range(group, follow, 0, 0, self.site)],
+                             [self.users[1]])
+            self.assertEqual(Graph.rebuild_stats['db_fallbacks'] - stats['db_fallbacks'], 1)
+            self.graph.cache.release_lock(api.REBUILD_LOCK_KEY_FORMAT % {'key': list_key}, token)
+
+            self.assertEqual([item.node for item in self.graph.in_edge_range(group, follow, 0, 0, self.site)],
+                             [self.users[1]])
+            self.assertEqual(self.graph.cache.sorted_set_count(list_key), 1)
+            self.assertEqual(self.graph.cache.get(state_key), api.TRUNCATED)
+            self.assertEqual(self.graph.in_edge_count(group, follow, self.site), 2)
+            self.assertEqual([item.node for item in self.graph.in_edge_range(group, follow, 0, 10, self.site)],
+                             [self.users[1], self.users[0]])
+            self.assertEqual(self.graph.cache.get(state_key), api.COMPLETE)
+            self.assertEqual(Graph.rebuild_stats['rebuilds'] - stats['rebuilds'], 2)
+        finally:
+            api.EDGE_LIST_WINDOW = window
+
+    def test_local_cache(self):
+        like = self.relationships['like']
+        count_key = self.graph._count_key(
+            ContentType.objects.get_for_model(User).pk, self.users[0].pk, like.pk, self.site.pk
+        )
+        local_cache = api.LOCAL_CACHE
+        api.LOCAL_CACHE = {'size': 3, 'timeout': 60}
+        try:
+            local = self.graph._local()
+            local._ensure_listener()
+            for i in range(100):
+                if local._listening:
+                    break
+                sleep(0.01)
+            self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+            self.assertEqual(local.stats[('count', 'hits')], 1)
+
+            # writes invalidate the values they change
+            self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 2)
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 2)
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 2)
+            self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 0, self.site)), 1)
+            self.assertEqual(local.stats[('list', 'hits')], 1)
+            self.assertIsNone(self.graph.edge_get(self.users[0], like, self.objects['limited'], self.site))
+            self.graph.edge(self.users[0], self.objects['limited'], like, self.site)
+            self.assertIsNotNone(self.graph.edge_get(self.users[0], like, self.objects['limited'], self.site))
+            self.assertLessEqual(len(local._entries), 3)
+
+            # invalidations published by other processes
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 3)
+            self.graph.cache.set(count_key, 5)
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 3)
+            generation = local.generation
+            self.graph.cache.publish(local.channel, json.dumps([count_key]))
+            for i in range(100):
+                if local.generation != generation:
+                    break
+                sleep(0.01)
+            self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 5)
+            self.assertTrue(0 < local.hit_ratios()['count'] < 1)
+
+            # one listener per process and graph cache alias, until stopped
+            self.assertIs(Graph()._local(), local)
+            Graph.stop_local_caches()
+            self.assertFalse(local._listening)
+            self.assertIsNot(self.graph._local(), local)
+        finally:
+            api.LOCAL_CACHE = local_cache
+            Graph.stop_local_caches()
+
     # noinspection PyUnusedLocal
     def _created_flag_on(self, **kwargs):
         self.created_flag = True
@@ -363,6 +960,45 @@ class SocialGraphTest(TestCase):
         object_deleted.disconnect(self._deleted_flag_on, B)
         object_visited.disconnect(self._visited_flag_on)
 
+    def test_node_delete_cleans_edges(self):
+        like, liked_by = self.relationships['like'], self.relationships['liked_by']
+        node = A.objects.create(a=1)
+        self.graph.edge(self.users[0], node, like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.edge(node, self.objects['advanced'], like, self.site)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 2)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 2)
+        self.assertEqual(self.graph.edge_count(self.objects['advanced'], liked_by, self.site), 1)
+
+        # savepoint, edges lookup and delete, node counters lookup and delete, other counters lookup and grouped update,
+        # release, node delete
+        with self.assertNumQueries(9):
+            node.delete()
+        ctype = ContentType.objects.get_for_model(A)
+        self.assertFalse(Edge.objects.filter(fromNode_type=ctype).exists())
+        self.assertFalse(Edge.objects.filter(toNode_type=ctype).exists())
+        self.assertFalse(EdgeCount.objects.filter(fromNode_type=ctype).exists())
+        self.assertEqual(Edge.objects.count(), 2)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+        self.assertEqual(EdgeCount.objects.get(fromNode_pk=self.users[0].pk, type=like).count, 1)
+        edges = self.graph.edge_range(self.users[0], like, 0, 10, self.site)
+        self.assertEqual([edge[TO_NODE] for edge in edges], [self.objects['admin']])
+        self.assertEqual(self.graph.edge_count(self.objects['advanced'], liked_by, self.site), 0)
+
+    def test_unregistered_node_delete(self):
+        node = B.objects.create(b=1)
+        self.graph.edge(self.users[0], node, self.relationships['like'], self.site)
+        # not a graph node: its deletion doesn't look for edges
+        with self.assertNumQueries(1):
+            node.delete()
+
+    def test_integer_node_pk_field(self):
+        field = IntegerNodePkField()
+        self.assertEqual(field.to_python(42), u'42')
+        self.assertEqual(field.to_python(u'42'), u'42')
+        self.assertEqual(field.get_prep_value(u'42'), 42)
+        self.assertIsNone(field.get_prep_value(None))
+
     # noinspection PyProtectedMember
     def test_singleton(self):
         self.assertEqual(self.graph._instance_count, 1)
@@ -408,6 +1044,32 @@ class SocialGraphTest(TestCase):
             association
         )
 
+    def test_edge_type_registry(self):
+        from social_graph import models
+
+        follow = EdgeType.objects.create(name="Follow", read_as="follows")
+        self.assertRaises(EdgeTypeAssociation.DoesNotExist, EdgeTypeAssociation.objects.get_for_direct_edge_type, follow)
+        # preloaded, negative entries included
+        with self.assertNumQueries(0):
+            self.assertIsNone(Graph._inverse_type(follow))
+            self.assertEqual(Graph._inverse_type(self.relationships['like']), self.relationships['liked_by'])
+            self.assertEqual(EdgeType.objects.get(name="Follow"), follow)
+
+        # changes made by other processes are seen once the shared version is bumped
+        interval = models.REGISTRY_CHECK_INTERVAL
+        models.REGISTRY_CHECK_INTERVAL = 0
+        try:
+            EdgeType.objects.filter(pk=follow.pk).update(read_as="is a fan of")
+            self.assertEqual(EdgeType.objects.get(pk=follow.pk).read_as, "follows")
+            models.EdgeTypeRegistry._bump()
+            self.assertEqual(EdgeType.objects.get(pk=follow.pk).read_as, "is a fan of")
+        finally:
+            models.REGISTRY_CHECK_INTERVAL = interval
+
+        # and so are the changes made by this one
+        EdgeTypeAssociation.objects.create(direct=follow, inverse=EdgeType.objects.create(name="Followed By"))
+        self.assertEqual(Graph._inverse_type(follow).name, "Followed By")
+
     def test_edge_form_descendants(self):
         like = self.relationships['like']
 
@@ -493,6 +1155,248 @@ class SocialGraphTest(TestCase):
         self.assertEqual(edges[0][ATTRIBUTES], {'rating': '5', 'favorite': True})
 
 
+class CompactEdgeListTest(SocialGraphTest):
+    """
+    Runs the whole graph test suite with compact edge list members.
+    """
+    def setUp(self):
+        self.compact = api.COMPACT_EDGE_LISTS
+        api.COMPACT_EDGE_LISTS = True
+        super(CompactEdgeListTest, self).setUp()
+
+    def tearDown(self):
+        api.COMPACT_EDGE_LISTS = self.compact
+
+    def test_lazy_hydration(self):
+        like = self.relationships['like']
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site, {"quantity": 1})
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site, {"quantity": 2})
+        self.graph.edge_range(self.users[0], like, 0, 10, self.site)  # warm up the list
+
+        with self.assertNumQueries(0):
+            edges = self.graph.edge_range(self.users[0], like, 0, 10, self.site)
+            self.assertIsInstance(edges, EdgeList)
+            group_ctype = ContentType.objects.get_for_model(Group).pk
+            self.assertEqual(
+                sorted(edges.keys()),
+                sorted([(group_ctype, u'%s' % self.objects['advanced'].pk),
+                        (group_ctype, u'%s' % self.objects['admin'].pk)])
+            )
+            self.assertEqual(sorted(edge[ATTRIBUTES]['quantity'] for edge in edges), [1, 2])
+        # all nodes of the same type are hydrated by a single query
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                set(edge[TO_NODE].name for edge in edges),
+                {self.objects['advanced'].name, self.objects['admin'].name}
+            )
+
+    def test_edge_list_stays_warm(self):
+        like = self.relationships['like']
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['limited'], like, self.site)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 3)  # warm up the list
+
+        self.graph.no_edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site, {"quantity": 3})
+
+        # the list was patched in place, not invalidated: reading it doesn't rebuild it from the database
+        with self.assertNumQueries(0):
+            edges = self.graph.edge_range(self.users[0], like, 0, 10, self.site)
+            self.assertEqual(len(edges), 2)
+        # edges of the same second may come in any order: look them up by node
+        attributes = dict((edge[TO_NODE].name, edge[ATTRIBUTES]) for edge in edges)
+        self.assertEqual(attributes[self.objects['admin'].name], {"quantity": 3})
+        self.assertIn(self.objects['limited'].name, attributes)
+
+    def test_common_neighbors_warm(self):
+        like = self.relationships['like']
+        self._mutual_likes()
+        for user in self.users:
+            self.graph.edge_range(user, like, 0, 10, self.site)  # warm up the lists
+
+        # intersected in the cache: only the neighbors are loaded from the database
+        with self.assertNumQueries(1):
+            self.assertEqual(set(self.graph.common_neighbors(self.users[0], self.users[2], like, 10, self.site)),
+                             {self.objects['admin'], self.objects['advanced']})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.graph.common_neighbors_many(self.users, like, 10, self.site),
+                             [self.objects['admin']])
+
+
+@override_settings(GRAPH_CACHE_ALIAS='sharded')
+class ShardedGraphTest(SocialGraphTest):
+    """
+    Runs the whole graph test suite over a sharded graph cache.
+    """
+    def setUp(self):
+        # the keys of a sharded graph cache carry the hash tag of their node
+        self.key_formats = dict((name, getattr(api, name)) for name in api.key_formats(True))
+        for name, key_format in api.key_formats(True).items():
+            setattr(api, name, key_format)
+        super(ShardedGraphTest, self).setUp()
+
+    def tearDown(self):
+        for name, key_format in self.key_formats.items():
+            setattr(api, name, key_format)
+
+    def test_node_keys_in_one_shard(self):
+        like = self.relationships['like']
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 1)
+        self.assertEqual(len(self.graph.edge_range(self.users[0], like, 0, 10, self.site)), 1)
+        self.assertIsNotNone(self.graph.edge_get(self.users[0], like, self.objects['advanced'], self.site))
+
+        ctype = ContentType.objects.get_for_model(User).pk
+        keys = [
+            self.graph._count_key(ctype, self.users[0].pk, like.pk, self.site.pk),
+            self.graph._list_key(ctype, self.users[0].pk, like.pk, self.site.pk),
+            self.graph._edge_key(ctype, self.users[0].pk, like.pk, ContentType.objects.get_for_model(Group).pk,
+                                 self.objects['advanced'].pk, self.site.pk)
+        ]
+        cache = self.graph.cache
+        self.assertEqual(len(set(cache.master_for(key) for key in keys)), 1)
+        for key in cache.make_keys(keys):
+            self.assertTrue(cache.master_for(key).exists(key))
+        # the keys of the graph cache of the test settings (not sharded) are left untagged
+        self.assertEqual(self.key_formats['COUNT_KEY_FORMAT'], "count:%(ctype)s:%(pk)s:%(etype)s:%(site)s")
+
+
+class DeferredConsistencyTest(TransactionTestCase):
+    """
+    Deferred consistency enforcement, over real transactions: the tasks reach the outbox once committed.
+    """
+    def setUp(self):
+        self.deferred = outbox.DEFERRED_CONSISTENCY
+        outbox.DEFERRED_CONSISTENCY = True
+        self.graph = Graph()
+        self.graph.clear_cache()
+        self.users = [User.objects.create(username="pepe")]
+        self.objects = {
+            'advanced': Group.objects.create(name="advanced users"),
+            'admin': Group.objects.create(name="administrators"),
+            'limited': Group.objects.create(name="limited users")
+        }
+        self.relationships = {
+            'like': EdgeType.objects.create(name="Like", read_as="likes"),
+            'liked_by': EdgeType.objects.create(name="Liked By", read_as="is liked by")
+        }
+        EdgeTypeAssociation.objects.create(direct=self.relationships['like'], inverse=self.relationships['liked_by'])
+        self.site = Site.objects.get_current()
+
+    def tearDown(self):
+        outbox.DEFERRED_CONSISTENCY = self.deferred
+        self.graph.clear_cache()
+        # the content types are flushed with the database
+        ContentType.objects.clear_cache()
+
+    def test_deferred_consistency(self):
+        like, liked_by = self.relationships['like'], self.relationships['liked_by']
+        self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        # only the edges themselves are written in the request path
+        self.assertEqual(Edge.objects.count(), 2)
+        self.assertEqual(EdgeCount.objects.count(), 0)
+
+        self.assertEqual(outbox.process(), 4)
+        self.assertEqual(Edge.objects.count(), 4)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 2)
+        self.assertEqual(self.graph.edge_count(self.objects['admin'], liked_by, self.site), 1)
+        self.assertEqual(EdgeCount.objects.get(fromNode_pk=self.users[0].pk, type=like).count, 2)
+        self.assertEqual(len(self.graph.edge_range(self.objects['admin'], liked_by, 0, 10, self.site)), 1)
+
+        self.graph.no_edge(self.users[0], self.objects['admin'], like, self.site)
+        self.graph.edge(self.users[0], self.objects['limited'], like, self.site)
+        self.assertEqual(outbox.process(), 4)
+        self.assertEqual(outbox.process(), 0)
+        self.assertEqual(
+            set(edge.toNode for edge in Edge.objects.filter(type=liked_by)),
+            {self.users[0]}
+        )
+        self.assertEqual(Edge.objects.filter(type=liked_by).count(), 2)
+        self.assertEqual(self.graph.edge_count(self.users[0], like, self.site), 2)
+        self.assertEqual(self.graph.edge_count(self.objects['admin'], liked_by, self.site), 0)
+        self.assertEqual(self.graph.edge_count(self.objects['limited'], liked_by, self.site), 1)
+
+    def test_outbox_transactions(self):
+        like = self.relationships['like']
+        # the tasks of a rolled back edge() are dropped
+        edge_created.connect(raise_exception)
+        try:
+            self.assertRaises(MyException, self.graph.edge, self.users[0], self.objects['advanced'], like, self.site)
+        finally:
+            edge_created.disconnect(raise_exception)
+        self.assertEqual(Edge.objects.count(), 0)
+        self.assertEqual(outbox.process(), 0)
+
+        # inside an outer transaction, they wait for it to finish
+        with transaction.atomic():
+            self.graph.edge(self.users[0], self.objects['advanced'], like, self.site)
+            self.assertEqual(outbox.process(), 0)
+        if getattr(transaction, 'on_commit', None) is None:
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(outbox.process(), 2)
+
+        # and later edges are still pushed once committed
+        self.graph.edge(self.users[0], self.objects['admin'], like, self.site)
+        self.assertEqual(outbox.process(), 2)
+
+
+class EdgeTypeRegistryTransactionTest(TransactionTestCase):
+    """
+    Shared edge types registry version, over real transactions.
+    """
+    def tearDown(self):
+        Graph().clear_cache()
+        # the content types are flushed with the database
+        ContentType.objects.clear_cache()
+
+    def test_version_bumped_once_committed(self):
+        from social_graph import models
+
+        def version():
+            return Graph().cache.get(models.REGISTRY_VERSION_KEY, 0)
+
+        with transaction.atomic():
+            follow = EdgeType.objects.create(name="Follow", read_as="follows")
+            self.assertEqual(EdgeType.objects.get(name="Follow"), follow)
+            bumped = version()
+        # bumped again once committed (by the next registry access, without commit hooks)
+        self.assertEqual(EdgeType.objects.get(name="Follow"), follow)
+        self.assertEqual(version(), bumped + 1)
+        EdgeType.objects.get(name="Follow")
+        self.assertEqual(version(), bumped + 1)
+
+
+
+class NodePkColumnsTest(TransactionTestCase):
+    """
+    Node pk columns conversions, over committed rows (PostgreSQL can't alter a table with pending constraint checks).
+    """
+    def tearDown(self):
+        Graph().clear_cache()
+        # the content types are flushed with the database
+        ContentType.objects.clear_cache()
+
+    def test_node_pk_columns(self):
+        from south.db import db
+
+        like = EdgeType.objects.create(name="Like", read_as="likes")
+        user, group = User.objects.create(username="pepe"), Group.objects.create(name="advanced users")
+        Graph().edge(user, group, like, Site.objects.get_current())
+        self.assertEqual([node_pk_storage(table, column) for table, column in NODE_PK_COLUMNS],
+                         [NODE_PK_FIELD] * len(NODE_PK_COLUMNS))
+        check_node_pk_columns()
+        self.assertEqual(convert_node_pk_columns(db), [])
+
+        # columns left behind by a setting change are found, and converted back
+        self.assertEqual(convert_node_pk_columns(db, 'char' if NODE_PK_FIELD != 'char' else 'text'), NODE_PK_COLUMNS)
+        self.assertRaises(ImproperlyConfigured, check_node_pk_columns)
+        self.assertEqual(convert_node_pk_columns(db), NODE_PK_COLUMNS)
+        check_node_pk_columns()
+        self.assertEqual(Edge.objects.get(fromNode_pk=user.pk, type=like).toNode, group)
+
+
 if __name__ == '__main__':
     import unittest
     unittest.main()